@@ -0,0 +1,79 @@
+try:
+    from PySide import QtGui
+except ImportError:
+    from PyQt4 import QtGui
+from util import Singleton
+
+
+class AnimationPlayer(Singleton):
+    """
+    Plays animated gifs (smileys, spinners) for all widgets. Every file is decoded by one QMovie.
+    Movie runs only while some subscriber shows it, subscribers tell which animations are visible now.
+    All movies are paused while main window is hidden
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._movies = {}  # path to gif -> QMovie
+        self._subscribers = {}  # key of subscriber -> tuple (set of paths, callback)
+        self._paused = False
+
+    def _get_movie(self, path):
+        if path not in self._movies:
+            movie = QtGui.QMovie(path)
+            movie.setCacheMode(QtGui.QMovie.CacheAll)  # every frame is decoded once
+            movie.jumpToFrame(0)
+            movie.frameChanged[int].connect(lambda x: self._frame_changed(path))
+            self._movies[path] = movie
+        return self._movies[path]
+
+    def get_frame(self, path):
+        """
+        :param path: path to gif
+        :return: current frame of animation (QPixmap)
+        """
+        return self._get_movie(path).currentPixmap()
+
+    def set_animations(self, key, paths, callback=None):
+        """
+        Sets animations shown by subscriber
+        :param key: key of subscriber
+        :param paths: paths to gifs which are visible in subscriber now
+        :param callback: function (path, pixmap) which is called on every new frame of visible animation
+        """
+        if paths:
+            self._subscribers[key] = (set(paths), callback)
+        else:
+            self._subscribers.pop(key, None)
+        self._update_movies()
+
+    def remove(self, key):
+        self.set_animations(key, ())
+
+    def set_paused(self, paused):
+        """
+        :param paused: pause all animations (main window was hidden) or resume visible animations
+        """
+        self._paused = paused
+        self._update_movies()
+
+    def _update_movies(self):
+        needed = set()
+        if not self._paused:
+            for paths, callback in self._subscribers.values():
+                needed.update(paths)
+        for path in needed:
+            movie = self._get_movie(path)
+            if movie.state() == QtGui.QMovie.Paused:
+                movie.setPaused(False)
+            elif movie.state() == QtGui.QMovie.NotRunning:
+                movie.start()
+        for path, movie in self._movies.items():
+            if path not in needed and movie.state() == QtGui.QMovie.Running:
+                movie.setPaused(True)
+
+    def _frame_changed(self, path):
+        pixmap = self._movies[path].currentPixmap()
+        for paths, callback in list(self._subscribers.values()):
+            if path in paths:
+                callback(path, pixmap)
@@ -8,6 +8,7 @@ from profile import Profile
 from toxcore_enums_and_consts import *
 from toxav_enums import *
 from tox import bin_to_string
+from ctypes import string_at
 from plugin_support import PluginLoader
 
 
@@ -69,7 +70,6 @@ def friend_status(tox, friend_num, new_status, user_data):
         sound_notification(SOUND_NOTIFICATION['FRIEND_CONNECTION_STATUS'])
     invoke_in_main_thread(friend.set_status, new_status)
     invoke_in_main_thread(profile.send_files, friend_num)
-    invoke_in_main_thread(profile.update_filtration)
 
 
 def friend_connection_status(tox, friend_num, new_status, user_data):
@@ -81,7 +81,6 @@ def friend_connection_status(tox, friend_num, new_status, user_data):
     friend = profile.get_friend_by_number(friend_num)
     if new_status == TOX_CONNECTION['NONE']:
         invoke_in_main_thread(profile.friend_exit, friend_num)
-        invoke_in_main_thread(profile.update_filtration)
         if Settings.get_instance()['sound_notifications'] and profile.status != TOX_USER_STATUS['BUSY']:
             sound_notification(SOUND_NOTIFICATION['FRIEND_CONNECTION_STATUS'])
     elif friend.status is None:
@@ -149,7 +148,7 @@ def friend_typing(tox, friend_number, typing, user_data):
 
 def friend_read_receipt(tox, friend_number, message_id, user_data):
     profile = Profile.get_instance()
-    profile.get_friend_by_number(friend_number).dec_receipt()
+    invoke_in_main_thread(profile.get_friend_by_number(friend_number).dec_receipt)  # history is used in main thread
     if friend_number == profile.get_active_number():
         invoke_in_main_thread(profile.receipt)
 
@@ -204,7 +203,7 @@ def file_recv_chunk(tox, friend_number, file_number, position, chunk, length, us
                               position,
                               None)
     else:
-        Profile.get_instance().incoming_chunk(friend_number, file_number, position, chunk[:length])
+        Profile.get_instance().incoming_chunk(friend_number, file_number, position, string_at(chunk, length))
 
 
 def file_chunk_request(tox, friend_number, file_number, position, size, user_data):
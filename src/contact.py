@@ -5,29 +5,48 @@ try:
 except ImportError:
     from PyQt4 import QtCore, QtGui
 from toxcore_enums_and_consts import TOX_PUBLIC_KEY_SIZE
+import pixmaps
 
 
 class Contact:
     """
     Class encapsulating TOX contact
     Properties: name (alias of contact or name), status_message, status (connection status)
-    widget - widget for update
+    widget - widget for update. Contacts in friends list have no widgets - they are painted by friends list model
     """
 
     def __init__(self, name, status_message, widget, tox_id):
         """
         :param name: name, example: 'Toxygen user'
         :param status_message: status message, example: 'Toxing on Toxygen'
-        :param widget: ContactItem instance
+        :param widget: widget with labels name, status_message, connection_status, avatar_label or None
         :param tox_id: tox id of contact
         """
         self._name, self._status_message = name, status_message
-        self._status, self._widget = None, widget
-        self._widget.name.setText(name)
-        self._widget.status_message.setText(status_message)
+        self._name_lower = name.lower()
+        self._status, self._widget = None, None
         self._tox_id = tox_id
+        self._avatar_path = self._avatar_digest = None  # resolved on first paint after avatar change
+        if widget is not None:
+            self.set_widget(widget)
+
+    def set_widget(self, widget):
+        """
+        Sets widget and shows current data in it
+        """
+        self._widget = widget
+        self._widget.name.setText(self._name)
+        self._widget.status_message.setText(self._status_message)
+        self._widget.connection_status.update(self._status)
         self.load_avatar()
 
+    def _changed(self, avatar=False):
+        """
+        Called when shown data of contact was changed. Contacts without widget are repainted here
+        :param avatar: avatar was changed
+        """
+        pass
+
     # -----------------------------------------------------------------------------------------------------------------
     # name - current name or alias of user
     # -----------------------------------------------------------------------------------------------------------------
@@ -37,11 +56,19 @@ class Contact:
 
     def set_name(self, value):
         self._name = str(value, 'utf-8')
-        self._widget.name.setText(self._name)
-        self._widget.name.repaint()
+        self._name_lower = self._name.lower()
+        if self._widget is not None:
+            self._widget.name.setText(self._name)
+            self._widget.name.repaint()
+        self._changed()
 
     name = property(get_name, set_name)
 
+    def get_name_lower(self):
+        return self._name_lower
+
+    name_lower = property(get_name_lower)  # lowercase name for search, computed once on change
+
     # -----------------------------------------------------------------------------------------------------------------
     # Status message
     # -----------------------------------------------------------------------------------------------------------------
@@ -51,8 +78,10 @@ class Contact:
 
     def set_status_message(self, value):
         self._status_message = str(value, 'utf-8')
-        self._widget.status_message.setText(self._status_message)
-        self._widget.status_message.repaint()
+        if self._widget is not None:
+            self._widget.status_message.setText(self._status_message)
+            self._widget.status_message.repaint()
+        self._changed()
 
     status_message = property(get_status_message, set_status_message)
 
@@ -65,7 +94,9 @@ class Contact:
 
     def set_status(self, value):
         self._status = value
-        self._widget.connection_status.update(value)
+        if self._widget is not None:
+            self._widget.connection_status.update(value)
+        self._changed()
 
     status = property(get_status, set_status)
 
@@ -82,19 +113,36 @@ class Contact:
     # Avatars
     # -----------------------------------------------------------------------------------------------------------------
 
-    def load_avatar(self):
+    def get_avatar_path(self):
         """
-        Tries to load avatar of contact or uses default avatar
+        :return: path to avatar of contact or to default avatar
         """
-        avatar_path = '{}.png'.format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-        os.chdir(ProfileHelper.get_path() + 'avatars/')
+        avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
         if not os.path.isfile(avatar_path):  # load default image
-            avatar_path = 'avatar.png'
-            os.chdir(curr_directory() + '/images/')
-        pixmap = QtGui.QPixmap(QtCore.QSize(64, 64))
-        pixmap.load(avatar_path)
+            avatar_path = curr_directory() + '/images/avatar.png'
+        return avatar_path
+
+    def _get_avatar_pixmap(self):
+        """
+        :return: avatar of contact or default avatar scaled to 64x64. Same avatar is decoded only once,
+        file is checked only after avatar change
+        """
+        if self._avatar_digest is None:
+            self._avatar_path = self.get_avatar_path()
+            self._avatar_digest = pixmaps.get_file_digest(self._avatar_path)
+        return pixmaps.get_avatar(self._avatar_path, digest=self._avatar_digest)
+
+    def load_avatar(self):
+        """
+        Tries to load avatar of contact or uses default avatar. Called when avatar was changed
+        """
+        pixmaps.forget_file(ProfileHelper.get_path() + 'avatars/{}.png'.format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2]))
+        self._avatar_path = self._avatar_digest = None
+        if self._widget is None:
+            self._changed(True)
+            return
         self._widget.avatar_label.setScaledContents(False)
-        self._widget.avatar_label.setPixmap(pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio))
+        self._widget.avatar_label.setPixmap(self._get_avatar_pixmap())
         self._widget.avatar_label.repaint()
 
     def reset_avatar(self):
@@ -110,4 +158,4 @@ class Contact:
         self.load_avatar()
 
     def get_pixmap(self):
-        return self._widget.avatar_label.pixmap()
+        return self._widget.avatar_label.pixmap() if self._widget is not None else self._get_avatar_pixmap()
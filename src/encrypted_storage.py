@@ -0,0 +1,124 @@
+import os
+import struct
+import hashlib
+from toxencryptsave import TOX_PASS_ENCRYPTION_EXTRA_LENGTH, TOX_PASS_SALT_LENGTH
+
+
+PAGED_FILE_MAGIC = b'toxyPage'
+
+# magic, page size, size of plain data, salt
+PAGED_FILE_HEADER = struct.Struct('<8sIQ{}s'.format(TOX_PASS_SALT_LENGTH))
+
+HEADER_MAC_SIZE = 32  # keyed hash of header after it, size of data can't be changed without key
+
+PAGE_INDEX = struct.Struct('<Q')  # index of page, encrypted before page data, pages can't be swapped
+
+
+class PagedEncryptedFile:
+    """
+    Encrypted copy of plain file. Data is split into pages and every page is encrypted separately with one derived key.
+    On save only changed pages are encrypted and written, unchanged pages are never rewritten.
+    File format: header, MAC of header, then slots of fixed size - one encrypted page with its index per slot
+    """
+
+    PAGE_SIZE = 64 * 1024
+
+    def __init__(self, path, encryption):
+        """
+        :param path: path to encrypted file
+        :param encryption: LibToxEncryptSave instance
+        """
+        self._path = path
+        self._encryption = encryption
+        self._key = None
+        self._page_size = self.PAGE_SIZE
+        self._digests = []  # digests of plain pages which are stored in file
+
+    @staticmethod
+    def is_paged_file(path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as fl:
+            return fl.read(len(PAGED_FILE_MAGIC)) == PAGED_FILE_MAGIC
+
+    @staticmethod
+    def _digest(page):
+        return hashlib.blake2b(page, digest_size=16).digest()
+
+    def _mac(self, header):
+        return hashlib.blake2b(header, digest_size=HEADER_MAC_SIZE, key=self._key[TOX_PASS_SALT_LENGTH:]).digest()
+
+    def _slot_offset(self, index):
+        return PAGED_FILE_HEADER.size + HEADER_MAC_SIZE + \
+            index * (PAGE_INDEX.size + self._page_size + TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+
+    def decrypt_to(self, plain_path):
+        """
+        Decrypts all pages to plain file and remembers digests of pages
+        :raises RuntimeError: if header, index or size of page don't match (file was truncated or changed)
+        """
+        with open(self._path, 'rb') as fin, open(plain_path, 'wb') as fout:
+            header = fin.read(PAGED_FILE_HEADER.size)
+            magic, self._page_size, size, salt = PAGED_FILE_HEADER.unpack(header)
+            self._key = self._encryption.pass_key_derive(salt)
+            if fin.read(HEADER_MAC_SIZE) != self._mac(header):
+                raise RuntimeError('Header of encrypted history is corrupted')
+            self._digests = []
+            while size > 0:
+                length = min(size, self._page_size)
+                data = fin.read(PAGE_INDEX.size + length + TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+                if len(data) != PAGE_INDEX.size + length + TOX_PASS_ENCRYPTION_EXTRA_LENGTH:
+                    raise RuntimeError('Encrypted history is truncated')
+                page = self._encryption.pass_key_decrypt(data, self._key)
+                if len(page) != PAGE_INDEX.size + length or \
+                        PAGE_INDEX.unpack_from(page)[0] != len(self._digests):
+                    raise RuntimeError('Page {} of encrypted history is corrupted'.format(len(self._digests)))
+                page = page[PAGE_INDEX.size:]
+                fout.write(page)
+                self._digests.append(self._digest(page))
+                size -= length
+                fin.seek(self._slot_offset(len(self._digests)))
+
+    def encrypt_from(self, plain_path):
+        """
+        Encrypts pages of plain file which differ from pages stored in encrypted file
+        :return: number of written pages
+        """
+        if self._key is not None and self._key != self._encryption.pass_key_derive(self._key[:TOX_PASS_SALT_LENGTH]):
+            self._key = None  # password was changed
+        if self._key is None or not self.is_paged_file(self._path):  # write all pages with new key
+            self._key = self._encryption.pass_key_derive()
+            self._page_size = self.PAGE_SIZE
+            self._digests = []
+            with open(self._path, 'wb'):
+                pass
+        written = size = 0
+        with open(plain_path, 'rb') as fin, open(self._path, 'r+b') as fout:
+            index = 0
+            page = fin.read(self._page_size)
+            while page:
+                digest = self._digest(page)
+                if index >= len(self._digests) or self._digests[index] != digest:
+                    fout.seek(self._slot_offset(index))
+                    fout.write(self._encryption.pass_key_encrypt(PAGE_INDEX.pack(index) + page, self._key))
+                    if index < len(self._digests):
+                        self._digests[index] = digest
+                    else:
+                        self._digests.append(digest)
+                    written += 1
+                size += len(page)
+                index += 1
+                page = fin.read(self._page_size)
+            del self._digests[index:]
+            if index:  # remove slots of pages which were cut off
+                last_page_size = size - (index - 1) * self._page_size
+                fout.truncate(self._slot_offset(index - 1) + PAGE_INDEX.size + last_page_size +
+                              TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+            else:
+                fout.truncate(self._slot_offset(0))
+            header = PAGED_FILE_HEADER.pack(PAGED_FILE_MAGIC, self._page_size, size, self._key[:TOX_PASS_SALT_LENGTH])
+            fout.seek(0)
+            fout.write(header + self._mac(header))
+            fout.flush()
+            os.fsync(fout.fileno())
+        return written
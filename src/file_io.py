@@ -0,0 +1,391 @@
+from bisect import bisect_left, bisect_right
+from collections import deque
+import mmap
+import os
+import threading
+import time
+from util import Singleton, log
+
+
+WORKERS_COUNT = 4  # threads for disk operations of all file transfers
+
+TASKS_PER_TURN = 16  # worker serves other transfers after this number of operations of one transfer
+
+MAX_WRITE_SIZE = 1024 * 1024  # contiguous chunks are coalesced into writes of this size
+
+MAX_PENDING_WRITES = 32 * 1024 * 1024  # bytes of one transfer waiting for disk, tox thread waits if there are more
+
+
+class FileIOQueue:
+    """
+    Ordered queue of disk operations of one file transfer. Operations of one queue are executed one by one,
+    operations of different queues - in parallel by workers of FileIOPool.
+    Writes are queued without waiting (write-behind), contiguous writes are coalesced into one
+    """
+
+    def __init__(self, pool, fl):
+        """
+        :param pool: FileIOPool instance
+        :param fl: file opened in binary mode. All writes and closing must be done through queue
+        """
+        self.pool = pool
+        self._file = fl
+        self._condition = pool.condition
+        self._tasks = deque()  # lists [function, args] or ['write', position, bytearray]
+        self._active = False  # queue is waiting for worker or is served now
+        self._pending = 0  # bytes queued for writing
+        self._read_lock = threading.Lock()  # for positional reads without os.pread
+        self.closed = False
+        self.error = None  # last exception of disk operation
+
+    def put(self, function, *args):
+        """
+        Queues operation. It will be executed in worker thread after all previously queued operations
+        """
+        with self._condition:
+            self._tasks.append([function, args])
+            self._schedule()
+
+    def write(self, position, data):
+        """
+        Queues writing of data at position. Tox thread waits only if too much data is waiting for slow disk
+        """
+        with self._condition:
+            if self.closed:
+                return
+            while self._pending > MAX_PENDING_WRITES and self._active and self.pool.is_running():
+                self._condition.wait()
+            self._pending += len(data)
+            last = self._tasks[-1] if self._tasks else None
+            if last is not None and last[0] == 'write' and last[1] + len(last[2]) == position and \
+                    len(last[2]) < MAX_WRITE_SIZE:
+                last[2] += data  # contiguous chunk
+                self.pool.metrics['coalesced_writes'] += 1
+            else:
+                self._tasks.append(['write', position, bytearray(data)])
+                self._schedule()
+
+    def read(self, position, size):
+        """
+        Positional read, can be called from any thread at the same time with queued operations
+        :return: bytes
+        """
+        if hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), size, position)
+        with self._read_lock:
+            self._file.seek(position)
+            return self._file.read(size)
+
+    def get_size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def map(self):
+        """
+        :return: read-only memory map of file or None if file can't be mapped (empty or too big for address space)
+        """
+        try:
+            return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, OverflowError):
+            return None
+
+    def flush(self):
+        """
+        Blocks until all queued operations are done
+        """
+        with self._condition:
+            while self._active and self.pool.is_running():
+                self._condition.wait()
+
+    def close(self):
+        """
+        Writes queued data and closes file. Blocks until file is closed
+        """
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+        self.put(self._file.close)
+        self.flush()
+        if not self._file.closed:  # pool was stopped
+            self._file.close()
+
+    def _schedule(self):
+        if not self._active:
+            self._active = True
+            self.pool.schedule(self)
+
+    def _write(self, position, data):
+        if hasattr(os, 'pwrite'):  # positional write without seek
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self._file.fileno(), view, position)
+                view, position = view[written:], position + written
+        else:
+            self._file.seek(position)
+            self._file.write(data)
+
+    def serve(self):
+        """
+        Executes queued operations in worker thread
+        """
+        for _ in range(TASKS_PER_TURN):
+            with self._condition:
+                if not self._tasks:
+                    self._active = False
+                    self._condition.notify_all()
+                    return
+                task = self._tasks.popleft()
+            try:
+                if task[0] == 'write':
+                    self._write(task[1], task[2])
+                else:
+                    task[0](*task[1])
+            except Exception as ex:
+                self.error = ex
+                log('File I/O error: ' + str(ex))
+            if task[0] == 'write':
+                with self._condition:
+                    self._pending -= len(task[2])
+                    self._condition.notify_all()
+        with self._condition:
+            self.pool.schedule(self)  # other transfers are served before rest of this queue
+
+
+class IntervalSet:
+    """
+    Set of received ranges of file. Ranges are half-open [start, end), adjacent ranges are merged
+    """
+
+    def __init__(self, intervals=()):
+        """
+        :param intervals: iterable of (start, end) pairs, for example saved list of previous transfer
+        """
+        self._starts, self._ends = [], []  # sorted, ranges don't overlap and don't touch
+        self.size = 0  # total length of ranges
+        for start, end in intervals:
+            self.add(start, end)
+
+    def add(self, start, end):
+        """
+        :return: number of bytes which were not in set before
+        """
+        if start >= end:
+            return 0
+        starts, ends = self._starts, self._ends
+        if ends and ends[-1] == start:  # chunk after last range - usual case
+            ends[-1] = end
+            self.size += end - start
+            return end - start
+        i = bisect_left(ends, start)  # first range which ends at or after start
+        j = bisect_right(starts, end)  # ranges before j start at or before end
+        if i == j:  # no intersections
+            starts.insert(i, start)
+            ends.insert(i, end)
+            self.size += end - start
+            return end - start
+        old = sum(ends[k] - starts[k] for k in range(i, j))
+        new_start, new_end = min(start, starts[i]), max(end, ends[j - 1])
+        starts[i:j] = [new_start]
+        ends[i:j] = [new_end]
+        added = new_end - new_start - old
+        self.size += added
+        return added
+
+    def contains(self, start, end):
+        """
+        :return: True if whole range [start, end) is in set
+        """
+        i = bisect_right(self._starts, start) - 1
+        return i >= 0 and self._ends[i] >= end
+
+    def is_complete(self, size):
+        return self.contains(0, size) if size else True
+
+    def gaps(self, size):
+        """
+        :return: list of (start, end) ranges in [0, size) which are not in set
+        """
+        result, position = [], 0
+        for start, end in zip(self._starts, self._ends):
+            if start > position:
+                result.append((position, min(start, size)))
+            position = max(position, end)
+            if position >= size:
+                break
+        if position < size:
+            result.append((position, size))
+        return result
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class FileIOPool(Singleton):
+    """
+    Thread pool for disk I/O of file transfers. Tox iterate thread only queues operations and never waits for disk
+    (except read-ahead misses and write-behind overflow)
+    """
+
+    def __init__(self, workers_count=WORKERS_COUNT):
+        super().__init__()
+        self.condition = threading.Condition()
+        self._ready = deque()  # queues waiting for worker
+        self._stopped = False
+        self.metrics = {
+            'coalesced_writes': 0,
+            'read_ahead_hits': 0,
+            'read_ahead_misses': 0,
+            'max_miss_latency': 0.
+        }
+        self._workers = [threading.Thread(target=self._work, name='FileIO-{}'.format(i), daemon=True)
+                         for i in range(workers_count)]
+        for worker in self._workers:
+            worker.start()
+
+    def create_queue(self, fl):
+        """
+        :param fl: file of transfer
+        :return: FileIOQueue for file
+        """
+        return FileIOQueue(self, fl)
+
+    def schedule(self, queue):
+        """
+        Queue has new operations. Must be called with condition acquired
+        """
+        self._ready.append(queue)
+        self.condition.notify_all()
+
+    def is_running(self):
+        return not self._stopped
+
+    def add_miss(self, latency):
+        """
+        Read-ahead miss: data was read in tox thread
+        :param latency: time of read in seconds
+        """
+        with self.condition:
+            self.metrics['read_ahead_misses'] += 1
+            self.metrics['max_miss_latency'] = max(self.metrics['max_miss_latency'], latency)
+
+    def get_metrics(self):
+        with self.condition:
+            return dict(self.metrics)
+
+    def stop(self):
+        """
+        Executes all queued operations and stops workers
+        """
+        with self.condition:
+            self._stopped = True
+            self.condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self._ready and not self._stopped:
+                    self.condition.wait()
+                if not self._ready:
+                    return
+                queue = self._ready.popleft()
+            queue.serve()
+
+
+class ReadAhead:
+    """
+    Sliding read-ahead window of outgoing transfer. Workers read blocks of file before toxcore requests chunks of them,
+    tox thread takes chunks from memory. Blocks before requested chunk are kept for re-requests after packet loss.
+    File is memory mapped if possible: workers only load pages of window and chunks are sliced from map
+    """
+
+    BLOCK_SIZE = 256 * 1024
+    WINDOW_SIZE = 8 * 1024 * 1024  # bytes after requested chunk which are read in advance
+    BEHIND_SIZE = 1024 * 1024  # bytes before requested chunk which are kept in memory
+
+    def __init__(self, queue, use_mmap=True):
+        """
+        :param queue: FileIOQueue of transfer
+        :param use_mmap: try to map file into memory
+        """
+        self._queue = queue
+        self._metrics = queue.pool.metrics
+        self._size = queue.get_size()
+        self._map = queue.map() if use_mmap else None
+        self._lock = threading.Lock()  # guards blocks: tox thread evicts them while workers read them
+        self._blocks = {}  # number of block -> bytes, only if file is not mapped
+        self._loaded = set()  # blocks which are read by workers
+        self._requested = set()  # blocks which are queued or read
+        self._current = None  # block of last requested chunk
+        self._closed = False
+
+    def read(self, position, size):
+        """
+        Called in tox thread for every requested chunk
+        :return: data of chunk
+        """
+        if self._closed:
+            return b''
+        number = position // self.BLOCK_SIZE
+        end = min(position + size, self._size)
+        last = (end - 1) // self.BLOCK_SIZE  # chunk can cross end of block
+        with self._lock:
+            hit = number in self._loaded and (last == number or last in self._loaded)
+            if hit and self._map is None:
+                offset = position - number * self.BLOCK_SIZE
+                data = self._blocks[number][offset:offset + size]
+                if last != number:
+                    data += self._blocks[last][:end - last * self.BLOCK_SIZE]
+        if hit:
+            if self._map is not None:
+                data = self._map[position:end]
+            self._metrics['read_ahead_hits'] += 1
+        else:  # block is not read yet
+            t = time.perf_counter()
+            data = self._map[position:end] if self._map is not None else self._queue.read(position, size)
+            self._queue.pool.add_miss(time.perf_counter() - t)
+        if number != self._current:
+            self._current = number
+            self._read_next(number)
+        return data
+
+    def close(self):
+        """
+        Stops reading. Map is closed after queued reads
+        """
+        self._closed = True
+        if self._map is not None:
+            self._queue.put(self._map.close)
+
+    def _read_next(self, number):
+        first = number - self.BEHIND_SIZE // self.BLOCK_SIZE
+        last = min(number + self.WINDOW_SIZE // self.BLOCK_SIZE, (self._size - 1) // self.BLOCK_SIZE)
+        with self._lock:
+            for old in [n for n in self._requested if n < first]:
+                self._requested.discard(old)
+                self._loaded.discard(old)
+                self._blocks.pop(old, None)
+            new = [n for n in range(number, last + 1) if n not in self._requested]
+            self._requested.update(new)
+        for n in new:
+            self._queue.put(self._read_block, n)
+
+    def _read_block(self, number):
+        with self._lock:
+            if self._closed or number not in self._requested:
+                return
+        start = number * self.BLOCK_SIZE
+        if self._map is not None:  # pages are loaded into page cache, one byte of every page is touched
+            self._map[start:start + self.BLOCK_SIZE:mmap.PAGESIZE]
+            data = None
+        else:
+            data = self._queue.read(start, self.BLOCK_SIZE)
+        with self._lock:
+            if number in self._requested:  # block wasn't evicted while it was read
+                if data is not None:
+                    self._blocks[number] = data
+                self._loaded.add(number)
@@ -1,16 +1,16 @@
 from toxcore_enums_and_consts import TOX_FILE_KIND, TOX_FILE_CONTROL
 from os.path import basename, getsize, exists, dirname
 from os import remove, rename, chdir
-from time import time, sleep
+from time import time
+from math import exp
 from tox import Tox
 import settings
+from file_io import FileIOPool, ReadAhead, IntervalSet
 try:
     from PySide import QtCore
 except ImportError:
     from PyQt4 import QtCore
 
-# TODO: threads!
-
 
 TOX_FILE_TRANSFER_STATE = {
     'RUNNING': 0,
@@ -32,6 +32,10 @@ SHOW_PROGRESS_BAR = (0, 1, 4)
 
 ALLOWED_FILES = ('toxygen_inline.png', 'utox-inline.png', 'sticker.png')
 
+STREAMING_SIZE = 2 ** 64 - 1  # UINT64_MAX, size of streaming transfer of unknown size
+
+PAUSED_TRANSFER_LIFETIME = 30 * 24 * 60 * 60  # seconds, older suspended transfers are forgotten
+
 
 class StateSignal(QtCore.QObject):
     try:
@@ -45,6 +49,9 @@ class FileTransfer(QtCore.QObject):
     Superclass for file transfers
     """
 
+    SIGNAL_INTERVAL = 0.1  # progress is signalled at most 10 times per second, state changes - at once
+    SPEED_PERIOD = 3.0  # seconds, time constant of moving average of speed
+
     def __init__(self, path, tox, friend_number, size, file_number=None):
         QtCore.QObject.__init__(self)
         self._path = path
@@ -52,10 +59,14 @@ class FileTransfer(QtCore.QObject):
         self._friend_number = friend_number
         self.state = TOX_FILE_TRANSFER_STATE['RUNNING']
         self._file_number = file_number
+        self._file_id = None
         self._creation_time = None
         self._size = float(size)
         self._done = 0
         self._state_changed = StateSignal()
+        self._signalled_state = None
+        self._signal_time, self._signal_done = 0, 0  # time and progress of last signal
+        self._speed = None  # bytes per second, moving average
 
     def set_tox(self, tox):
         self._tox = tox
@@ -64,12 +75,42 @@ class FileTransfer(QtCore.QObject):
         self._state_changed.signal.connect(handler)
 
     def signal(self):
+        """
+        Signals state, progress and ETA of transfer. It's called for every chunk, but progress is signalled
+        only once in SIGNAL_INTERVAL
+        """
+        now = time()
+        if self.state == self._signalled_state and now - self._signal_time < self.SIGNAL_INTERVAL:
+            return
+        self._update_speed(now)
+        self._signalled_state = self.state
         percentage = self._done / self._size if self._size else 0
-        if self._creation_time is None or not percentage:
-            t = -1
-        else:
-            t = ((time() - self._creation_time) / percentage) * (1 - percentage)
-        self._state_changed.signal.emit(self.state, percentage, int(t))
+        self._state_changed.signal.emit(self.state, percentage, self.get_eta())
+
+    def _update_speed(self, now):
+        if self._creation_time is not None and self._signal_time >= self._creation_time:
+            dt = now - self._signal_time
+            if dt > 0:
+                speed = (self._done - self._signal_done) / dt
+                if self._speed is None:
+                    self._speed = speed
+                else:  # exponential moving average, weight of sample depends on its duration
+                    self._speed += (speed - self._speed) * (1 - exp(-dt / self.SPEED_PERIOD))
+        self._signal_time, self._signal_done = now, self._done
+
+    def get_speed(self):
+        """
+        :return: moving average of speed in bytes per second or None if it's unknown
+        """
+        return self._speed
+
+    def get_eta(self):
+        """
+        :return: estimated time to end of transfer in seconds or -1 if it's unknown
+        """
+        if not self._speed:
+            return -1
+        return int(max(self._size - self._done, 0) / self._speed)
 
     def get_file_number(self):
         return self._file_number
@@ -77,16 +118,26 @@ class FileTransfer(QtCore.QObject):
     def get_friend_number(self):
         return self._friend_number
 
+    def _close_file(self):
+        """
+        Finishes queued disk operations and closes file
+        """
+        if hasattr(self, '_io'):
+            self._io.close()
+
+    def get_error(self):
+        """
+        :return: last exception of disk operation or None
+        """
+        return self._io.error if hasattr(self, '_io') else None
+
     def cancel(self):
         self.send_control(TOX_FILE_CONTROL['CANCEL'])
-        if hasattr(self, '_file'):
-            self._file.close()
+        self._close_file()
         self.signal()
 
     def cancelled(self):
-        if hasattr(self, '_file'):
-            sleep(0.1)
-            self._file.close()
+        self._close_file()
         self.state = TOX_FILE_TRANSFER_STATE['CANCELLED']
         self.signal()
 
@@ -103,7 +154,26 @@ class FileTransfer(QtCore.QObject):
             self.signal()
 
     def get_file_id(self):
-        return self._tox.file_get_file_id(self._friend_number, self._file_number)
+        """
+        :return: file id (hex string). It's kept after transfer is purged from core
+        """
+        if self._file_id is None:
+            self._file_id = self._tox.file_get_file_id(self._friend_number, self._file_number)
+        return self._file_id
+
+    def get_path(self):
+        return self._path
+
+    def get_size(self):
+        return int(self._size)
+
+    def suspend(self):
+        """
+        Friend went offline or tox was restarted. File is closed, transfer can be resumed later by new transfer
+        """
+        self._close_file()
+        self.state = TOX_FILE_TRANSFER_STATE['PAUSED_BY_FRIEND']
+        self.signal()
 
 # -----------------------------------------------------------------------------------------------------------------
 # Send file
@@ -111,17 +181,26 @@ class FileTransfer(QtCore.QObject):
 
 
 class SendTransfer(FileTransfer):
+    """
+    Send file. File is read in advance by I/O workers, chunks are taken from memory in tox thread
+    """
 
     def __init__(self, path, tox, friend_number, kind=TOX_FILE_KIND['DATA'], file_id=None):
+        size = getsize(path) if path is not None else 0
+        super(SendTransfer, self).__init__(path, tox, friend_number, size)
         if path is not None:
             self._file = open(path, 'rb')
-            size = getsize(path)
-        else:
-            size = 0
-        super(SendTransfer, self).__init__(path, tox, friend_number, size)
+            self._io = FileIOPool.get_instance().create_queue(self._file)
+            self._read_ahead = ReadAhead(self._io)
         self.state = TOX_FILE_TRANSFER_STATE['OUTGOING_NOT_STARTED']
         self._file_number = tox.file_send(friend_number, kind, size, file_id,
                                           bytes(basename(path), 'utf-8') if path else b'')
+        self._file_id = file_id
+
+    def _close_file(self):
+        if hasattr(self, '_read_ahead'):
+            self._read_ahead.close()
+        super(SendTransfer, self)._close_file()
 
     def send_chunk(self, position, size):
         """
@@ -131,15 +210,14 @@ class SendTransfer(FileTransfer):
         """
         if self._creation_time is None:
             self._creation_time = time()
+            self._done = position  # resumed transfer starts after data received by friend before
         if size:
-            self._file.seek(position)
-            data = self._file.read(size)
+            data = self._read_ahead.read(position, size)
             self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
             self._done += size
             self.signal()
         else:
-            if hasattr(self, '_file'):
-                self._file.close()
+            self._close_file()
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self.signal()
 
@@ -203,17 +281,54 @@ class SendFromFileBuffer(SendTransfer):
 
 
 class ReceiveTransfer(FileTransfer):
+    """
+    Receive file. Chunks are written to disk by I/O workers with positional writes, tox thread doesn't wait for disk.
+    File is created sparse with final size, so chunks after gaps don't need padding
+    """
 
-    def __init__(self, path, tox, friend_number, size, file_number):
+    def __init__(self, path, tox, friend_number, size, file_number, received=None):
+        """
+        :param received: IntervalSet of ranges received by previous transfer of same file or None for new file
+        """
         super(ReceiveTransfer, self).__init__(path, tox, friend_number, size, file_number)
-        self._file = open(self._path, 'wb')
-        self._file.truncate(0)
-        self._file_size = 0
+        self._file = open(self._path, 'wb' if received is None else 'r+b')
+        self._io = FileIOPool.get_instance().create_queue(self._file)
+        self._streaming = size == STREAMING_SIZE
+        if size and not self._streaming:
+            self._io.put(self._file.truncate, int(size))
+        self._received = received if received is not None else IntervalSet()  # ranges of file which were written
+        self._done = self._received.size
 
     def cancel(self):
         super(ReceiveTransfer, self).cancel()
         remove(self._path)
 
+    def get_received(self):
+        """
+        :return: IntervalSet of received ranges. Ranges are added when chunks are queued for writing, they are
+        written to disk only if file was closed and get_error() returns None
+        """
+        return self._received
+
+    def _get_known_size(self):
+        """
+        :return: size of file or end of received data if size is unknown (streaming)
+        """
+        if self._streaming:
+            return max((end for start, end in self._received), default=0)
+        return int(self._size)
+
+    def is_complete(self):
+        return self._received.is_complete(self._get_known_size())
+
+    def get_resume_position(self):
+        """
+        :return: position from which friend should send file again. Last byte is sent again if file is complete
+        """
+        size = self._get_known_size()
+        gaps = self._received.gaps(size)
+        return gaps[0][0] if gaps else max(size - 1, 0)
+
     def write_chunk(self, position, data):
         """
         Incoming chunk
@@ -223,49 +338,50 @@ class ReceiveTransfer(FileTransfer):
         if self._creation_time is None:
             self._creation_time = time()
         if data is None:
-            self._file.close()
-            self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
+            self._close_file()
+            if self.get_error() is None and self.is_complete():
+                self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
+            else:  # disk error or friend finished transfer before sending all chunks
+                remove(self._path)
+                self.state = TOX_FILE_TRANSFER_STATE['CANCELLED']
             self.signal()
         else:
-            data = bytearray(data)
-            if self._file_size < position:
-                self._file.seek(0, 2)
-                self._file.write(b'\0' * (position - self._file_size))
-            self._file.seek(position)
-            self._file.write(data)
-            l = len(data)
-            if position + l > self._file_size:
-                self._file_size = position + l
-            self._done += l
+            self._io.write(position, data)
+            self._done += self._received.add(position, position + len(data))  # repeated chunks are not counted
             self.signal()
 
 
 class ReceiveToBuffer(FileTransfer):
     """
-    Inline image - save in buffer not in file system
+    Inline image - save in buffer not in file system. Buffer is allocated once for advertised size and filled in place
     """
 
     def __init__(self, tox, friend_number, size, file_number):
         super(ReceiveToBuffer, self).__init__(None, tox, friend_number, size, file_number)
-        self._data = bytes()
+        self._data = bytearray(int(size))
         self._data_size = 0
 
     def get_data(self):
+        """
+        :return: received data (bytearray, not copied)
+        """
         return self._data
 
     def write_chunk(self, position, data):
         if self._creation_time is None:
             self._creation_time = time()
         if data is None:
+            if self._data_size < len(self._data):  # friend sent less than advertised
+                del self._data[self._data_size:]
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
         else:
-            data = bytes(data)
             l = len(data)
-            if self._data_size < position:
-                self._data += (b'\0' * (position - self._data_size))
-            self._data = self._data[:position] + data + self._data[position + l:]
-            if position + l > self._data_size:
-                self._data_size = position + l
+            end = position + l
+            if end > len(self._data):  # friend sent more than advertised
+                self._data.extend(bytes(end - len(self._data)))
+            self._data[position:end] = data
+            if end > self._data_size:
+                self._data_size = end
             self._done += l
         self.signal()
 
@@ -281,14 +397,13 @@ class ReceiveAvatar(ReceiveTransfer):
         super(ReceiveAvatar, self).__init__(path + '.tmp', tox, friend_number, size, file_number)
         if size > self.MAX_AVATAR_SIZE:
             self.send_control(TOX_FILE_CONTROL['CANCEL'])
-            self._file.close()
+            self._close_file()
             remove(path + '.tmp')
         elif not size:
             self.send_control(TOX_FILE_CONTROL['CANCEL'])
-            self._file.close()
+            self._close_file()
             if exists(path):
                 remove(path)
-            self._file.close()
             remove(path + '.tmp')
         elif exists(path):
             hash = self.get_file_id()
@@ -297,7 +412,7 @@ class ReceiveAvatar(ReceiveTransfer):
             existing_hash = Tox.hash(data)
             if hash == existing_hash:
                 self.send_control(TOX_FILE_CONTROL['CANCEL'])
-                self._file.close()
+                self._close_file()
                 remove(path + '.tmp')
             else:
                 self.send_control(TOX_FILE_CONTROL['RESUME'])
@@ -306,7 +421,7 @@ class ReceiveAvatar(ReceiveTransfer):
 
     def write_chunk(self, position, data):
         super(ReceiveAvatar, self).write_chunk(position, data)
-        if self.state:
+        if self.state == TOX_FILE_TRANSFER_STATE['FINISHED']:
             avatar_path = self._path[:-4]
             if exists(avatar_path):
                 chdir(dirname(avatar_path))
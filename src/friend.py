@@ -1,6 +1,9 @@
 import contact
 from messages import *
 from history import *
+from bisect import bisect_right, insort
+from collections import deque, OrderedDict
+from itertools import islice
 import util
 import file_transfers as ft
 
@@ -15,17 +18,34 @@ class Friend(contact.Contact):
         :param message_getter: gets messages from db
         :param number: number of friend.
         """
-        super(Friend, self).__init__(*args)
         self._number = number
         self._new_messages = False
         self._visible = True
         self._alias = False
         self._message_getter = message_getter
-        self._corr = []
-        self._unsaved_messages = 0
+        self._corr = deque()  # window of conversation in memory, old saved messages are evicted if it grows
+        self._corr_limit = None  # max size of window, None - unlimited
+        self._corr_trim_size = 0  # window is trimmed when it becomes larger
+        # positions in window: messages are numbered from old to new, deleted messages stay in window as tombstones
+        # until compaction, inline images are attached to transfer messages
+        self._seqs = {}  # message in window -> sequence number
+        self._first_seq = self._next_seq = 0
+        self._deleted = set()  # tombstones
+        self._deleted_seqs = []  # sorted sequence numbers of tombstones
+        self._inlines = {}  # transfer message -> inline image shown before it
+        self._inline_seqs = []  # sorted sequence numbers of transfer messages with inline images
+        # indexes of window
+        self._messages_by_time = {}  # unix time -> text message
+        self._unsent = deque()  # not sent text messages from old to new
+        self._unsaved = OrderedDict()  # unix time -> text message which is not saved in db yet
+        self._transfers = {}  # file number -> message about active file transfer
+        self._unsent_files = OrderedDict()  # unix time -> file which will be sent when friend is online
+        self._last_own_message = None  # newest text message sent by user
         self._history_loaded = self._new_actions = False
         self._receipts = 0
         self._curr_text = ''
+        self._model = None  # friends list model which shows friend
+        super(Friend, self).__init__(*args)
 
     def __del__(self):
         self.set_visibility(False)
@@ -56,66 +76,239 @@ class Friend(contact.Contact):
         """
         if (first_time and self._history_loaded) or (not hasattr(self, '_message_getter')):
             return
-        data = list(self._message_getter.get(PAGE_SIZE))
-        if data is not None and len(data):
-            data.reverse()
-        else:
+        # next page starts before oldest text message in memory: newer messages are loaded or not saved yet
+        before_time = next((m.get_time() for m in self._iter_corr() if m.get_type() <= 1), None)
+        data = self._message_getter.get(PAGE_SIZE, before_time)  # from new to old
+        if not data:
             return
-        data = list(map(lambda tupl: TextMessage(*tupl), data))
-        self._corr = data + self._corr
+        self._prepend_messages(data)
         self._history_loaded = True
 
+    def load_corr_around(self, unix_time):
+        """
+        Loads message with given time, all messages between it and loaded messages and one page of older messages
+        """
+        if not hasattr(self, '_message_getter'):
+            return
+        before_time = next((m.get_time() for m in self._iter_corr() if m.get_type() <= 1), None)
+        if before_time is not None and before_time <= unix_time:  # already loaded
+            return
+        self._prepend_messages(self._message_getter.get_around(unix_time, PAGE_SIZE // 2, before_time))
+        self._history_loaded = True
+
+    def _prepend_messages(self, data):
+        """
+        Adds messages loaded from db to the beginning of window
+        :param data: list of tuples (message, owner, unix_time, message_type) ordered from new to old
+        """
+        for message in TextMessage.from_db(data):
+            self._first_seq -= 1
+            self._seqs[message] = self._first_seq
+            self._corr.appendleft(message)
+            self._messages_by_time[message.get_time()] = message
+            if message.get_owner() == MESSAGE_OWNER['NOT_SENT']:
+                self._unsent.appendleft(message)
+            if self._last_own_message is None and message.get_owner() != MESSAGE_OWNER['FRIEND']:
+                self._last_own_message = message
+
+    def _set_corr(self, messages):
+        """
+        Replaces window and builds all indexes from scratch
+        :param messages: iterable of messages from old to new without inline images
+        """
+        self._corr = deque(messages)
+        self._deleted = set()
+        self._compact()
+        self._messages_by_time = {m.get_time(): m for m in self._corr if m.get_type() <= 1}
+        self._unsent = deque(m for m in self._corr if m.get_type() <= 1 and
+                             m.get_owner() == MESSAGE_OWNER['NOT_SENT'])
+        self._transfers = {m.get_file_number(): m for m in self._corr if type(m) is TransferMessage and
+                           m.get_status() not in (2, 3)}
+        self._unsent_files = OrderedDict((m.get_time(), m) for m in self._corr if type(m) is UnsentFile)
+        self._last_own_message = next((m for m in reversed(self._corr) if m.get_type() <= 1 and
+                                       m.get_owner() != MESSAGE_OWNER['FRIEND']), None)
+
+    def _compact(self):
+        """
+        Removes tombstones from window and numbers messages again
+        """
+        if self._deleted:
+            self._corr = deque(m for m in self._corr if m not in self._deleted)
+            self._deleted = set()
+        self._seqs = dict((m, i) for i, m in enumerate(self._corr))
+        self._first_seq, self._next_seq = 0, len(self._corr)
+        self._deleted_seqs = []
+        self._inlines = dict((m, inline) for m, inline in self._inlines.items() if m in self._seqs)
+        self._inline_seqs = sorted(self._seqs[m] for m in self._inlines)
+
+    def _iter_corr(self, reverse=False):
+        """
+        :return: iterator over window from old to new (or from new to old) without tombstones, with inline images
+        """
+        messages = reversed(self._corr) if reverse else iter(self._corr)
+        if not self._deleted and not self._inlines:
+            return messages
+        return self._expand(messages, reverse)
+
+    def _expand(self, messages, reverse):
+        deleted, inlines = self._deleted, self._inlines
+        for message in messages:
+            if message in deleted:
+                continue
+            inline = inlines.get(message)
+            if inline is None:
+                yield message
+            elif reverse:
+                yield message
+                yield inline
+            else:
+                yield inline
+                yield message
+
+    def _count_after(self, message):
+        """
+        :return: number of messages (with inline images) after message in window. O(log) of tombstones and inlines
+        """
+        seq = self._seqs[message]
+        deleted = len(self._deleted_seqs) - bisect_right(self._deleted_seqs, seq)
+        inlines = len(self._inline_seqs) - bisect_right(self._inline_seqs, seq)
+        return self._next_seq - 1 - seq - deleted + inlines
+
+    def _delete(self, message):
+        """
+        Message stays in window as tombstone, tombstones are removed when they are half of window
+        """
+        self._deleted.add(message)
+        insort(self._deleted_seqs, self._seqs[message])
+        if len(self._deleted) > max(PAGE_SIZE, len(self._corr) // 2):
+            self._compact()
+
     def get_corr_for_saving(self):
         """
         Get data to save in db
         :return: list of unsaved messages or []
         """
-        messages = list(filter(lambda x: x.get_type() <= 1, self._corr))
-        return list(map(lambda x: x.get_data(), messages[-self._unsaved_messages:])) if self._unsaved_messages else []
+        return [m.get_data() for m in self._unsaved.values()]
 
     def get_corr(self):
-        return self._corr[:]
+        return list(self._iter_corr())
+
+    def get_last_corr(self, count, skip=0):
+        """
+        :param count: max number of messages
+        :param skip: number of newest messages which are skipped
+        :return: list of messages from old to new
+        """
+        messages = list(islice(self._iter_corr(True), skip, skip + count))
+        messages.reverse()
+        return messages
+
+    def set_corr_limit(self, limit):
+        """
+        Sets max number of messages in memory. Old messages are evicted if window is larger
+        :param limit: max size of window or None if size is not limited (active friend)
+        """
+        self._corr_limit = limit
+        if limit is not None:
+            self._corr_trim_size = limit
+            self.trim_corr()
+
+    def trim_corr(self):
+        """
+        Evicts oldest messages until window fits limit. Text messages are evicted only if they are saved in db and
+        sent, they are loaded again on scrolling. Evicted text messages are always older than text messages in memory.
+        Active and unsent file transfers are kept
+        """
+        if self._corr_limit is None or len(self._corr) <= self._corr_trim_size:
+            return
+        excess = len(self._corr) - self._corr_limit
+        kept = []
+        texts_kept = False
+        while excess and self._corr:
+            message = self._corr.popleft()
+            seq = self._seqs.pop(message)
+            if message in self._deleted:
+                self._deleted.discard(message)
+                del self._deleted_seqs[bisect_right(self._deleted_seqs, seq) - 1]
+                excess -= 1
+            elif message.get_type() <= 1:
+                if texts_kept or message.get_time() in self._unsaved or \
+                        message.get_owner() == MESSAGE_OWNER['NOT_SENT']:
+                    kept.append(message)
+                    texts_kept = True  # newer text messages must stay in memory too
+                else:
+                    excess -= 1
+                    del self._messages_by_time[message.get_time()]
+            elif message.get_type() == MESSAGE_TYPE['FILE_TRANSFER'] and \
+                    (message.get_status() is None or message.get_status() in ft.ACTIVE_FILE_TRANSFERS):
+                kept.append(message)
+            else:  # info messages and inlines are not saved
+                excess -= 1
+                if self._inlines.pop(message, None) is not None:
+                    del self._inline_seqs[bisect_right(self._inline_seqs, seq) - 1]
+        # kept messages get numbers right before first message left in window
+        self._first_seq = self._seqs[self._corr[0]] if self._corr else self._next_seq
+        for message in reversed(kept):
+            self._first_seq -= 1
+            self._seqs[message] = self._first_seq
+            self._corr.appendleft(message)
+        # messages which can't be evicted don't cause trimming on every new message
+        self._corr_trim_size = max(self._corr_limit, len(self._corr)) + PAGE_SIZE
 
     def append_message(self, message):
         """
         :param message: text or file transfer message
         """
+        self._seqs[message] = self._next_seq
+        self._next_seq += 1
         self._corr.append(message)
         if message.get_type() <= 1:
-            self._unsaved_messages += 1
+            self._messages_by_time[message.get_time()] = message
+            if message.get_owner() == MESSAGE_OWNER['NOT_SENT']:
+                self._unsent.append(message)
+            if message.get_owner() != MESSAGE_OWNER['FRIEND']:
+                self._last_own_message = message
+            self._unsaved[message.get_time()] = message
+            unsaved = (m.get_data() for m in self._unsaved.values())  # built only if messages are queued
+            if hasattr(self, '_message_getter') and self._message_getter.append(unsaved):
+                self._unsaved.clear()  # messages are written in background
+        elif type(message) is TransferMessage:
+            self._transfers[message.get_file_number()] = message
+        elif type(message) is UnsentFile:
+            self._unsent_files[message.get_time()] = message
+        self.trim_corr()
 
     def get_last_message_text(self):
-        messages = list(filter(lambda x: x.get_type() <= 1 and x.get_owner() != MESSAGE_OWNER['FRIEND'], self._corr))
-        if messages:
-            return messages[-1].get_data()[0]
-        else:
-            return ''
+        return self._last_own_message.get_data()[0] if self._last_own_message is not None else ''
 
     def get_unsent_messages(self):
         """
         :return list of unsent messages
         """
-        messages = filter(lambda x: x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr)
-        return list(messages)
+        return list(self._unsent)
 
     def get_unsent_messages_for_saving(self):
         """
         :return list of unsent messages for saving
         """
-        messages = filter(lambda x: x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr)
-        return list(map(lambda x: x.get_data(), messages))
+        return [m.get_data() for m in self._unsent]
 
     def delete_message(self, time):
-        elem = list(filter(lambda x: type(x) is TextMessage and x.get_data()[2] == time, self._corr))[0]
-        tmp = list(filter(lambda x: x.get_type() <= 1, self._corr))
-        if elem in tmp[-self._unsaved_messages:]:
-            self._unsaved_messages -= 1
-        self._corr.remove(elem)
+        elem = self._messages_by_time.pop(time)
+        self._unsaved.pop(time, None)
+        if elem.get_owner() == MESSAGE_OWNER['NOT_SENT']:
+            self._unsent.remove(elem)
+        self._delete(elem)
+        if elem is self._last_own_message:
+            self._last_own_message = next((m for m in self._iter_corr(True) if m.get_type() <= 1 and
+                                           m.get_owner() != MESSAGE_OWNER['FRIEND']), None)
 
     def mark_as_sent(self):
         try:
-            message = list(filter(lambda x: x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr))[0]
+            message = self._unsent.popleft()
             message.mark_as_sent()
+            if hasattr(self, '_message_getter'):
+                self._message_getter.mark_as_sent(message.get_time())
         except Exception as ex:
             util.log('Mark as sent ex: ' + str(ex))
 
@@ -126,15 +319,14 @@ class Friend(contact.Contact):
         if hasattr(self, '_message_getter'):
             del self._message_getter
         # don't delete data about active file transfer
+        messages = (m for m in self._corr if m not in self._deleted)
         if not save_unsent:
-            self._corr = list(filter(lambda x: x.get_type() in (2, 3) and
-                                               x.get_status() in ft.ACTIVE_FILE_TRANSFERS, self._corr))
-            self._unsaved_messages = 0
+            self._set_corr(filter(lambda x: x.get_type() in (2, 3) and
+                                  x.get_status() in ft.ACTIVE_FILE_TRANSFERS, messages))
         else:
-            self._corr = list(filter(lambda x: (x.get_type() in (2, 3) and x.get_status() in ft.ACTIVE_FILE_TRANSFERS)
-                                     or (x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT']),
-                                     self._corr))
-            self._unsaved_messages = len(self.get_unsent_messages())
+            self._set_corr(filter(lambda x: (x.get_type() in (2, 3) and x.get_status() in ft.ACTIVE_FILE_TRANSFERS)
+                                  or (x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT']), messages))
+        self._unsaved = OrderedDict((m.get_time(), m) for m in self._unsent)
 
     def get_curr_text(self):
         return self._curr_text
@@ -152,26 +344,43 @@ class Friend(contact.Contact):
         """
         Update status of active transfer and load inline if needed
         """
-        try:
-            tr = list(filter(lambda x: x.get_type() == MESSAGE_TYPE['FILE_TRANSFER'] and x.is_active(file_number),
-                        self._corr))[0]
-            tr.set_status(status)
-            i = self._corr.index(tr)
-            if inline:  # inline was loaded
-                self._corr.insert(i, inline)
-            return i - len(self._corr)
-        except:
-            pass
+        tr = self._transfers.get(file_number)
+        if tr is None:
+            return
+        tr.set_status(status)
+        if not tr.is_active(file_number):
+            del self._transfers[file_number]
+        after = self._count_after(tr)
+        if inline:  # inline was loaded, it's shown before transfer message
+            self._inlines[tr] = inline
+            insort(self._inline_seqs, self._seqs[tr])
+            return -after - 2  # negative index of inline
+        return -after - 1
+
+    def delete_transfer_message(self, file_number):
+        """
+        Removes message about transfer (suspended transfer which was offered again gets new message)
+        :return: negative index of removed message or None if there is no message about transfer
+        """
+        tr = self._transfers.pop(file_number, None)
+        if tr is None:
+            return None
+        index = -self._count_after(tr) - 1
+        self._delete(tr)
+        return index
 
     def get_unsent_files(self):
-        messages = filter(lambda x: type(x) is UnsentFile, self._corr)
-        return messages
+        return list(self._unsent_files.values())
 
     def clear_unsent_files(self):
-        self._corr = list(filter(lambda x: type(x) is not UnsentFile, self._corr))
+        for message in self._unsent_files.values():
+            self._delete(message)
+        self._unsent_files.clear()
 
     def delete_one_unsent_file(self, time):
-        self._corr = list(filter(lambda x: not (type(x) is UnsentFile and x.get_data()[2] == time), self._corr))
+        message = self._unsent_files.pop(time, None)
+        if message is not None:
+            self._delete(message)
 
     # -----------------------------------------------------------------------------------------------------------------
     # Alias support
@@ -200,6 +409,13 @@ class Friend(contact.Contact):
 
     visibility = property(get_visibility, set_visibility)
 
+    def set_model(self, model):
+        self._model = model
+
+    def _changed(self, avatar=False):
+        if self._model is not None:
+            self._model.friend_changed(self, avatar)
+
     # -----------------------------------------------------------------------------------------------------------------
     # Unread messages from friend
     # -----------------------------------------------------------------------------------------------------------------
@@ -209,7 +425,7 @@ class Friend(contact.Contact):
 
     def set_actions(self, value):
         self._new_actions = value
-        self._widget.connection_status.update(self.status, value)
+        self._changed()
 
     actions = property(get_actions, set_actions)  # unread messages, incoming files, av calls
 
@@ -219,14 +435,12 @@ class Friend(contact.Contact):
     def inc_messages(self):
         self._new_messages += 1
         self._new_actions = True
-        self._widget.connection_status.update(self.status, True)
-        self._widget.messages.update(self._new_messages)
+        self._changed()
 
     def reset_messages(self):
         self._new_actions = False
         self._new_messages = 0
-        self._widget.messages.update(self._new_messages)
-        self._widget.connection_status.update(self.status, False)
+        self._changed()
 
     messages = property(get_messages)
 
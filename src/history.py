@@ -1,13 +1,43 @@
 # coding=utf-8
-from sqlite3 import connect
+from sqlite3 import connect, OperationalError
+from contextlib import contextmanager
+from collections import deque
+from itertools import groupby
+import threading
+import time
 import settings
-from os import chdir
 import os.path
+import re
 from toxencryptsave import LibToxEncryptSave
+from encrypted_storage import PagedEncryptedFile, PAGED_FILE_MAGIC
+from util import log
 
 
 PAGE_SIZE = 42
 
+SCHEMA_VERSION = 1  # 0 - table 'id<TOX_ID>' for every friend, 1 - one table for all messages
+
+MIGRATION_BATCH_SIZE = 50  # number of friends moved to new schema in one step
+
+TOX_ID_REGEXP = re.compile('^[0-9A-F]+$')
+
+WORKING_COPY_SUFFIX = '.tmp'  # plain copy of encrypted history
+
+SEARCH_LIMIT = 100  # max number of search results
+
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'  # found words in snippets are between these markers
+
+FLUSH_INTERVAL = 5  # new messages are written to db at least every FLUSH_INTERVAL seconds...
+
+FLUSH_SIZE = 100  # ...or when FLUSH_SIZE statements are queued
+
+BUSY_TIMEOUT = 30  # seconds, writer waits for lock of db, failed batch is written again after FLUSH_INTERVAL
+
+INSERT_MESSAGE_SQL = ('INSERT INTO messages(friend_id, message, owner, unix_time, message_type) '
+                      'VALUES (?, ?, ?, ?, ?);')
+
+MARK_AS_SENT_SQL = 'UPDATE messages SET owner = 0 WHERE friend_id=? AND unix_time=? AND owner = 2;'
+
 MESSAGE_OWNER = {
     'ME': 0,
     'FRIEND': 1,
@@ -15,44 +45,378 @@ MESSAGE_OWNER = {
 }
 
 
+class HistoryWriter(threading.Thread):
+    """
+    Writes new messages to db in background thread. Statements are collected in append queue and executed in one
+    transaction every FLUSH_INTERVAL seconds or when FLUSH_SIZE statements are queued. If transaction fails (db is
+    locked, disk is full), batch stays at head of queue and is written again after FLUSH_INTERVAL.
+    Writer uses its own connection, WAL mode lets main connection read at the same time
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to plain db
+        """
+        super(HistoryWriter, self).__init__(name='HistoryWriter', daemon=True)
+        self._path = path
+        self._queue = deque()  # tuples (sql, params, friend_id)
+        self._pending = {}  # friend_id -> number of queued statements
+        self._condition = threading.Condition()
+        self._first_queued = 0.  # time when oldest statement in queue was added
+        self._flush_requested = self._stopped = False
+        self._failed = False  # last transaction failed, writer waits FLUSH_INTERVAL before next attempt
+        self._queued = self._written = 0  # number of statements ever queued / executed
+        self._metrics = {
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'flushes': 0,
+            'flushed_statements': 0,
+            'failed_flushes': 0,
+            'last_flush_latency': 0.,
+            'max_flush_latency': 0.,
+            'total_flush_latency': 0.
+        }
+
+    def append(self, sql, params_list, friend_id):
+        """
+        Queues statement for writing
+        :param sql: sql statement
+        :param params_list: list of parameter tuples, statement is executed once for every tuple
+        :param friend_id: id of friend whose messages are changed by statement
+        """
+        with self._condition:
+            if not self._queue:
+                self._first_queued = time.monotonic()
+                self._condition.notify()
+            for params in params_list:
+                self._queue.append((sql, params, friend_id))
+            self._queued += len(params_list)
+            self._pending[friend_id] = self._pending.get(friend_id, 0) + len(params_list)
+            self._metrics['max_queue_depth'] = max(self._metrics['max_queue_depth'], len(self._queue))
+            if len(self._queue) >= FLUSH_SIZE:
+                self._condition.notify()
+
+    def flush(self, friend_id=None):
+        """
+        Blocks until all queued statements are written or writing fails (statements stay queued).
+        Must not be called inside of transaction of other connection
+        :param friend_id: if not None, writer is flushed only if statements of this friend are queued
+        """
+        with self._condition:
+            target = self._queued
+            if self._written >= target or not self.is_alive():
+                return
+            if friend_id is not None and friend_id not in self._pending:
+                return
+            failures = self._metrics['failed_flushes']
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._written < target and self.is_alive() and self._metrics['failed_flushes'] == failures:
+                self._condition.wait(FLUSH_INTERVAL)
+
+    def stop(self):
+        """
+        Writes queue tail and stops thread
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self.is_alive():
+            self.join()
+
+    def get_metrics(self):
+        """
+        :return: dict with queue depth and flush latency (in seconds) statistics
+        """
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics['queue_depth'] = len(self._queue)
+        return metrics
+
+    def run(self):
+        db = connect(self._path, isolation_level=None, cached_statements=16, timeout=BUSY_TIMEOUT)
+        db.execute('PRAGMA synchronous=NORMAL;')
+        stop = False
+        while not stop:
+            with self._condition:
+                while not self._stopped:
+                    if not self._queue:
+                        self._condition.wait()
+                        continue
+                    if not self._failed and (self._flush_requested or len(self._queue) >= FLUSH_SIZE):
+                        break
+                    timeout = self._first_queued + FLUSH_INTERVAL - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                batch = list(self._queue)
+                self._queue.clear()
+                self._flush_requested = False
+                stop = self._stopped
+            if not batch:
+                continue
+            latency = time.perf_counter()
+            written = self._write(db, batch)
+            latency = time.perf_counter() - latency
+            with self._condition:
+                m = self._metrics
+                if written:
+                    m['flushes'] += 1
+                    m['flushed_statements'] += len(batch)
+                    m['last_flush_latency'] = latency
+                    m['max_flush_latency'] = max(m['max_flush_latency'], latency)
+                    m['total_flush_latency'] += latency
+                else:
+                    m['failed_flushes'] += 1
+                    if not stop:  # batch is written again before newer statements
+                        self._queue.extendleft(reversed(batch))
+                        self._first_queued = time.monotonic()
+                    else:
+                        log('Writing history failed, {} statements were lost'.format(len(batch)))
+                self._failed = not written
+                if written or stop:
+                    self._written += len(batch)
+                    for statement in batch:
+                        count = self._pending[statement[2]] - 1
+                        if count:
+                            self._pending[statement[2]] = count
+                        else:
+                            del self._pending[statement[2]]
+                self._condition.notify_all()
+        db.close()
+
+    @staticmethod
+    def _write(db, batch):
+        """
+        Executes batch of statements in one transaction
+        :return: True if transaction was committed
+        """
+        try:
+            db.execute('BEGIN;')
+            for sql, group in groupby(batch, key=lambda statement: statement[0]):
+                db.executemany(sql, (statement[1] for statement in group))
+            db.execute('COMMIT;')
+            return True
+        except Exception as ex:
+            log('Writing history failed: ' + str(ex))
+            if db.in_transaction:
+                db.execute('ROLLBACK;')
+            return False
+
+
 class History:
+    """
+    Chat history of profile. Owns one connection to db which is used during whole session
+    """
 
     def __init__(self, name):
         self._name = name
-        chdir(settings.ProfileHelper.get_path())
-        path = settings.ProfileHelper.get_path() + self._name + '.hstr'
-        if os.path.exists(path):
-            decr = LibToxEncryptSave.get_instance()
+        self._db = None
+        self._storage_path = settings.ProfileHelper.get_path() + self._name + '.hstr'
+        encr = LibToxEncryptSave.get_instance()
+        self._storage = PagedEncryptedFile(self._storage_path, encr)
+        self._path = self._storage_path  # path to plain db
+        if encr.has_password():  # plain working copy of encrypted history is used during session
+            self._path += WORKING_COPY_SUFFIX
             try:
-                with open(path, 'rb') as fin:
-                    data = fin.read()
-                if decr.is_data_encrypted(data):
-                    data = decr.pass_decrypt(data)
-                    with open(path, 'wb') as fout:
+                if os.path.exists(self._path):  # working copy wasn't saved (crash) - it contains newest data
+                    pass
+                elif PagedEncryptedFile.is_paged_file(self._storage_path):
+                    self._storage.decrypt_to(self._path)
+                elif os.path.exists(self._storage_path):
+                    with open(self._storage_path, 'rb') as fin:
+                        data = fin.read()
+                    if encr.is_data_encrypted(data):  # whole file was encrypted by old versions
+                        data = encr.pass_decrypt(data)
+                    with open(self._path, 'wb') as fout:
                         fout.write(data)
-            except:
-                os.remove(path)
-        db = connect(name + '.hstr')
-        cursor = db.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS friends('
-                       '    tox_id TEXT PRIMARY KEY'
-                       ')')
-        db.close()
+            except Exception as ex:
+                log('Loading history failed: ' + str(ex))
+                for path in (self._path, self._storage_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+        elif os.path.exists(self._path):
+            with open(self._path, 'rb') as fin:
+                data = fin.read(len(PAGED_FILE_MAGIC))
+            encrypted = data == PAGED_FILE_MAGIC or len(data) == len(PAGED_FILE_MAGIC) and encr.is_data_encrypted(data)
+            if encrypted:  # can't be decrypted without password
+                log('History is encrypted, but profile has no password')
+                os.remove(self._path)
+        # transactions are managed explicitly, statements are cached by sqlite3 module
+        self._db = connect(self._path, isolation_level=None, cached_statements=256)
+        self._db.execute('PRAGMA journal_mode=WAL;')
+        self._db.execute('PRAGMA synchronous=NORMAL;')
+        self._upgrade_schema()
+        self._search_index = self._create_search_index()
+        self._friend_ids = dict(self._db.execute('SELECT tox_id, id FROM friends;'))
+        self._writer = HistoryWriter(self._path)  # new messages are written in background
+        self._writer.start()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Writes queued messages, moves all data from write-ahead log to db file and closes connection
+        """
+        if getattr(self, '_writer', None) is not None:
+            self._writer.stop()
+            self._writer = None
+        if self._db is not None:
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        All statements executed inside this block are committed at once. Nested blocks join outer transaction
+        """
+        if self._db.in_transaction:
+            yield
+            return
+        self._db.execute('BEGIN;')
+        try:
+            yield
+        except:
+            self._db.execute('ROLLBACK;')
+            raise
+        else:
+            self._db.execute('COMMIT;')
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Schema and migration from old versions
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _upgrade_schema(self):
+        """
+        Creates tables of current schema version. Old per-friend tables are registered for migration
+        """
+        version = self._db.execute('PRAGMA user_version;').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            with self.transaction():
+                legacy = self._db.execute("SELECT 0 FROM sqlite_master WHERE type='table' AND name='friends';")
+                legacy = legacy.fetchone() is not None  # version 0 - table 'id<TOX_ID>' for every friend
+                if legacy:
+                    self._db.execute('ALTER TABLE friends RENAME TO legacy_friends;')
+                self._db.execute('CREATE TABLE friends('
+                                 '    id INTEGER PRIMARY KEY,'
+                                 '    tox_id TEXT NOT NULL UNIQUE'
+                                 ')')
+                self._db.execute('CREATE TABLE messages('
+                                 '    id INTEGER PRIMARY KEY,'
+                                 '    friend_id INTEGER NOT NULL,'
+                                 '    message TEXT,'
+                                 '    owner INTEGER,'
+                                 '    unix_time REAL,'
+                                 '    message_type INTEGER'
+                                 ')')
+                self._db.execute('CREATE INDEX messages_friend_time ON messages(friend_id, unix_time);')
+                if legacy:
+                    self._db.execute('INSERT INTO friends(tox_id) SELECT tox_id FROM legacy_friends;')
+                self._db.execute('PRAGMA user_version = {};'.format(SCHEMA_VERSION))
+        legacy = self._db.execute("SELECT 0 FROM sqlite_master WHERE type='table' AND name='legacy_friends';")
+        if legacy.fetchone() is not None:
+            self._not_migrated = set(row[0] for row in self._db.execute('SELECT tox_id FROM legacy_friends;'))
+        else:
+            self._not_migrated = None
+
+    def _create_search_index(self):
+        """
+        Creates FTS5 index over messages. Index is kept in step with messages table by triggers
+        :return: True if index exists, False if sqlite was built without FTS5
+        """
+        exists = self._db.execute("SELECT 0 FROM sqlite_master WHERE type='table' AND name='messages_fts';")
+        if exists.fetchone() is not None:
+            return True
+        try:
+            with self.transaction():
+                self._db.execute("CREATE VIRTUAL TABLE messages_fts USING fts5("
+                                 "    message,"
+                                 "    friend_id,"  # indexed to filter by friend inside of full-text query
+                                 "    content='messages',"
+                                 "    content_rowid='id'"
+                                 ");")
+                self._db.execute('CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN'
+                                 '    INSERT INTO messages_fts(rowid, message, friend_id)'
+                                 '    VALUES (new.id, new.message, new.friend_id);'
+                                 'END;')
+                self._db.execute("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN"
+                                 "    INSERT INTO messages_fts(messages_fts, rowid, message, friend_id)"
+                                 "    VALUES ('delete', old.id, old.message, old.friend_id);"
+                                 "END;")
+                self._db.execute("CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN"
+                                 "    INSERT INTO messages_fts(messages_fts, rowid, message, friend_id)"
+                                 "    VALUES ('delete', old.id, old.message, old.friend_id);"
+                                 "    INSERT INTO messages_fts(rowid, message, friend_id)"
+                                 "    VALUES (new.id, new.message, new.friend_id);"
+                                 "END;")
+                self._db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');")  # index old messages
+            return True
+        except OperationalError as ex:
+            log('Search index was not created: ' + str(ex))
+            return False
+
+    def _migrate_friend(self, tox_id):
+        """
+        Moves messages of friend from table id<TOX_ID> to messages table
+        """
+        with self.transaction():
+            table = 'id' + tox_id
+            exists = self._db.execute("SELECT 0 FROM sqlite_master WHERE type='table' AND name=?;", (table, ))
+            if TOX_ID_REGEXP.match(tox_id) and exists.fetchone() is not None:
+                self._db.execute('INSERT INTO messages(friend_id, message, owner, unix_time, message_type) '
+                                 'SELECT ?, message, owner, unix_time, message_type FROM ' + table + ' ORDER BY id;',
+                                 (self._friend_ids[tox_id], ))
+                self._db.execute('DROP TABLE ' + table + ';')
+            self._db.execute('DELETE FROM legacy_friends WHERE tox_id=?;', (tox_id, ))
+        self._not_migrated.discard(tox_id)
+
+    def migrate(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Migrates next batch of friends from old db schema. Friends used before are migrated on demand
+        :param batch_size: max number of friends migrated in one transaction
+        :return: True if migration is finished
+        """
+        if self._not_migrated is None:
+            return True
+        with self.transaction():
+            for tox_id in list(self._not_migrated)[:batch_size]:
+                self._migrate_friend(tox_id)
+            if not self._not_migrated:
+                self._db.execute('DROP TABLE legacy_friends;')
+                self._not_migrated = None
+        return self._not_migrated is None
+
+    def _get_friend_id(self, tox_id):
+        """
+        :return: id of friend in db or None if friend is not in db
+        """
+        if self._not_migrated and tox_id in self._not_migrated:
+            self._migrate_friend(tox_id)
+        return self._friend_ids.get(tox_id)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Save, export
+    # -----------------------------------------------------------------------------------------------------------------
 
     def save(self):
+        self.close()
         encr = LibToxEncryptSave.get_instance()
         if encr.has_password():
-            path = settings.ProfileHelper.get_path() + self._name + '.hstr'
-            with open(path, 'rb') as fin:
-                data = fin.read()
-            data = encr.pass_encrypt(bytes(data))
-            with open(path, 'wb') as fout:
-                fout.write(data)
+            if self._path == self._storage_path:  # password was set during session
+                os.replace(self._path, self._path + WORKING_COPY_SUFFIX)
+                self._path += WORKING_COPY_SUFFIX
+            self._storage.encrypt_from(self._path)  # only changed pages are encrypted
+            os.remove(self._path)
+        elif self._path != self._storage_path:  # password was removed during session
+            os.replace(self._path, self._storage_path)
 
     def export(self, directory):
-        path = settings.ProfileHelper.get_path() + self._name + '.hstr'
+        self.flush()
+        self._db.execute('PRAGMA wal_checkpoint(TRUNCATE);')
         new_path = directory + self._name + '.hstr'
-        with open(path, 'rb') as fin:
+        with open(self._path, 'rb') as fin:
             data = fin.read()
         encr = LibToxEncryptSave.get_instance()
         if encr.has_password():
@@ -60,123 +424,198 @@ class History:
         with open(new_path, 'wb') as fout:
             fout.write(data)
 
+    # -----------------------------------------------------------------------------------------------------------------
+    # Friends and messages
+    # -----------------------------------------------------------------------------------------------------------------
+
     def add_friend_to_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        try:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO friends VALUES (?);', (tox_id, ))
-            cursor.execute('CREATE TABLE id' + tox_id + '('
-                           '    id INTEGER PRIMARY KEY,'
-                           '    message TEXT,'
-                           '    owner INTEGER,'
-                           '    unix_time REAL,'
-                           '    message_type INTEGER'
-                           ')')
-            db.commit()
-        except:
-            db.rollback()
-            raise
-        finally:
-            db.close()
+        with self.transaction():
+            cursor = self._db.execute('INSERT INTO friends(tox_id) VALUES (?);', (tox_id, ))
+            self._friend_ids[tox_id] = cursor.lastrowid
 
     def delete_friend_from_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM friends WHERE tox_id=?;', (tox_id, ))
-            cursor.execute('DROP TABLE id' + tox_id + ';')
-            db.commit()
-        except:
-            db.rollback()
-            raise
-        finally:
-            db.close()
+        self.flush()
+        with self.transaction():
+            self._db.execute('DELETE FROM messages WHERE friend_id=?;', (self._get_friend_id(tox_id), ))
+            self._db.execute('DELETE FROM friends WHERE tox_id=?;', (tox_id, ))
+        del self._friend_ids[tox_id]
 
     def friend_exists_in_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        cursor = db.cursor()
-        cursor.execute('SELECT 0 FROM friends WHERE tox_id=?', (tox_id, ))
-        result = cursor.fetchone()
-        db.close()
-        return result is not None
+        return tox_id in self._friend_ids
 
     def save_messages_to_db(self, tox_id, messages_iter):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        try:
-            cursor = db.cursor()
-            cursor.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) '
-                               'VALUES (?, ?, ?, ?);', messages_iter)
-            db.commit()
-        except:
-            db.rollback()
-            raise
-        finally:
-            db.close()
+        friend_id = self._get_friend_id(tox_id)
+        with self.transaction():
+            self._db.executemany(INSERT_MESSAGE_SQL, ((friend_id, ) + tuple(m) for m in messages_iter))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Write-behind
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def append_messages(self, tox_id, messages):
+        """
+        Queues new messages of friend for writing in background
+        :param tox_id: friend's public key
+        :param messages: iterable of tuples (message, owner, unix_time, message_type)
+        """
+        friend_id = self._get_friend_id(tox_id)
+        if friend_id is None:
+            self.add_friend_to_db(tox_id)
+            friend_id = self._friend_ids[tox_id]
+        self._writer.append(INSERT_MESSAGE_SQL, [(friend_id, ) + tuple(m) for m in messages], friend_id)
+
+    def mark_as_sent(self, tox_id, unix_time):
+        """
+        Queues update of owner of message which was sent
+        """
+        friend_id = self._get_friend_id(tox_id)
+        if friend_id is not None and self._writer is not None:
+            self._writer.append(MARK_AS_SENT_SQL, [(friend_id, unix_time)], friend_id)
+
+    def flush(self):
+        """
+        Waits until queued messages are written. Called before statements which can change queued messages
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def get_writer_metrics(self):
+        return self._writer.get_metrics() if self._writer is not None else None
 
     def update_messages(self, tox_id, unsent_time):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        try:
-            cursor = db.cursor()
-            cursor.execute('UPDATE id' + tox_id + ' SET owner = 0 '
-                           'WHERE unix_time < ' + str(unsent_time) + ' AND owner = 2;')
-            db.commit()
-        except:
-            db.rollback()
-            raise
-        finally:
-            db.close()
-        pass
+        self.flush()
+        with self.transaction():
+            self._db.execute('UPDATE messages SET owner = 0 '
+                             'WHERE friend_id=? AND unix_time < ? AND owner = 2;',
+                             (self._get_friend_id(tox_id), unsent_time))
 
     def delete_message(self, tox_id, time):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM id' + tox_id + ' WHERE unix_time = ' + str(time) + ';')
-            db.commit()
-        except:
-            db.rollback()
-            raise
-        finally:
-            db.close()
+        self.flush()
+        with self.transaction():
+            self._db.execute('DELETE FROM messages WHERE friend_id=? AND unix_time=?;',
+                             (self._get_friend_id(tox_id), time))
 
     def delete_messages(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr')
-        try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM id' + tox_id + ';')
-            db.commit()
-        except:
-            db.rollback()
-            raise
-        finally:
-            db.close()
+        self.flush()
+        with self.transaction():
+            self._db.execute('DELETE FROM messages WHERE friend_id=?;', (self._get_friend_id(tox_id), ))
+
+    def get_messages(self, tox_id, count, before_time=None):
+        """
+        Messages of friend older than given time (index range scan on (friend_id, unix_time))
+        :param count: max number of messages, -1 - all messages
+        :param before_time: unix time of oldest message which was already loaded or None to get newest messages
+        :return: list of tuples (message, owner, unix_time, message_type) ordered from new to old
+        """
+        friend_id = self._get_friend_id(tox_id)
+        if friend_id is None:
+            return []
+        if self._writer is not None:
+            self._writer.flush(friend_id)  # evicted messages can be in queue
+        if before_time is None:
+            cursor = self._db.execute('SELECT message, owner, unix_time, message_type FROM messages '
+                                      'WHERE friend_id=? ORDER BY unix_time DESC LIMIT ?;',
+                                      (friend_id, count))
+        else:
+            cursor = self._db.execute('SELECT message, owner, unix_time, message_type FROM messages '
+                                      'WHERE friend_id=? AND unix_time < ? ORDER BY unix_time DESC LIMIT ?;',
+                                      (friend_id, before_time, count))
+        return cursor.fetchall()
+
+    def get_messages_around(self, tox_id, unix_time, count, before_time=None):
+        """
+        Message with given time, all newer messages up to before_time and page of older messages
+        :return: list of tuples (message, owner, unix_time, message_type) ordered from new to old
+        """
+        friend_id = self._get_friend_id(tox_id)
+        if friend_id is None:
+            return []
+        if self._writer is not None:
+            self._writer.flush(friend_id)  # evicted messages can be in queue
+        if before_time is None:
+            before_time = float('inf')
+        newer = self._db.execute('SELECT message, owner, unix_time, message_type FROM messages '
+                                 'WHERE friend_id=? AND unix_time >= ? AND unix_time < ? ORDER BY unix_time DESC;',
+                                 (friend_id, unix_time, before_time)).fetchall()
+        return newer + self.get_messages(tox_id, count, unix_time)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Search
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def search(self, text, tox_id=None, limit=SEARCH_LIMIT):
+        """
+        Full-text search over history
+        :param text: words to search. Last word can be a prefix of word in message
+        :param tox_id: search in history of this friend only. None - search in history of all friends
+        :param limit: max number of results
+        :return: list of tuples (tox_id, unix_time, snippet) ordered from new to old. Found words in snippet are
+        between SNIPPET_START and SNIPPET_END
+        """
+        words = text.split()
+        if not words:
+            return []
+        friend_id = None
+        if tox_id is not None:
+            friend_id = self._get_friend_id(tox_id)
+            if friend_id is None:
+                return []
+        if self._search_index:
+            query = '{{message}}: ({})'.format(' '.join('"{}"'.format(word.replace('"', '""')) for word in words) + '*')
+            if friend_id is not None:
+                query += ' AND {{friend_id}}: "{}"'.format(friend_id)
+            sql = ('SELECT friends.tox_id, messages.unix_time, found.snippet FROM ('
+                   '    SELECT rowid, snippet(messages_fts, 0, ?, ?, \'...\', 12) AS snippet FROM messages_fts'
+                   '    WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?'
+                   ') AS found '
+                   'JOIN messages ON messages.id = found.rowid '
+                   'JOIN friends ON friends.id = messages.friend_id '
+                   'ORDER BY messages.unix_time DESC;')
+            params = [SNIPPET_START, SNIPPET_END, query, limit]
+        else:  # slow search without index
+            query = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            sql = ('SELECT friends.tox_id, messages.unix_time, messages.message FROM messages '
+                   'JOIN friends ON friends.id = messages.friend_id '
+                   'WHERE messages.message LIKE ? ESCAPE \'\\\' {} ORDER BY messages.unix_time DESC LIMIT ?;'
+                   ).format('' if friend_id is None else 'AND messages.friend_id=?')
+            params = [query] + ([] if friend_id is None else [friend_id]) + [limit]
+        return self._db.execute(sql, params).fetchall()
 
     def messages_getter(self, tox_id):
-        return History.MessageGetter(self._name, tox_id)
+        return History.MessageGetter(self, tox_id)
 
     class MessageGetter:
-        def __init__(self, name, tox_id):
-            chdir(settings.ProfileHelper.get_path())
-            self._db = connect(name + '.hstr')
-            self._cursor = self._db.cursor()
-            self._cursor.execute('SELECT message, owner, unix_time, message_type FROM id' + tox_id +
-                                 ' ORDER BY unix_time DESC;')
+        """
+        Loads messages of friend page by page. Stateless - nothing is kept open between calls
+        """
 
-        def get_one(self):
-            return self._cursor.fetchone()
+        def __init__(self, history, tox_id):
+            self._history = history
+            self._tox_id = tox_id
 
-        def get_all(self):
-            return self._cursor.fetchall()
+        def get_one(self, before_time=None):
+            return (self.get(1, before_time) or [None])[0]
 
-        def get(self, count):
-            return self._cursor.fetchmany(count)
+        def get_all(self, before_time=None):
+            return self.get(-1, before_time)
 
-        def __del__(self):
-            self._db.close()
+        def get(self, count, before_time=None):
+            return self._history.get_messages(self._tox_id, count, before_time)
+
+        def get_around(self, unix_time, count, before_time=None):
+            return self._history.get_messages_around(self._tox_id, unix_time, count, before_time)
+
+        def append(self, messages):
+            """
+            Queues new messages for writing in background if full history is saved
+            :param messages: iterable of tuples (message, owner, unix_time, message_type)
+            :return: True if messages were queued, False if they must be saved on exit
+            """
+            s = settings.Settings.get_instance()
+            if s is None or not s['save_history'] or s['save_unsent_only']:
+                return False
+            self._history.append_messages(self._tox_id, messages)
+            return True
+
+        def mark_as_sent(self, unix_time):
+            self._history.mark_as_sent(self._tox_id, unix_time)
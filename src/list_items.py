@@ -6,9 +6,13 @@ except ImportError:
 import profile
 from file_transfers import TOX_FILE_TRANSFER_STATE, PAUSED_FILE_TRANSFERS, DO_NOT_SHOW_ACCEPT_BUTTON, ACTIVE_FILE_TRANSFERS, SHOW_PROGRESS_BAR
 from util import curr_directory, convert_time, curr_time
-from widgets import DataLabel, create_menu
-import html as h
+from widgets import DataLabel, create_menu, elided_text
+from collections import OrderedDict
+import math
+from message_render import render_message
+from animations import AnimationPlayer
 import smileys
+import pixmaps
 import settings
 
 
@@ -16,7 +20,7 @@ class MessageEdit(QtGui.QTextBrowser):
 
     def __init__(self, text, width, message_type, parent=None):
         super(MessageEdit, self).__init__(parent)
-        self.urls = {}
+        self.urls = {}  # path to animated smiley -> url of image in document
         self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
         self.setWordWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
@@ -26,11 +30,15 @@ class MessageEdit(QtGui.QTextBrowser):
         self.setOpenLinks(False)
         self.setSearchPaths([smileys.SmileyLoader.get_instance().get_smileys_path()])
         self.document().setDefaultStyleSheet('a { color: #306EFF; }')
-        text = self.decoratedText(text)
-        if message_type != TOX_MESSAGE_TYPE['NORMAL']:
-            self.setHtml('<p style="color: #5CB3FF; font: italic; font-size: 20px;" >' + text + '</p>')
-        else:
-            self.setHtml(text)
+        text, animated = render_message(text, message_type)
+        self.setHtml(text)
+        smileys_path = smileys.SmileyLoader.get_instance().get_smileys_path()
+        for file_name in animated:
+            self.urls[smileys_path + file_name] = QtCore.QUrl(file_name)
+        if self.urls:
+            player, key = AnimationPlayer.get_instance(), id(self)
+            player.set_animations(key, self.urls.keys(), self.animate)
+            self.destroyed.connect(lambda: player.remove(key))
         font = QtGui.QFont()
         font.setFamily("Times New Roman")
         font.setPixelSize(settings.Settings.get_instance()['message_font_size'])
@@ -47,146 +55,490 @@ class MessageEdit(QtGui.QTextBrowser):
         del menu
 
     def on_anchor_clicked(self, url):
-        text = str(url.toString())
-        if text.startswith('tox:'):
-            import menu
-            self.add_contact = menu.AddContact(text[4:])
-            self.add_contact.show()
-        else:
-            QtGui.QDesktopServices.openUrl(url)
+        window = open_link(str(url.toString()))
+        if window is not None:
+            self.add_contact = window
         self.clearFocus()
 
-    def addAnimation(self, url, fileName):
-        movie = QtGui.QMovie(self)
-        movie.setFileName(fileName)
-        self.urls[movie] = url
-        movie.frameChanged[int].connect(lambda x: self.animate(movie))
-        movie.start()
+    def animate(self, path, pixmap):
+        """
+        Shows new frame of animated smiley. Frames have the same size so document is repainted without relayout
+        """
+        self.document().addResource(QtGui.QTextDocument.ImageResource, self.urls[path], pixmap)
+        self.viewport().update()
 
-    def animate(self, movie):
-        self.document().addResource(QtGui.QTextDocument.ImageResource,
-                                    self.urls[movie],
-                                    movie.currentPixmap())
-        self.setLineWrapColumnOrWidth(self.lineWrapColumnOrWidth())
-
-    def decoratedText(self, text):
-        text = h.escape(text)  # replace < and >
-        exp = QtCore.QRegExp(
-            '('
-            '(?:\\b)((www\\.)|(http[s]?|ftp)://)'
-            '\\w+\\S+)'
-            '|(?:\\b)(file:///)([\\S| ]*)'
-            '|(?:\\b)(tox:[a-zA-Z\\d]{76}$)'
-            '|(?:\\b)(mailto:\\S+@\\S+\\.\\S+)'
-            '|(?:\\b)(tox:\\S+@\\S+)')
-        offset = exp.indexIn(text, 0)
-        while offset != -1:  # add links
-            url = exp.cap()
-            if exp.cap(2) == 'www.':
-                html = '<a href="http://{0}">{0}</a>'.format(url)
-            else:
-                html = '<a href="{0}">{0}</a>'.format(url)
-            text = text[:offset] + html + text[offset + len(exp.cap()):]
-            offset += len(html)
-            offset = exp.indexIn(text, offset)
-        arr = text.split('\n')
-        for i in range(len(arr)):  # quotes
-            if arr[i].startswith('&gt;'):
-                arr[i] = '<font color="green"><b>' + arr[i][4:] + '</b></font>'
-        text = '<br>'.join(arr)
-        text = smileys.SmileyLoader.get_instance().add_smileys_to_text(text, self)  # smileys
-        return text
-
-
-class MessageItem(QtGui.QWidget):
+
+def open_link(url):
     """
-    Message in messages list
+    Opens link from message. Links to tox ids open window for adding contact
+    :param url: url as str
+    :return: opened window or None
     """
-    def __init__(self, text, time, user='', sent=True, message_type=TOX_MESSAGE_TYPE['NORMAL'], parent=None):
-        QtGui.QWidget.__init__(self, parent)
-        self.name = DataLabel(self)
-        self.name.setGeometry(QtCore.QRect(2, 2, 95, 20))
-        self.name.setTextFormat(QtCore.Qt.PlainText)
-        font = QtGui.QFont()
-        font.setFamily("Times New Roman")
-        font.setPointSize(11)
-        font.setBold(True)
-        self.name.setFont(font)
-        self.name.setText(user)
+    if url.startswith('tox:'):
+        import menu
+        window = menu.AddContact(url[4:])
+        window.show()
+        return window
+    QtGui.QDesktopServices.openUrl(QtCore.QUrl(url))
+    return None
 
-        self.time = QtGui.QLabel(self)
-        self.time.setGeometry(QtCore.QRect(parent.width() - 50, 0, 50, 20))
-        font = QtGui.QFont()
-        font.setFamily("Times New Roman")
-        font.setPointSize(10)
-        font.setBold(False)
-        self.time.setFont(font)
-        self._time = time
-        if not sent:
-            movie = QtGui.QMovie(curr_directory() + '/images/spinner.gif')
-            self.time.setMovie(movie)
-            movie.start()
-            self.t = True
-        else:
-            self.time.setText(convert_time(time))
-            self.t = False
 
-        self.message = MessageEdit(text, parent.width() - 150, message_type, self)
-        if message_type != TOX_MESSAGE_TYPE['NORMAL']:
-            self.name.setStyleSheet("QLabel { color: #5CB3FF; }")
-            self.message.setAlignment(QtCore.Qt.AlignCenter)
-            self.time.setStyleSheet("QLabel { color: #5CB3FF; }")
-        self.message.setGeometry(QtCore.QRect(100, 0, parent.width() - 150, self.message.height()))
-        self.setFixedHeight(self.message.height())
+MESSAGE_ROLE = QtCore.Qt.UserRole  # data of text message in messages list: (text, time, name, sent, message type)
 
-    def mouseReleaseEvent(self, event):
-        if event.button() == QtCore.Qt.RightButton and event.x() > self.time.x():
-            self.listMenu = QtGui.QMenu()
-            delete_item = self.listMenu.addAction(QtGui.QApplication.translate("MainWindow", 'Delete message', None, QtGui.QApplication.UnicodeUTF8))
-            self.connect(delete_item, QtCore.SIGNAL("triggered()"), self.delete)
-            parent_position = self.time.mapToGlobal(QtCore.QPoint(0, 0))
-            self.listMenu.move(parent_position)
-            self.listMenu.show()
-
-    def delete(self):
-        pr = profile.Profile.get_instance()
-        pr.delete_message(self._time)
 
-    def mark_as_sent(self):
-        if self.t:
-            self.time.setText(convert_time(self._time))
-            self.t = False
+def mark_message_as_sent(item):
+    """
+    :param item: QListWidgetItem in messages list
+    :return: True if item is text message which was not sent before
+    """
+    data = item.data(MESSAGE_ROLE)
+    if data is None or data[3]:
+        return False
+    item.setData(MESSAGE_ROLE, data[:3] + (True,) + data[4:])
+    return True
+
+
+class MessageDelegate(QtGui.QStyledItemDelegate):
+    """
+    Paints text messages in messages list: name, time and message text. Only visible rows are painted.
+    Laid out messages are cached and are laid out again without parsing when width of list changes.
+    Double click on message opens MessageEdit for text selection.
+    Animated smileys and spinners of unsent messages are played only in visible rows.
+    Rows of file transfers and inline images have widgets and are not painted here
+    """
+
+    DOCUMENTS_CACHE_SIZE = 300  # laid out messages, several screens of messages
+    HEIGHTS_CACHE_SIZE = 10000
+
+    def __init__(self, view):
+        """
+        :param view: messages list
+        """
+        super(MessageDelegate, self).__init__(view)
+        self._view = view
+        self._documents = OrderedDict()  # (text, message type, font size) -> QTextDocument
+        self._heights = OrderedDict()  # (text, message type, font size, width) -> height of row
+        self._name_font = QtGui.QFont()
+        self._name_font.setFamily("Times New Roman")
+        self._name_font.setPointSize(11)
+        self._name_font.setBold(True)
+        self._time_font = QtGui.QFont(self._name_font)
+        self._time_font.setPointSize(10)
+        self._time_font.setBold(False)
+        self._spinner_path = curr_directory() + '/images/spinner.gif'
+        self._animated_rows = {}  # path to gif -> rows of visible messages with this animation
+        self._animations_timer = QtCore.QTimer(self)  # visible animations are updated once after many changes
+        self._animations_timer.setSingleShot(True)
+        self._animations_timer.timeout.connect(self.update_animations)
+        for signal in (view.verticalScrollBar().valueChanged, view.verticalScrollBar().rangeChanged,
+                       view.model().rowsInserted, view.model().rowsRemoved, view.model().modelReset):
+            signal.connect(lambda *args: self._animations_timer.start())
+        self._menu = self._window = None
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Layouts of messages
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _get_document(self, text, message_type, width):
+        """
+        :return: QTextDocument with message laid out for given width
+        """
+        font_size = settings.Settings.get_instance()['message_font_size']
+        key = (text, message_type, font_size)
+        if key in self._documents:
+            self._documents.move_to_end(key)
+            document = self._documents[key]
+        else:
+            document = QtGui.QTextDocument()
+            smileys_path = smileys.SmileyLoader.get_instance().get_smileys_path()
+            document.setMetaInformation(QtGui.QTextDocument.DocumentUrl,
+                                        QtCore.QUrl.fromLocalFile(smileys_path).toString())  # images of smileys
+            document.setDefaultStyleSheet('a { color: #306EFF; }')
+            font = QtGui.QFont()
+            font.setFamily("Times New Roman")
+            font.setPixelSize(font_size)
+            document.setDefaultFont(font)
+            option = document.defaultTextOption()
+            option.setWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
+            document.setDefaultTextOption(option)
+            document.setHtml(render_message(text, message_type)[0])
+            self._documents[key] = document
+            if len(self._documents) > self.DOCUMENTS_CACHE_SIZE:
+                self._documents.popitem(last=False)
+        if document.textWidth() != width:
+            document.setTextWidth(width)
+        return document
+
+    def _get_height(self, text, message_type, width):
+        key = (text, message_type, settings.Settings.get_instance()['message_font_size'], width)
+        if key in self._heights:
+            self._heights.move_to_end(key)
+        else:
+            size = self._get_document(text, message_type, width).size()
+            self._heights[key] = int(math.ceil(size.height()))
+            if len(self._heights) > self.HEIGHTS_CACHE_SIZE:
+                self._heights.popitem(last=False)
+        return self._heights[key]
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Animations
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def update_animations(self):
+        """
+        Subscribes to animations of visible messages only, so hidden history doesn't use CPU
+        """
+        view, rows = self._view, {}
+        count = view.count()
+        if count:
+            first = view.indexAt(QtCore.QPoint(5, 2)).row()
+            last = view.indexAt(QtCore.QPoint(5, view.viewport().height() - 3)).row()
+            for row in range(max(first, 0), last + 1 if last != -1 else count):
+                data = view.item(row).data(MESSAGE_ROLE)
+                if data is None:
+                    continue
+                animated = render_message(data[0], data[4])[1]
+                paths = []
+                if animated:
+                    smileys_path = smileys.SmileyLoader.get_instance().get_smileys_path()
+                    paths.extend(smileys_path + file_name for file_name in animated)
+                if not data[3]:
+                    paths.append(self._spinner_path)
+                for path in paths:
+                    rows.setdefault(path, []).append(row)
+        self._animated_rows = rows
+        AnimationPlayer.get_instance().set_animations(id(self), rows.keys(), self._frame_changed)
+
+    def _frame_changed(self, path, pixmap):
+        for row in self._animated_rows.get(path, ()):
+            item = self._view.item(row)
+            if item is not None:
+                self._view.viewport().update(self._view.visualItemRect(item))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Painting
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def sizeHint(self, option, index):
+        data = index.data(MESSAGE_ROLE)
+        if data is None:  # row with widget
+            return super(MessageDelegate, self).sizeHint(option, index)
+        width = self._view.width()
+        return QtCore.QSize(width, self._get_height(data[0], data[4], width - 150))
+
+    def paint(self, painter, option, index):
+        data = index.data(MESSAGE_ROLE)
+        if data is None:
+            super(MessageDelegate, self).paint(painter, option, index)
+            return
+        text, unix_time, name, sent, message_type = data
+        x, y, width = option.rect.x(), option.rect.y(), self._view.width()
+        painter.save()
+        if message_type != TOX_MESSAGE_TYPE['NORMAL']:
+            painter.setPen(QtGui.QColor('#5CB3FF'))
+        else:
+            painter.setPen(option.palette.color(QtGui.QPalette.Text))
+        painter.setFont(self._name_font)
+        painter.drawText(QtCore.QRect(x + 2, y + 2, 95, 20), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                         elided_text(name, self._name_font, 95))
+        if sent:
+            painter.setFont(self._time_font)
+            painter.drawText(QtCore.QRect(x + width - 50, y, 50, 20), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                             convert_time(unix_time))
+        else:
+            painter.drawPixmap(x + width - 50, y, AnimationPlayer.get_instance().get_frame(self._spinner_path))
+        document = self._get_document(text, message_type, width - 150)
+        animated = render_message(text, message_type)[1]
+        if animated:  # current frames of animated smileys
+            smileys_path = smileys.SmileyLoader.get_instance().get_smileys_path()
+            for file_name in animated:
+                document.addResource(QtGui.QTextDocument.ImageResource, QtCore.QUrl(file_name),
+                                     AnimationPlayer.get_instance().get_frame(smileys_path + file_name))
+        painter.translate(x + 100, y)
+        context = QtGui.QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QtGui.QPalette.Text, option.palette.color(QtGui.QPalette.Text))
+        document.documentLayout().draw(painter, context)
+        painter.restore()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Links, context menu and text selection
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def editorEvent(self, event, model, option, index):
+        data = index.data(MESSAGE_ROLE)
+        if data is None or event.type() != QtCore.QEvent.MouseButtonRelease:
+            return False
+        width = self._view.width()
+        x, y = event.pos().x() - option.rect.x(), event.pos().y() - option.rect.y()
+        if event.button() == QtCore.Qt.RightButton and x > width - 50:
+            self._menu = QtGui.QMenu()
+            delete_item = self._menu.addAction(QtGui.QApplication.translate("MainWindow", 'Delete message', None,
+                                                                            QtGui.QApplication.UnicodeUTF8))
+            delete_item.triggered.connect(lambda: profile.Profile.get_instance().delete_message(data[1]))
+            self._menu.move(event.globalPos())
+            self._menu.show()
             return True
+        if event.button() == QtCore.Qt.LeftButton and 100 <= x < width - 50:
+            document = self._get_document(data[0], data[4], width - 150)
+            url = document.documentLayout().anchorAt(QtCore.QPointF(x - 100, y))
+            if url:
+                self._window = open_link(url)
+                return True
         return False
 
+    def createEditor(self, parent, option, index):
+        data = index.data(MESSAGE_ROLE)
+        if data is None:
+            return None
+        return MessageEdit(data[0], self._view.width() - 150, data[4], parent)
 
-class ContactItem(QtGui.QWidget):
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(QtCore.QRect(option.rect.x() + 100, option.rect.y(),
+                                        self._view.width() - 150, option.rect.height()))
+
+    def setEditorData(self, editor, index):
+        pass
+
+    def setModelData(self, editor, model, index):
+        pass  # messages are read only
+
+
+FRIEND_ROLE = QtCore.Qt.UserRole  # role of Friend instance in friends list model
+
+
+def status_image_name(status, unread_messages=False):
+    """
+    :return: name of image in images/ which shows connection status
+    """
+    if status == TOX_USER_STATUS['NONE']:
+        name = 'online'
+    elif status == TOX_USER_STATUS['AWAY']:
+        name = 'idle'
+    elif status == TOX_USER_STATUS['BUSY']:
+        name = 'busy'
+    else:
+        name = 'offline'
+    if unread_messages:
+        name += '_notification'
+    return name
+
+
+class FriendsListModel(QtCore.QAbstractListModel):
     """
-    Contact in friends list
+    Model of friends list. Rows are friends of profile, widgets for rows are not created - FriendDelegate paints them.
+    Model shares list of friends with profile, friends are added and removed only through model.
+    Visibility of friend is computed by model when friend is added or changed and when filter changes
     """
 
     def __init__(self, parent=None):
-        QtGui.QWidget.__init__(self, parent)
-        self.setBaseSize(QtCore.QSize(250, 70))
-        self.avatar_label = QtGui.QLabel(self)
-        self.avatar_label.setGeometry(QtCore.QRect(3, 3, 64, 64))
-        self.avatar_label.setScaledContents(True)
-        self.name = DataLabel(self)
-        self.name.setGeometry(QtCore.QRect(75, 10, 150, 25))
-        font = QtGui.QFont()
-        font.setFamily("Times New Roman")
-        font.setPointSize(12)
-        font.setBold(True)
-        self.name.setFont(font)
-        self.status_message = DataLabel(self)
-        self.status_message.setGeometry(QtCore.QRect(75, 30, 170, 20))
-        font.setPointSize(10)
-        font.setBold(False)
-        self.status_message.setFont(font)
-        self.connection_status = StatusCircle(self)
-        self.connection_status.setGeometry(QtCore.QRect(230, 5, 32, 32))
-        self.messages = UnreadMessagesCount(self)
-        self.messages.setGeometry(QtCore.QRect(52, 50, 30, 20))
+        super(FriendsListModel, self).__init__(parent)
+        self._friends = []
+        self._rows = {}  # id of friend -> row
+        self._show_online, self._filter_str = True, ''
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._friends)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._friends):
+            return None
+        friend = self._friends[index.row()]
+        if role == FRIEND_ROLE:
+            return friend
+        if role == QtCore.Qt.DisplayRole:
+            return friend.name
+        return None
+
+    def get_friend(self, row):
+        return self._friends[row]
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Changes of friends list
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def set_friends(self, friends):
+        """
+        Replaces all rows
+        :param friends: list of Friend instances. This list is used by model and must not be changed outside
+        """
+        self.beginResetModel()
+        self._friends = friends
+        for friend in friends:
+            friend.set_model(self)
+            self._update_visibility(friend)
+        self._rebuild_rows()
+        self.endResetModel()
+
+    def append_friend(self, friend):
+        row = len(self._friends)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._friends.append(friend)
+        self._rows[id(friend)] = row
+        friend.set_model(self)
+        self._update_visibility(friend)
+        self.endInsertRows()
+
+    def remove_friend(self, row):
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        friend = self._friends.pop(row)
+        friend.set_model(None)
+        self._rebuild_rows()
+        self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        for friend in self._friends:
+            friend.set_model(None)
+        del self._friends[:]  # list is shared with profile
+        self._rows.clear()
+        self.endResetModel()
+
+    def _rebuild_rows(self):
+        self._rows = dict((id(friend), row) for row, friend in enumerate(self._friends))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Filtration
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def set_filter(self, show_online, filter_str):
+        """
+        :param show_online: show online only contacts
+        :param filter_str: show contacts which name contains this substring
+        :return: True if filter was changed and visibility of friends was computed again
+        """
+        filter_str = filter_str.lower()
+        if (show_online, filter_str) == (self._show_online, self._filter_str):
+            return False
+        self._show_online, self._filter_str = show_online, filter_str
+        self.update_visibility()
+        return True
+
+    def update_visibility(self):
+        for friend in self._friends:
+            self._update_visibility(friend)
+
+    def _update_visibility(self, friend):
+        visible = (friend.status is not None or not self._show_online) and (self._filter_str in friend.name_lower)
+        friend.visibility = bool(visible or friend.messages or friend.actions)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Changes of friends' data
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def friend_changed(self, friend, avatar=False):
+        """
+        Repaints row of friend if it's visible
+        :param friend: Friend instance
+        :param avatar: avatar of friend was changed
+        """
+        row = self._rows.get(id(friend))
+        if row is not None:
+            self._update_visibility(friend)  # proxy filters row again after data change
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def get_avatar(self, friend):
+        """
+        :return: avatar of friend. Avatars are decoded once and kept in pixmaps cache
+        """
+        return friend.get_pixmap()
+
+
+class FriendsFilterProxyModel(QtGui.QSortFilterProxyModel):
+    """
+    Hides friends which are not visible. Hidden friends have no rows in view.
+    Row of friend is filtered again when friend's data changes, whole list - only when filter changes
+    """
+
+    def __init__(self, parent=None):
+        super(FriendsFilterProxyModel, self).__init__(parent)
+        self.setDynamicSortFilter(True)  # rows are shown and hidden when data of friend changes
+
+    def set_filter(self, show_online, filter_str):
+        """
+        :param show_online: show online only contacts
+        :param filter_str: show contacts which name contains this substring
+        """
+        if self.sourceModel().set_filter(show_online, filter_str):
+            self.invalidateFilter()
+
+    def update_filter(self):
+        """
+        Computes visibility of all friends again
+        """
+        self.sourceModel().update_visibility()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self.sourceModel().get_friend(source_row).visibility
+
+
+class FriendDelegate(QtGui.QStyledItemDelegate):
+    """
+    Paints contact in friends list: avatar, name, status message, connection status and unread messages count.
+    Only visible rows are painted
+    """
+
+    def __init__(self, model, parent=None):
+        """
+        :param model: FriendsListModel instance, keeps avatars of painted friends
+        """
+        super(FriendDelegate, self).__init__(parent)
+        self._model = model
+        self._name_font = QtGui.QFont()
+        self._name_font.setFamily("Times New Roman")
+        self._name_font.setPointSize(12)
+        self._name_font.setBold(True)
+        self._status_message_font = QtGui.QFont(self._name_font)
+        self._status_message_font.setPointSize(10)
+        self._status_message_font.setBold(False)
+        self._count_font = QtGui.QFont(self._name_font)
+        self._status_images = {}  # name of image -> pixmap
+
+    def sizeHint(self, option, index):
+        return QtCore.QSize(250, 70)
+
+    def _get_status_image(self, status, unread_messages):
+        name = status_image_name(status, unread_messages)
+        if name not in self._status_images:
+            self._status_images[name] = QtGui.QPixmap(curr_directory() + '/images/{}.png'.format(name))
+        return self._status_images[name]
+
+    def paint(self, painter, option, index):
+        friend = index.data(FRIEND_ROLE)
+        if friend is None:
+            return
+        opt = QtGui.QStyleOptionViewItemV4(option)
+        self.initStyleOption(opt, index)
+        opt.text = ''
+        style = opt.widget.style() if opt.widget is not None else QtGui.QApplication.style()
+        style.drawControl(QtGui.QStyle.CE_ItemViewItem, opt, painter, opt.widget)  # background and selection
+
+        x, y = option.rect.x(), option.rect.y()
+        painter.save()
+        painter.drawPixmap(x + 3, y + 3, self._model.get_avatar(friend))
+
+        painter.setPen(opt.palette.color(QtGui.QPalette.Text))
+        painter.setFont(self._name_font)
+        painter.drawText(QtCore.QRect(x + 75, y + 10, 150, 25), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                         elided_text(friend.name, self._name_font, 150))
+        painter.setFont(self._status_message_font)
+        painter.drawText(QtCore.QRect(x + 75, y + 30, 170, 20), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                         elided_text(friend.status_message, self._status_message_font, 170))
+
+        unread = bool(friend.messages or friend.actions)
+        painter.drawPixmap(x + (230 if unread else 232), y + 5, self._get_status_image(friend.status, unread))
+
+        if friend.messages:
+            rect = QtCore.QRect(x + 52, y + 50, 30, 20)
+            painter.setRenderHint(QtGui.QPainter.Antialiasing)
+            painter.setPen(QtCore.Qt.NoPen)
+            painter.setBrush(QtGui.QColor(settings.Settings.get_instance()['unread_color']))
+            painter.drawRoundedRect(rect, 10, 10)
+            painter.setPen(QtGui.QColor('white'))
+            painter.setFont(self._count_font)
+            painter.drawText(rect, QtCore.Qt.AlignCenter, str(friend.messages))
+        painter.restore()
 
 
 class StatusCircle(QtGui.QWidget):
@@ -205,50 +557,14 @@ class StatusCircle(QtGui.QWidget):
             unread_messages = self.unread
         else:
             self.unread = unread_messages
-        if status == TOX_USER_STATUS['NONE']:
-            name = 'online'
-        elif status == TOX_USER_STATUS['AWAY']:
-            name = 'idle'
-        elif status == TOX_USER_STATUS['BUSY']:
-            name = 'busy'
-        else:
-            name = 'offline'
         if unread_messages:
-            name += '_notification'
             self.label.setGeometry(QtCore.QRect(0, 0, 32, 32))
         else:
             self.label.setGeometry(QtCore.QRect(2, 0, 32, 32))
-        pixmap = QtGui.QPixmap(curr_directory() + '/images/{}.png'.format(name))
+        pixmap = QtGui.QPixmap(curr_directory() + '/images/{}.png'.format(status_image_name(status, unread_messages)))
         self.label.setPixmap(pixmap)
 
 
-class UnreadMessagesCount(QtGui.QWidget):
-
-    def __init__(self, parent=None):
-        super(UnreadMessagesCount, self).__init__(parent)
-        self.resize(30, 20)
-        self.label = QtGui.QLabel(self)
-        self.label.setGeometry(QtCore.QRect(0, 0, 30, 20))
-        self.label.setVisible(False)
-        font = QtGui.QFont()
-        font.setFamily("Times New Roman")
-        font.setPointSize(12)
-        font.setBold(True)
-        self.label.setFont(font)
-        self.label.setAlignment(QtCore.Qt.AlignVCenter | QtCore.Qt.AlignCenter)
-        color = settings.Settings.get_instance()['unread_color']
-        self.label.setStyleSheet('QLabel { color: white; background-color: ' + color + '; border-radius: 10; }')
-
-    def update(self, messages_count):
-        color = settings.Settings.get_instance()['unread_color']
-        self.label.setStyleSheet('QLabel { color: white; background-color: ' + color + '; border-radius: 10; }')
-        if messages_count:
-            self.label.setVisible(True)
-            self.label.setText(str(messages_count))
-        else:
-            self.label.setVisible(False)
-
-
 class FileTransferItem(QtGui.QListWidget):
 
     def __init__(self, file_name, size, time, user, friend_number, file_number, state, width, parent=None):
@@ -448,8 +764,8 @@ class InlineImageItem(QtGui.QScrollArea):
         self._image_label.raise_()
         self.setWidget(self._image_label)
         self._image_label.setScaledContents(False)
-        self._pixmap = QtGui.QPixmap()
-        self._pixmap.loadFromData(data, 'PNG')
+        self._data = data
+        self._pixmap = pixmaps.get_image(data)  # decoded once for all pages of history
         self._max_size = width - 30
         self._resize_needed = not (self._pixmap.width() <= self._max_size)
         self._full_size = not self._resize_needed
@@ -458,7 +774,7 @@ class InlineImageItem(QtGui.QScrollArea):
             self.resize(QtCore.QSize(self._max_size + 5, self._pixmap.height() + 5))
             self._image_label.setGeometry(5, 0, self._pixmap.width(), self._pixmap.height())
         else:
-            pixmap = self._pixmap.scaled(self._max_size, self._max_size, QtCore.Qt.KeepAspectRatio)
+            pixmap = pixmaps.get_image(data, self._max_size)
             self._image_label.setPixmap(pixmap)
             self.resize(QtCore.QSize(self._max_size + 5, pixmap.height()))
             self._image_label.setGeometry(5, 0, self._max_size + 5, pixmap.height())
@@ -467,7 +783,7 @@ class InlineImageItem(QtGui.QScrollArea):
     def mouseReleaseEvent(self, event):
         if event.button() == QtCore.Qt.LeftButton and self._resize_needed:  # scale inline
             if self._full_size:
-                pixmap = self._pixmap.scaled(self._max_size, self._max_size, QtCore.Qt.KeepAspectRatio)
+                pixmap = pixmaps.get_image(self._data, self._max_size)
                 self._image_label.setPixmap(pixmap)
                 self.resize(QtCore.QSize(self._max_size, pixmap.height()))
                 self._image_label.setGeometry(5, 0, pixmap.width(), pixmap.height())
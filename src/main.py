@@ -15,6 +15,8 @@ import toxencryptsave
 from passwordscreen import PasswordScreen
 import profile
 from plugin_support import PluginLoader
+from file_io import FileIOPool
+from transfer_scheduler import TransferScheduler
 
 
 class Toxygen:
@@ -201,6 +203,8 @@ class Toxygen:
         plugin_helper = PluginLoader(self.tox, settings)  # plugin support
         plugin_helper.load()
 
+        file_io = FileIOPool()  # disk operations of file transfers
+
         # init thread
         self.init = self.InitThread(self.tox, self.ms, self.tray)
         self.init.start()
@@ -223,6 +227,7 @@ class Toxygen:
         self.mainloop.wait()
         self.init.wait()
         self.avloop.wait()
+        file_io.stop()
         data = self.tox.get_savedata()
         ProfileHelper.get_instance().save_profile(data)
         settings.close()
@@ -305,8 +310,10 @@ class Toxygen:
             self.stop = False
 
         def run(self):
+            scheduler = TransferScheduler.get_instance()
             while not self.stop:
                 self.tox.iterate()
+                scheduler.send_chunks()  # chunks delayed by rate limits or full packet queue
                 self.msleep(self.tox.iteration_interval())
 
     class ToxAVIterateThread(QtCore.QThread):
@@ -4,6 +4,7 @@ from menu import *
 from profile import *
 from list_items import *
 from widgets import MultilineEdit, LineEdit
+from animations import AnimationPlayer
 import plugin_support
 from mainscreen_widgets import *
 
@@ -50,10 +51,13 @@ class MainWindow(QtGui.QMainWindow):
         self.actionAbout_program.setObjectName("actionAbout_program")
         self.actionSettings = QtGui.QAction(MainWindow)
         self.actionSettings.setObjectName("actionSettings")
+        self.actionSearch_history = QtGui.QAction(MainWindow)
+        self.actionSearch_history.setObjectName("actionSearch_history")
         self.audioSettings = QtGui.QAction(MainWindow)
         self.pluginData = QtGui.QAction(MainWindow)
         self.menuProfile.addAction(self.actionAdd_friend)
         self.menuProfile.addAction(self.actionSettings)
+        self.menuProfile.addAction(self.actionSearch_history)
         self.menuSettings.addAction(self.actionPrivacy_settings)
         self.menuSettings.addAction(self.actionInterface_settings)
         self.menuSettings.addAction(self.actionNotifications)
@@ -70,6 +74,7 @@ class MainWindow(QtGui.QMainWindow):
         self.actionNetwork.triggered.connect(self.network_settings)
         self.actionAdd_friend.triggered.connect(self.add_contact)
         self.actionSettings.triggered.connect(self.profile_settings)
+        self.actionSearch_history.triggered.connect(self.search_history)
         self.actionPrivacy_settings.triggered.connect(self.privacy_settings)
         self.actionInterface_settings.triggered.connect(self.interface_settings)
         self.actionNotifications.triggered.connect(self.notification_settings)
@@ -99,6 +104,7 @@ class MainWindow(QtGui.QMainWindow):
         self.actionNetwork.setText(QtGui.QApplication.translate("MainWindow", "Network", None, QtGui.QApplication.UnicodeUTF8))
         self.actionAbout_program.setText(QtGui.QApplication.translate("MainWindow", "About program", None, QtGui.QApplication.UnicodeUTF8))
         self.actionSettings.setText(QtGui.QApplication.translate("MainWindow", "Settings", None, QtGui.QApplication.UnicodeUTF8))
+        self.actionSearch_history.setText(QtGui.QApplication.translate("MainWindow", "Search in history", None, QtGui.QApplication.UnicodeUTF8))
         self.audioSettings.setText(QtGui.QApplication.translate("MainWindow", "Audio", None, QtGui.QApplication.UnicodeUTF8))
         self.contact_name.setPlaceholderText(QtGui.QApplication.translate("MainWindow", "Search", None, QtGui.QApplication.UnicodeUTF8))
         self.sendMessageButton.setToolTip(QtGui.QApplication.translate("MainWindow", "Send message", None, QtGui.QApplication.UnicodeUTF8))
@@ -150,11 +156,15 @@ class MainWindow(QtGui.QMainWindow):
         self.contact_name = LineEdit(Form)
         self.contact_name.setGeometry(QtCore.QRect(0, 0, 150, 25))
         self.contact_name.setObjectName("contact_name")
-        self.contact_name.textChanged.connect(self.filtering)
+        self.filter_timer = QtCore.QTimer(self)  # filtering starts when user stops typing
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(200)
+        self.filter_timer.timeout.connect(self.filtering)
+        self.contact_name.textChanged.connect(lambda x: self.filter_timer.start())
 
         self.online_contacts = QtGui.QComboBox(Form)
         self.online_contacts.setGeometry(QtCore.QRect(150, 0, 120, 25))
-        self.online_contacts.activated[int].connect(lambda x: self.filtering())
+        self.online_contacts.activated[int].connect(self.show_online_changed)
         self.search_label.raise_()
 
         QtCore.QMetaObject.connectSlotsByName(Form)
@@ -229,7 +239,7 @@ class MainWindow(QtGui.QMainWindow):
         QtCore.QMetaObject.connectSlotsByName(Form)
 
     def setup_left_center(self, widget):
-        self.friends_list = QtGui.QListWidget(widget)
+        self.friends_list = QtGui.QListView(widget)  # model and delegate are set by profile
         self.friends_list.setObjectName("friends_list")
         self.friends_list.setGeometry(0, 0, 270, 310)
         self.friends_list.clicked.connect(self.friend_click)
@@ -237,6 +247,7 @@ class MainWindow(QtGui.QMainWindow):
         self.friends_list.connect(self.friends_list, QtCore.SIGNAL("customContextMenuRequested(QPoint)"),
                                   self.friend_right_click)
         self.friends_list.setVerticalScrollMode(QtGui.QAbstractItemView.ScrollPerPixel)
+        self.friends_list.setUniformItemSizes(True)
 
     def setup_right_center(self, widget):
         self.messages = QtGui.QListWidget(widget)
@@ -246,6 +257,9 @@ class MainWindow(QtGui.QMainWindow):
         self.messages.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
         self.messages.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
         self.messages.setFocusPolicy(QtCore.Qt.NoFocus)
+        self.messages.setItemDelegate(MessageDelegate(self.messages))
+        self.messages.setResizeMode(QtGui.QListView.Adjust)  # heights of messages depend on width
+        self.messages.setEditTriggers(QtGui.QAbstractItemView.DoubleClicked)
 
         def load(pos):
             if not pos:
@@ -260,6 +274,7 @@ class MainWindow(QtGui.QMainWindow):
         self.setGeometry(s['x'], s['y'], s['width'], s['height'])
         self.setWindowTitle('Toxygen')
         os.chdir(curr_directory() + '/images/')
+        AnimationPlayer()
         main = QtGui.QWidget()
         grid = QtGui.QGridLayout()
         search = QtGui.QWidget()
@@ -309,6 +324,19 @@ class MainWindow(QtGui.QMainWindow):
         self.retranslateUi()
         self.profile = Profile(tox, self)
 
+    def hideEvent(self, event):
+        AnimationPlayer.get_instance().set_paused(True)
+        super(MainWindow, self).hideEvent(event)
+
+    def showEvent(self, event):
+        AnimationPlayer.get_instance().set_paused(self.isMinimized())
+        super(MainWindow, self).showEvent(event)
+
+    def changeEvent(self, event):
+        if event.type() == QtCore.QEvent.WindowStateChange:  # window was minimized or restored
+            AnimationPlayer.get_instance().set_paused(self.isMinimized() or not self.isVisible())
+        super(MainWindow, self).changeEvent(event)
+
     def closeEvent(self, *args, **kwargs):
         self.profile.save_history()
         self.profile.close()
@@ -371,6 +399,10 @@ class MainWindow(QtGui.QMainWindow):
         self.p_s = ProfileSettings()
         self.p_s.show()
 
+    def search_history(self):
+        self.s_h = SearchHistory()
+        self.s_h.show()
+
     def privacy_settings(self):
         self.priv_s = PrivacySettings()
         self.priv_s.show()
@@ -466,13 +498,13 @@ class MainWindow(QtGui.QMainWindow):
     # -----------------------------------------------------------------------------------------------------------------
 
     def friend_right_click(self, pos):
-        item = self.friends_list.itemAt(pos)
-        num = self.friends_list.indexFromItem(item).row()
-        friend = Profile.get_instance().get_friend(num)
-        settings = Settings.get_instance()
-        allowed = friend.tox_id in settings['auto_accept_from_friends']
-        auto = QtGui.QApplication.translate("MainWindow", 'Disallow auto accept', None, QtGui.QApplication.UnicodeUTF8) if allowed else QtGui.QApplication.translate("MainWindow", 'Allow auto accept', None, QtGui.QApplication.UnicodeUTF8)
-        if item is not None:
+        index = self.friends_list.indexAt(pos)
+        if index.isValid():
+            num = self.profile.get_friend_row(index)
+            friend = Profile.get_instance().get_friend(num)
+            settings = Settings.get_instance()
+            allowed = friend.tox_id in settings['auto_accept_from_friends']
+            auto = QtGui.QApplication.translate("MainWindow", 'Disallow auto accept', None, QtGui.QApplication.UnicodeUTF8) if allowed else QtGui.QApplication.translate("MainWindow", 'Allow auto accept', None, QtGui.QApplication.UnicodeUTF8)
             self.listMenu = QtGui.QMenu()
             set_alias_item = self.listMenu.addAction(QtGui.QApplication.translate("MainWindow", 'Set alias', None, QtGui.QApplication.UnicodeUTF8))
             clear_history_item = self.listMenu.addAction(QtGui.QApplication.translate("MainWindow", 'Clear history', None, QtGui.QApplication.UnicodeUTF8))
@@ -538,7 +570,7 @@ class MainWindow(QtGui.QMainWindow):
     # -----------------------------------------------------------------------------------------------------------------
 
     def friend_click(self, index):
-        num = index.row()
+        num = self.profile.get_friend_row(index)
         self.profile.set_active(num)
 
     def mouseReleaseEvent(self, event):
@@ -550,5 +582,12 @@ class MainWindow(QtGui.QMainWindow):
             super(MainWindow, self).mouseReleaseEvent(event)
 
     def filtering(self):
+        self.filter_timer.stop()
         self.profile.filtration(self.online_contacts.currentIndex() == 1, self.contact_name.text())
 
+    def show_online_changed(self, index):
+        self.filtering()
+        settings = Settings.get_instance()
+        settings['show_online_friends'] = index == 1
+        settings.save()
+
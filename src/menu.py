@@ -6,6 +6,8 @@ from settings import *
 from profile import Profile
 from util import curr_directory
 from widgets import CenteredWidget, DataLabel, LineEdit
+from history import SNIPPET_START, SNIPPET_END
+import time
 import pyaudio
 import toxencryptsave
 import plugin_support
@@ -783,3 +785,56 @@ class PluginsSettings(CenteredWidget):
             self.button.setText(QtGui.QApplication.translate("PluginsForm", "Disable plugin", None, QtGui.QApplication.UnicodeUTF8))
         else:
             self.button.setText(QtGui.QApplication.translate("PluginsForm", "Enable plugin", None, QtGui.QApplication.UnicodeUTF8))
+
+
+class SearchHistory(CenteredWidget):
+    """
+    Full-text search over chat history
+    """
+
+    def __init__(self):
+        super(SearchHistory, self).__init__()
+        self.initUI()
+        self.center()
+        self.retranslateUi()
+
+    def initUI(self):
+        self.resize(500, 400)
+        self.setMinimumSize(QtCore.QSize(500, 400))
+        self.setMaximumSize(QtCore.QSize(500, 400))
+        self.text = LineEdit(self)
+        self.text.setGeometry(QtCore.QRect(10, 10, 370, 30))
+        self.text.returnPressed.connect(self.search)
+        self.button = QtGui.QPushButton(self)
+        self.button.setGeometry(QtCore.QRect(390, 10, 100, 30))
+        self.button.clicked.connect(self.search)
+        self.active_only = QtGui.QCheckBox(self)
+        self.active_only.setGeometry(QtCore.QRect(10, 45, 480, 20))
+        self.active_only.setEnabled(Profile.get_instance().get_active_number() != -1)
+        self.results = QtGui.QListWidget(self)
+        self.results.setGeometry(QtCore.QRect(10, 70, 480, 320))
+        self.results.itemActivated.connect(self.show_result)
+        self.results.itemClicked.connect(self.show_result)
+        self.data = []
+
+    def retranslateUi(self):
+        self.setWindowTitle(QtGui.QApplication.translate('SearchHistory', "Search in history", None, QtGui.QApplication.UnicodeUTF8))
+        self.button.setText(QtGui.QApplication.translate('SearchHistory', "Search", None, QtGui.QApplication.UnicodeUTF8))
+        self.active_only.setText(QtGui.QApplication.translate('SearchHistory', "Search in history of active friend only", None, QtGui.QApplication.UnicodeUTF8))
+        self.text.setPlaceholderText(QtGui.QApplication.translate('SearchHistory', "Words to search", None, QtGui.QApplication.UnicodeUTF8))
+
+    def search(self):
+        profile = Profile.get_instance()
+        tox_id = None
+        if self.active_only.isChecked() and profile.get_active_number() != -1:
+            tox_id = profile.friend_public_key(profile.get_active())
+        self.data = profile.search_history(self.text.text(), tox_id)
+        self.results.clear()
+        for friend, unix_time, snippet in self.data:
+            snippet = snippet.replace(SNIPPET_START, '').replace(SNIPPET_END, '').replace('\n', ' ')
+            message_time = time.strftime('%d.%m.%Y %H:%M', time.localtime(unix_time))
+            self.results.addItem('{} [{}]: {}'.format(friend.name, message_time, snippet))
+
+    def show_result(self, item):
+        friend, unix_time, snippet = self.data[self.results.row(item)]
+        Profile.get_instance().show_message(friend, unix_time)
@@ -0,0 +1,73 @@
+import html as h
+import re
+from functools import lru_cache
+import smileys
+from toxcore_enums_and_consts import TOX_MESSAGE_TYPE
+
+
+CACHE_SIZE = 4096  # rendered messages, about 100 pages of history
+
+# links in text of message
+LINKS = re.compile(
+    r'(?:\b)((www\.)|(http[s]?|ftp)://)\w+\S+'
+    r'|(?:\b)(file:///)([\S| ]*)'
+    r'|(?:\b)(tox:[a-zA-Z\d]{76}\Z)'
+    r'|(?:\b)(mailto:\S+@\S+\.\S+)'
+    r'|(?:\b)(tox:\S+@\S+)')
+
+# lines which start with '>' (escaped)
+QUOTES = re.compile(r'^&gt;(.*)$', re.MULTILINE)
+
+
+def _link(match):
+    url = h.escape(match.group(0))
+    if match.group(1) == 'www.':
+        return '<a href="http://{0}">{0}</a>'.format(url)
+    return '<a href="{0}">{0}</a>'.format(url)
+
+
+def _add_smileys(text, loader, animated):
+    """
+    :return: escaped text with smileys. File names of found animated smileys are added to list animated
+    """
+    if loader is None:
+        return h.escape(text)
+    text, found = loader.add_smileys_to_text(text)
+    animated.extend(found)
+    return text
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _render(text, message_type, smileys_pack):
+    """
+    :param smileys_pack: id of current smileys pack, part of key in cache
+    """
+    loader = smileys.SmileyLoader.get_instance()
+    parts, animated, position = [], [], 0
+    for match in LINKS.finditer(text):  # text between links is escaped, smileys are added to it
+        parts.append(_add_smileys(text[position:match.start()], loader, animated))
+        parts.append(_link(match))
+        position = match.end()
+    parts.append(_add_smileys(text[position:], loader, animated))
+    text = ''.join(parts)
+    if '&gt;' in text:
+        text = QUOTES.sub(r'<font color="green"><b>\1</b></font>', text)
+    text = text.replace('\n', '<br>')
+    if message_type != TOX_MESSAGE_TYPE['NORMAL']:
+        text = '<p align="center" style="color: #5CB3FF; font: italic; font-size: 20px;" >' + text + '</p>'
+    return text, tuple(animated)
+
+
+def render_message(text, message_type=TOX_MESSAGE_TYPE['NORMAL']):
+    """
+    Converts text of message to html: adds links, quotes and smileys. Results are cached
+    :param text: text of message
+    :param message_type: type of message. Not normal messages are centered and highlighted
+    :return: tuple (html, tuple of file names of animated smileys in html)
+    """
+    loader = smileys.SmileyLoader.get_instance()
+    return _render(text, message_type, loader.get_pack_id() if loader is not None else None)
+
+
+def clear_cache():
+    _render.cache_clear()
@@ -10,6 +10,11 @@ MESSAGE_TYPE = {
 
 
 class Message:
+    """
+    Base class of messages. All messages have fixed set of fields (__slots__) - no per-instance dict
+    """
+
+    __slots__ = ('_time', '_type', '_owner')
 
     def __init__(self, message_type, owner, time):
         self._time = time
@@ -22,6 +27,9 @@ class Message:
     def get_owner(self):
         return self._owner
 
+    def get_time(self):
+        return self._time
+
     def mark_as_sent(self):
         self._owner = 0
 
@@ -31,10 +39,28 @@ class TextMessage(Message):
     Plain text or action message
     """
 
+    __slots__ = ('_message', )
+
     def __init__(self, message, owner, time, message_type):
         super(TextMessage, self).__init__(message_type, owner, time)
         self._message = message
 
+    @staticmethod
+    def from_db(rows):
+        """
+        Bulk constructor. Fields are set directly, constructors are not called
+        :param rows: iterable of tuples (message, owner, unix_time, message_type) from db
+        :return: list of messages in the same order
+        """
+        new = TextMessage.__new__
+        messages = []
+        append = messages.append
+        for message, owner, unix_time, message_type in rows:
+            m = new(TextMessage)
+            m._message, m._owner, m._time, m._type = message, owner, unix_time, message_type
+            append(m)
+        return messages
+
     def get_data(self):
         return self._message, self._owner, self._time, self._type
 
@@ -44,6 +70,8 @@ class TransferMessage(Message):
     Message with info about file transfer
     """
 
+    __slots__ = ('_status', '_size', '_file_name', '_friend_number', '_file_number')
+
     def __init__(self, owner, time, status, size, name, friend_number, file_number):
         super(TransferMessage, self).__init__(MESSAGE_TYPE['FILE_TRANSFER'], owner, time)
         self._status = status
@@ -71,6 +99,9 @@ class TransferMessage(Message):
 
 
 class UnsentFile(Message):
+
+    __slots__ = ('_data', '_path')
+
     def __init__(self, path, data, time):
         super(UnsentFile, self).__init__(MESSAGE_TYPE['FILE_TRANSFER'], 0, time)
         self._data, self._path = data, path
@@ -87,6 +118,8 @@ class InlineImage(Message):
     Inline image
     """
 
+    __slots__ = ('_data', )
+
     def __init__(self, data):
         super(InlineImage, self).__init__(MESSAGE_TYPE['INLINE'], None, None)
         self._data = data
@@ -97,5 +130,7 @@ class InlineImage(Message):
 
 class InfoMessage(TextMessage):
 
+    __slots__ = ()
+
     def __init__(self, message, time):
         super(InfoMessage, self).__init__(message, None, time, MESSAGE_TYPE['INFO_MESSAGE'])
@@ -0,0 +1,165 @@
+try:
+    from PySide import QtCore, QtGui
+except ImportError:
+    from PyQt4 import QtCore, QtGui
+from collections import OrderedDict
+import hashlib
+import os
+
+
+AVATAR_SIZES = (64, 32)  # avatars are kept only in these sizes
+MEMORY_LIMIT = 64 * 1024 * 1024  # bytes of decoded pixmaps in cache
+
+
+class LRUCache:
+    """
+    Keeps values with known cost. Least recently used values are evicted when total cost exceeds limit
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: max total cost of values
+        """
+        self._limit = limit
+        self._cost = 0
+        self._values = OrderedDict()  # key -> tuple (value, cost), least recently used first
+
+    def get(self, key):
+        """
+        :return: value or None if key is not in cache
+        """
+        if key not in self._values:
+            return None
+        self._values.move_to_end(key)
+        return self._values[key][0]
+
+    def put(self, key, value, cost):
+        self.pop(key)
+        self._values[key] = (value, cost)
+        self._cost += cost
+        while self._cost > self._limit and len(self._values) > 1:
+            self._cost -= self._values.popitem(last=False)[1][1]
+
+    def pop(self, key):
+        if key in self._values:
+            self._cost -= self._values.pop(key)[1]
+
+    def clear(self):
+        self._values.clear()
+        self._cost = 0
+
+    def get_cost(self):
+        return self._cost
+
+    cost = property(get_cost)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+
+# -----------------------------------------------------------------------------------------------------------------
+# Process-wide cache of decoded pixmaps. Keys are (hash of encoded image, size), so same image is decoded once
+# -----------------------------------------------------------------------------------------------------------------
+
+_pixmaps = LRUCache(MEMORY_LIMIT)
+_files = {}  # path -> tuple (modification time, size, hash of content)
+
+
+def _cost(pixmap):
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
+def _digest(data):
+    return hashlib.sha1(data).digest()
+
+
+def _file_digest(path):
+    """
+    Content of file is read and hashed only if file was changed
+    :return: tuple (hash of content, content or None if file was not read)
+    """
+    stat = os.stat(path)
+    known = _files.get(path)
+    if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+        return known[2], None
+    with open(path, 'rb') as fl:
+        data = fl.read()
+    digest = _digest(data)
+    _files[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest, data
+
+
+def get_file_digest(path):
+    """
+    :return: hash of content of file. File is read only if it was changed
+    """
+    return _file_digest(path)[0]
+
+
+def forget_file(path):
+    """
+    Next request of file will read it again. Called when file is rewritten
+    """
+    _files.pop(path, None)
+
+
+def get_avatar(path, size=AVATAR_SIZES[0], digest=None):
+    """
+    Avatar is decoded once and scaled to all sizes from AVATAR_SIZES, original is not kept
+    :param path: path to png
+    :param size: one of AVATAR_SIZES
+    :param digest: hash of file from get_file_digest or None. With digest file is accessed only if avatar
+    isn't in cache
+    :return: QPixmap scaled to size x size with kept aspect ratio
+    """
+    digest, data = (digest, None) if digest is not None else _file_digest(path)
+    pixmap = _pixmaps.get((digest, size))
+    if pixmap is not None:
+        return pixmap
+    if data is None:  # avatar was evicted from cache
+        with open(path, 'rb') as fl:
+            data = fl.read()
+    original = QtGui.QPixmap()
+    original.loadFromData(data, 'PNG')
+    for s in AVATAR_SIZES:
+        scaled = original.scaled(s, s, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        _pixmaps.put((digest, s), scaled, _cost(scaled))
+        if s == size:
+            pixmap = scaled
+    return pixmap if pixmap is not None else original.scaled(size, size, QtCore.Qt.KeepAspectRatio)
+
+
+def get_image(data, size=None):
+    """
+    :param data: encoded png
+    :param size: max width or None for original size
+    :return: QPixmap. Image is scaled to size x size with kept aspect ratio only if it's wider than size
+    """
+    digest = _digest(data)
+    original = _pixmaps.get((digest, None))
+    if original is None:
+        original = QtGui.QPixmap()
+        original.loadFromData(data, 'PNG')
+        _pixmaps.put((digest, None), original, _cost(original))
+    if size is None or original.width() <= size:
+        return original
+    pixmap = _pixmaps.get((digest, size))
+    if pixmap is None:
+        pixmap = original.scaled(size, size, QtCore.Qt.KeepAspectRatio)
+        _pixmaps.put((digest, size), pixmap, _cost(pixmap))
+    return pixmap
+
+
+def get_stats():
+    """
+    :return: tuple (number of pixmaps in cache, bytes used by them)
+    """
+    return len(_pixmaps), _pixmaps.cost
+
+
+def clear():
+    _pixmaps.clear()
+    _files.clear()
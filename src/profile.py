@@ -11,6 +11,8 @@ from util import log, Singleton, curr_directory
 from tox_dns import tox_dns
 from history import *
 from file_transfers import *
+from file_io import IntervalSet
+from transfer_scheduler import TransferScheduler
 import time
 import calls
 import avwidgets
@@ -36,29 +38,46 @@ class Profile(contact.Contact, Singleton):
         self._messages = screen.messages
         self._tox = tox
         self._file_transfers = {}  # dict of file transfers. key - tuple (friend_number, file_number)
+        self._paused_transfers = {}  # (friend_number, file_number) -> file id of transfers suspended in this session
+        self._scheduler = TransferScheduler(error_handler=self.outgoing_transfer_failed)  # sends outgoing chunks
         self._call = calls.AV(tox.AV)  # object with data about calls
         self._incoming_calls = set()
         settings = Settings.get_instance()
         self._show_online = settings['show_online_friends']
         screen.online_contacts.setCurrentIndex(int(self._show_online))
-        aliases = settings['friends_aliases']
-        data = tox.self_get_friend_list()
         self._history = History(tox.self_get_public_key())  # connection to db
+        self.migrate_history()
+        self.load_friends(tox)
+        self.prune_paused_transfers()
+        self.set_upload_limits()
+        self.filtration(self._show_online)
+
+    def load_friends(self, tox):
+        """
+        Creates list of friends and model of friends list. Friends have no widgets, visible rows are painted by delegate
+        """
+        aliases = dict(Settings.get_instance()['friends_aliases'])  # tox id -> alias
+        data = tox.self_get_friend_list()
         self._friends, self._active_friend = [], -1
-        for i in data:  # creates list of friends
+        self._friends_by_number = {}  # friend number -> friend, used by callbacks
+        for i in data:
             tox_id = tox.friend_get_public_key(i)
-            try:
-                alias = list(filter(lambda x: x[0] == tox_id, aliases))[0][1]
-            except:
-                alias = ''
-            item = self.create_friend_item()
+            alias = aliases.get(tox_id, '')
             name = alias or tox.friend_get_name(i) or tox_id
             status_message = tox.friend_get_status_message(i)
             message_getter = self._history.messages_getter(tox_id)
-            friend = Friend(message_getter, i, name, status_message, item, tox_id)
+            friend = Friend(message_getter, i, name, status_message, None, tox_id)
             friend.set_alias(alias)
             self._friends.append(friend)
-        self.filtration(self._show_online)
+            self._friends_by_number[i] = friend
+        self._friends_model = FriendsListModel()
+        self._friends_model.set_friends(self._friends)  # model shares list of friends with profile
+        self._friends_proxy = FriendsFilterProxyModel()
+        self._friends_proxy.setSourceModel(self._friends_model)
+        friends_list = self._screen.friends_list
+        friends_list.setModel(self._friends_proxy)
+        friends_list.setItemDelegate(FriendDelegate(self._friends_model, friends_list))
+        self.update_corr_limits()
 
     # -----------------------------------------------------------------------------------------------------------------
     # Edit current user's data
@@ -108,31 +127,29 @@ class Profile(contact.Contact, Singleton):
 
     def filtration(self, show_online=True, filter_str=''):
         """
-        Filtration of friends list
+        Filtration of friends list. Rows of friends whose data was changed are filtered again by model automatically
         :param show_online: show online only contacts
         :param filter_str: show contacts which name contains this substring
         """
         filter_str = filter_str.lower()
-        for index, friend in enumerate(self._friends):
-            friend.visibility = (friend.status is not None or not show_online) and (filter_str in friend.name.lower())
-            friend.visibility = friend.visibility or friend.messages or friend.actions
-            if friend.visibility:
-                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, 70))
-            else:
-                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, 0))
+        self._friends_proxy.set_filter(show_online, filter_str)
         self._show_online, self._filter_string = show_online, filter_str
-        settings = Settings.get_instance()
-        settings['show_online_friends'] = self._show_online
-        settings.save()
 
     def update_filtration(self):
         """
-        Update list of contacts when 1 of friends change connection status
+        Filter all friends again
+        """
+        self._friends_proxy.update_filter()
+
+    def get_friend_row(self, index):
+        """
+        :param index: index of row in friends list view
+        :return: number of friend in friends list
         """
-        self.filtration(self._show_online, self._filter_string)
+        return self._friends_proxy.mapToSource(index).row()
 
     def get_friend_by_number(self, num):
-        return list(filter(lambda x: x.number == num, self._friends))[0]
+        return self._friends_by_number[num]
 
     def get_friend(self, num):
         return self._friends[num]
@@ -166,15 +183,17 @@ class Profile(contact.Contact, Singleton):
                 if self._active_friend + 1:
                     try:
                         self._friends[self._active_friend].curr_text = self._screen.messageEdit.toPlainText()
+                        self._friends[self._active_friend].set_corr_limit(self._corr_limit)
                     except:
                         pass
                 self._active_friend = value
                 friend = self._friends[value]
+                friend.set_corr_limit(None)  # all shown messages are kept in memory
                 self._friends[value].reset_messages()
                 self._screen.messageEdit.setPlainText(friend.curr_text)
                 self._messages.clear()
                 friend.load_corr()
-                messages = friend.get_corr()[-PAGE_SIZE:]
+                messages = friend.get_last_corr(PAGE_SIZE)
                 for message in messages:
                     if message.get_type() <= 1:
                         data = message.get_data()
@@ -214,14 +233,8 @@ class Profile(contact.Contact, Singleton):
 
             self._screen.account_name.setText(friend.name)
             self._screen.account_status.setText(friend.status_message)
-            avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(friend.tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-            if not os.path.isfile(avatar_path):  # load default image
-                avatar_path = curr_directory() + '/images/avatar.png'
-            os.chdir(os.path.dirname(avatar_path))
-            pixmap = QtGui.QPixmap(QtCore.QSize(64, 64))
-            pixmap.load(avatar_path)
             self._screen.account_avatar.setScaledContents(False)
-            self._screen.account_avatar.setPixmap(pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio))
+            self._screen.account_avatar.setPixmap(friend.get_pixmap())
             self._screen.account_avatar.repaint()  # comment?
         except Exception as ex:  # no friend found. ignore
             log('Friend value: ' + str(value))
@@ -276,6 +289,7 @@ class Profile(contact.Contact, Singleton):
                 else:
                     self.send_file(data[0], friend_number, True)
             friend.clear_unsent_files()
+            self.resume_transfers(friend_number)
             if friend_number == self.get_active_number():
                 self.update()
         except Exception as ex:
@@ -285,11 +299,11 @@ class Profile(contact.Contact, Singleton):
         """
         Friend with specified number quit
         """
-        # TODO: fix and add full file resuming support
         self.get_friend_by_number(friend_number).status = None
         self.friend_typing(friend_number, False)
         if friend_number in self._call:
             self._call.finish_call(friend_number, True)
+        self.suspend_transfers(friend_number)
 
     # -----------------------------------------------------------------------------------------------------------------
     # Typing notifications
@@ -317,7 +331,7 @@ class Profile(contact.Contact, Singleton):
 
     def receipt(self):
         i = 0
-        while i < self._messages.count() and not self._messages.itemWidget(self._messages.item(i)).mark_as_sent():
+        while i < self._messages.count() and not mark_message_as_sent(self._messages.item(i)):
             i += 1
 
     def send_messages(self, friend_number):
@@ -375,8 +389,6 @@ class Profile(contact.Contact, Singleton):
             friend.inc_messages()
             friend.append_message(
                 TextMessage(message, MESSAGE_OWNER['FRIEND'], time.time(), message_type))
-            if not friend.visibility:
-                self.update_filtration()
 
     def send_message(self, text):
         """
@@ -419,18 +431,20 @@ class Profile(contact.Contact, Singleton):
         s = Settings.get_instance()
         if hasattr(self, '_history'):
             if s['save_history']:
-                for friend in self._friends:
-                    if not self._history.friend_exists_in_db(friend.tox_id):
-                        self._history.add_friend_to_db(friend.tox_id)
-                    if not s['save_unsent_only']:
-                        messages = friend.get_corr_for_saving()
-                    else:
-                        messages = friend.get_unsent_messages_for_saving()
-                        self._history.delete_messages(friend.tox_id)
-                    self._history.save_messages_to_db(friend.tox_id, messages)
-                    unsent_messages = friend.get_unsent_messages()
-                    unsent_time = unsent_messages[0].get_data()[2] if len(unsent_messages) else time.time() + 1
-                    self._history.update_messages(friend.tox_id, unsent_time)
+                self._history.flush()  # only small tail of messages is written by background writer
+                with self._history.transaction():  # one commit for all friends
+                    for friend in self._friends:
+                        if not self._history.friend_exists_in_db(friend.tox_id):
+                            self._history.add_friend_to_db(friend.tox_id)
+                        if not s['save_unsent_only']:
+                            messages = friend.get_corr_for_saving()
+                        else:
+                            messages = friend.get_unsent_messages_for_saving()
+                            self._history.delete_messages(friend.tox_id)
+                        self._history.save_messages_to_db(friend.tox_id, messages)
+                        unsent_messages = friend.get_unsent_messages()
+                        unsent_time = unsent_messages[0].get_data()[2] if len(unsent_messages) else time.time() + 1
+                        self._history.update_messages(friend.tox_id, unsent_time)
             self._history.save()
             del self._history
 
@@ -456,11 +470,8 @@ class Profile(contact.Contact, Singleton):
         """
         friend = self._friends[self._active_friend]
         friend.load_corr(False)
-        data = friend.get_corr()
-        if not data:
-            return
+        data = friend.get_last_corr(PAGE_SIZE, self._messages.count())
         data.reverse()
-        data = data[self._messages.count():self._messages.count() + PAGE_SIZE]
         for message in data:
             if message.get_type() <= 1:  # text message
                 data = message.get_data()
@@ -490,25 +501,60 @@ class Profile(contact.Contact, Singleton):
                                          '',
                                          data[3])
 
+    def update_corr_limits(self):
+        """
+        Spreads memory budget for messages across all friends. Messages of active friend are not limited
+        """
+        budget = Settings.get_instance()['messages_in_memory']
+        self._corr_limit = max(2 * PAGE_SIZE, budget // max(len(self._friends), 1))
+        for i, friend in enumerate(self._friends):
+            friend.set_corr_limit(self._corr_limit if i != self._active_friend else None)
+
+    def search_history(self, text, tox_id=None):
+        """
+        Full-text search over chat history
+        :param text: words to search
+        :param tox_id: search in history of this friend only. None - search in history of all friends
+        :return: list of tuples (friend, unix_time, snippet)
+        """
+        friends = dict((friend.tox_id, friend) for friend in self._friends)
+        results = self._history.search(text, tox_id)
+        return [(friends[r[0]], r[1], r[2]) for r in results if r[0] in friends]
+
+    def show_message(self, friend, unix_time):
+        """
+        Makes friend active and shows messages around message with given time
+        """
+        self.set_active(self._friends.index(friend))
+        friend.load_corr_around(unix_time)
+        corr = friend.get_corr()
+        try:
+            index = next(i for i, m in enumerate(corr) if m.get_type() <= 1 and m.get_data()[2] == unix_time)
+        except StopIteration:  # message was deleted
+            return
+        while self._messages.count() < len(corr) - index:
+            count = self._messages.count()
+            self.load_history()
+            if count == self._messages.count():
+                break
+        item = self._messages.item(self._messages.count() - (len(corr) - index))
+        if item is not None:
+            self._messages.scrollToItem(item, QtGui.QAbstractItemView.PositionAtCenter)
+
+    def migrate_history(self):
+        """
+        Moves history to new db schema batch by batch without blocking UI
+        """
+        if hasattr(self, '_history') and not self._history.migrate():
+            QtCore.QTimer.singleShot(0, self.migrate_history)
+
     def export_history(self, directory):
         self._history.export(directory)
 
     # -----------------------------------------------------------------------------------------------------------------
-    # Factories for friend, message and file transfer items
+    # Factories for message and file transfer items
     # -----------------------------------------------------------------------------------------------------------------
 
-    def create_friend_item(self):
-        """
-        Method-factory
-        :return: new widget for friend instance
-        """
-        item = ContactItem()
-        elem = QtGui.QListWidgetItem(self._screen.friends_list)
-        elem.setSizeHint(QtCore.QSize(250, 70))
-        self._screen.friends_list.addItem(elem)
-        self._screen.friends_list.setItemWidget(elem, item)
-        return item
-
     def create_message_item(self, text, time, owner, message_type, append=True):
         if message_type == MESSAGE_TYPE['INFO_MESSAGE']:
             name = ''
@@ -516,14 +562,13 @@ class Profile(contact.Contact, Singleton):
             name = self.get_active_name()
         else:
             name = self._name
-        item = MessageItem(text, time, name, owner != MESSAGE_OWNER['NOT_SENT'], message_type, self._messages)
-        elem = QtGui.QListWidgetItem()
-        elem.setSizeHint(QtCore.QSize(self._messages.width(), item.height()))
+        elem = QtGui.QListWidgetItem()  # row is painted by MessageDelegate, no widget is created
+        elem.setData(MESSAGE_ROLE, (text, time, name, owner != MESSAGE_OWNER['NOT_SENT'], message_type))
+        elem.setFlags(elem.flags() | QtCore.Qt.ItemIsEditable)  # double click opens editor for text selection
         if append:
             self._messages.addItem(elem)
         else:
             self._messages.insertItem(0, elem)
-        self._messages.setItemWidget(elem, item)
 
     def create_file_transfer_item(self, tm, append=True):
         data = list(tm.get_data())
@@ -631,8 +676,10 @@ class Profile(contact.Contact, Singleton):
         if self._history.friend_exists_in_db(friend.tox_id):
             self._history.delete_friend_from_db(friend.tox_id)
         self._tox.friend_delete(friend.number)
-        del self._friends[num]
-        self._screen.friends_list.takeItem(num)
+        self._friends_model.remove_friend(num)
+        del self._friends_by_number[friend.number]
+        self.update_corr_limits()
+        self.set_upload_limits()
         if num == self._active_friend:  # active friend was deleted
             if not len(self._friends):  # last friend was deleted
                 self.set_active(-1)
@@ -646,7 +693,6 @@ class Profile(contact.Contact, Singleton):
         Adds friend to list
         """
         num = self._tox.friend_add_norequest(tox_id)  # num - friend number
-        item = self.create_friend_item()
         try:
             if not self._history.friend_exists_in_db(tox_id):
                 self._history.add_friend_to_db(tox_id)
@@ -654,8 +700,11 @@ class Profile(contact.Contact, Singleton):
         except Exception as ex:  # something is wrong
             log('Accept friend request failed! ' + str(ex))
             message_getter = None
-        friend = Friend(message_getter, num, tox_id, '', item, tox_id)
-        self._friends.append(friend)
+        friend = Friend(message_getter, num, tox_id, '', None, tox_id)
+        self._friends_model.append_friend(friend)
+        self._friends_by_number[num] = friend
+        self.update_corr_limits()
+        self.set_upload_limits()
 
     def block_user(self, tox_id):
         """
@@ -717,12 +766,14 @@ class Profile(contact.Contact, Singleton):
             else:
                 result = self._tox.friend_add(tox_id, message.encode('utf-8'))
                 tox_id = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
-                item = self.create_friend_item()
                 if not self._history.friend_exists_in_db(tox_id):
                     self._history.add_friend_to_db(tox_id)
                 message_getter = self._history.messages_getter(tox_id)
-                friend = Friend(message_getter, result, tox_id, '', item, tox_id)
-                self._friends.append(friend)
+                friend = Friend(message_getter, result, tox_id, '', None, tox_id)
+                self._friends_model.append_friend(friend)
+                self._friends_by_number[result] = friend
+                self.update_corr_limits()
+                self.set_upload_limits()
             data = self._tox.get_savedata()
             ProfileHelper.get_instance().save_profile(data)
             return True
@@ -757,22 +808,23 @@ class Profile(contact.Contact, Singleton):
         Recreate tox instance
         :param restart: method which calls restart and returns new tox instance
         """
-        for key in self._file_transfers.keys():
-            self._file_transfers[key].cancel()
-            del self._file_transfers[key]
+        self.suspend_transfers()
         self._call.stop()
         del self._tox
         self._tox = restart()
         self.status = None
         for friend in self._friends:
             friend.status = None
+        # friend numbers are restored from savedata, index is rebuilt to stay in step with them
+        self._friends_by_number = dict((friend.number, friend) for friend in self._friends)
 
     def close(self):
+        self.suspend_transfers()
         if hasattr(self, '_call'):
             self._call.stop()
             del self._call
-        for i in range(len(self._friends)):
-            del self._friends[0]
+        self._friends_by_number.clear()
+        self._friends_model.clear()
 
     # -----------------------------------------------------------------------------------------------------------------
     # File transfers support
@@ -790,7 +842,21 @@ class Profile(contact.Contact, Singleton):
         friend = self.get_friend_by_number(friend_number)
         auto = settings['allow_auto_accept'] and friend.tox_id in settings['auto_accept_from_friends']
         inline = (file_name in ALLOWED_FILES) and settings['allow_inline']
-        if inline and size < 1024 * 1024:
+        file_id = self._tox.file_get_file_id(friend_number, file_number)
+        paused = settings['paused_file_transfers'].get(file_id)
+        resumed = paused is not None and paused[4] and paused[1] == friend.tox_id and paused[2] == size and \
+            os.path.isfile(paused[0])  # same file was partially received before
+        if resumed:
+            self.remove_paused_transfer_message(friend_number, file_id)
+            self.accept_transfer(None, paused[0], friend_number, file_number, size, received=paused[3])
+            tm = TransferMessage(MESSAGE_OWNER['FRIEND'],
+                                 time.time(),
+                                 TOX_FILE_TRANSFER_STATE['RUNNING'],
+                                 size,
+                                 os.path.basename(paused[0]),
+                                 friend_number,
+                                 file_number)
+        elif inline and size < 1024 * 1024:
             self.accept_transfer(None, '', friend_number, file_number, size, True)
             tm = TransferMessage(MESSAGE_OWNER['FRIEND'],
                                  time.time(),
@@ -830,7 +896,7 @@ class Profile(contact.Contact, Singleton):
                                  file_number)
         if friend_number == self.get_active_number():
             item = self.create_file_transfer_item(tm)
-            if (inline and size < 1024 * 1024) or auto:
+            if (inline and size < 1024 * 1024) or auto or resumed:
                 self._file_transfers[(friend_number, file_number)].set_state_changed_handler(item.update)
             self._messages.scrollToBottom()
         else:
@@ -853,11 +919,14 @@ class Profile(contact.Contact, Singleton):
                 tr.cancel()
             else:
                 tr.cancelled()
+            self._scheduler.remove(tr)
             if (friend_number, file_number) in self._file_transfers:
                 del tr
                 del self._file_transfers[(friend_number, file_number)]
         else:
-            if not already_cancelled:
+            if (friend_number, file_number) in self._paused_transfers:  # suspended, friend is offline
+                self.forget_paused_transfer(self._paused_transfers.pop((friend_number, file_number)))
+            elif not already_cancelled:
                 self._tox.file_control(friend_number, file_number, TOX_FILE_CONTROL['CANCEL'])
             if friend_number == self.get_active_number():
                 tmp = self._messages.count() + i
@@ -895,7 +964,7 @@ class Profile(contact.Contact, Singleton):
         else:  # send seek control?
             tr.send_control(TOX_FILE_CONTROL['RESUME'])
 
-    def accept_transfer(self, item, path, friend_number, file_number, size, inline=False):
+    def accept_transfer(self, item, path, friend_number, file_number, size, inline=False, received=None):
         """
         :param item: transfer item.
         :param path: path for saving
@@ -903,12 +972,18 @@ class Profile(contact.Contact, Singleton):
         :param file_number: file number
         :param size: file size
         :param inline: is inline image
+        :param received: list of ranges of file received before or None
         """
         if not inline:
-            rt = ReceiveTransfer(path, self._tox, friend_number, size, file_number)
+            rt = ReceiveTransfer(path, self._tox, friend_number, size, file_number,
+                                 IntervalSet(received) if received is not None else None)
+            self.forget_paused_transfer(rt.get_file_id())  # file id is saved for resuming
         else:
             rt = ReceiveToBuffer(self._tox, friend_number, size, file_number)
         self._file_transfers[(friend_number, file_number)] = rt
+        self._paused_transfers.pop((friend_number, file_number), None)
+        if received is not None:
+            self._tox.file_seek(friend_number, file_number, rt.get_resume_position())
         self._tox.file_control(friend_number, file_number, TOX_FILE_CONTROL['RESUME'])
         if item is not None:
             rt.set_state_changed_handler(item.update)
@@ -951,14 +1026,15 @@ class Profile(contact.Contact, Singleton):
         st.set_state_changed_handler(item.update)
         self._messages.scrollToBottom()
 
-    def send_file(self, path, number=None, is_resend=False):
+    def send_file(self, path, number=None, is_resend=False, file_id=None):
         """
-        Send file to current active friend
+        Send file to friend
         :param path: file path
-        :param number: friend_number
+        :param number: friend_number or None for active friend
         :param is_resend: is 'offline' message
+        :param file_id: file id of suspended transfer of same file or None
         """
-        friend_number = number or self.get_active_number()
+        friend_number = number if number is not None else self.get_active_number()
         friend = self.get_friend_by_number(friend_number)
         if friend.status is None and not is_resend:
             m = UnsentFile(path, None, time.time())
@@ -968,8 +1044,12 @@ class Profile(contact.Contact, Singleton):
         elif friend.status is None and is_resend:
             print('Error in sending')
             raise RuntimeError()
-        st = SendTransfer(path, self._tox, friend_number)
+        if file_id is not None:
+            self.remove_paused_transfer_message(friend_number, file_id)
+        st = SendTransfer(path, self._tox, friend_number, TOX_FILE_KIND['DATA'], file_id)
+        st.get_file_id()  # saved for resuming
         self._file_transfers[(friend_number, st.get_file_number())] = st
+        self._paused_transfers.pop((friend_number, st.get_file_number()), None)
         tm = TransferMessage(MESSAGE_OWNER['ME'],
                              time.time(),
                              TOX_FILE_TRANSFER_STATE['OUTGOING_NOT_STARTED'],
@@ -977,10 +1057,11 @@ class Profile(contact.Contact, Singleton):
                              os.path.basename(path),
                              friend_number,
                              st.get_file_number())
-        item = self.create_file_transfer_item(tm)
-        st.set_state_changed_handler(item.update)
-        self._friends[self._active_friend].append_message(tm)
-        self._messages.scrollToBottom()
+        friend.append_message(tm)
+        if friend_number == self.get_active_number():
+            item = self.create_file_transfer_item(tm)
+            st.set_state_changed_handler(item.update)
+            self._messages.scrollToBottom()
 
     def incoming_chunk(self, friend_number, file_number, position, data):
         """
@@ -1007,9 +1088,8 @@ class Profile(contact.Contact, Singleton):
                             elem.setSizeHint(QtCore.QSize(self._messages.width(), item.height()))
                             self._messages.insertItem(count + i + 1, elem)
                             self._messages.setItemWidget(elem, item)
-                else:
-                    self.get_friend_by_number(friend_number).update_transfer_data(file_number,
-                                                                                  TOX_FILE_TRANSFER_STATE['FINISHED'])
+                else:  # finished or cancelled if file is incomplete
+                    self.get_friend_by_number(friend_number).update_transfer_data(file_number, transfer.state)
                 del self._file_transfers[(friend_number, file_number)]
 
     def outgoing_chunk(self, friend_number, file_number, position, size):
@@ -1018,8 +1098,12 @@ class Profile(contact.Contact, Singleton):
         """
         if (friend_number, file_number) in self._file_transfers:
             transfer = self._file_transfers[(friend_number, file_number)]
+            if size:  # chunk is sent by scheduler when limits allow it
+                self._scheduler.request(transfer, position, size)
+                return
             transfer.send_chunk(position, size)
             if transfer.state not in ACTIVE_FILE_TRANSFERS:  # finished or cancelled
+                self._scheduler.remove(transfer)
                 del self._file_transfers[(friend_number, file_number)]
                 if type(transfer) is not SendAvatar:
                     if type(transfer) is SendFromBuffer and Settings.get_instance()['allow_inline']:  # inline
@@ -1041,6 +1125,127 @@ class Profile(contact.Contact, Singleton):
                         self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                                       TOX_FILE_TRANSFER_STATE['FINISHED'])
 
+    def outgoing_transfer_failed(self, transfer):
+        """
+        Chunk of transfer couldn't be sent, scheduler cancelled transfer. Called in tox thread
+        """
+        key = (transfer.get_friend_number(), transfer.get_file_number())
+        if self._file_transfers.get(key) is transfer:
+            del self._file_transfers[key]
+            self.get_friend_by_number(key[0]).update_transfer_data(key[1], TOX_FILE_TRANSFER_STATE['CANCELLED'])
+
+    def set_upload_limits(self):
+        """
+        Applies rate limits of outgoing transfers from settings: 'upload_limit' for all transfers and
+        'friends_upload_limits' (tox id -> limit). Limits are in KB/s, 0 - no limit
+        """
+        settings = Settings.get_instance()
+        limits = settings['friends_upload_limits']
+        self._scheduler.set_limits(settings['upload_limit'] * 1024,
+                                   dict((friend.number, limits[friend.tox_id] * 1024)
+                                        for friend in self._friends if friend.tox_id in limits))
+
+    def get_transfers_stats(self):
+        """
+        :return: live stats of outgoing transfers, see TransferScheduler.get_stats
+        """
+        return self._scheduler.get_stats()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Resuming of file transfers
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def suspend_transfers(self, friend_number=None):
+        """
+        Core drops transfers when friend goes offline or tox is restarted. State of file transfers is saved in
+        settings: file id, path, size, received ranges and time. Transfers are resumed when same file is offered again
+        :param friend_number: number of friend or None for all friends
+        """
+        if not self._file_transfers:
+            return
+        settings = Settings.get_instance()
+        paused = settings['paused_file_transfers']
+        for key, transfer in list(self._file_transfers.items()):
+            if friend_number is not None and key[0] != friend_number:
+                continue
+            del self._file_transfers[key]
+            self._scheduler.remove(transfer)
+            friend = self.get_friend_by_number(key[0])
+            if type(transfer) in (ReceiveTransfer, SendTransfer):
+                incoming = type(transfer) is ReceiveTransfer
+                transfer.suspend()  # all queued chunks are written before received ranges are saved
+                if incoming and transfer.get_error() is not None:  # ranges can cover chunks which weren't written
+                    transfer.cancelled()
+                    friend.update_transfer_data(key[1], TOX_FILE_TRANSFER_STATE['CANCELLED'])
+                    continue
+                paused[transfer.get_file_id()] = [transfer.get_path(), friend.tox_id, transfer.get_size(),
+                                                  list(transfer.get_received()) if incoming else [], incoming,
+                                                  time.time()]
+                self._paused_transfers[key] = transfer.get_file_id()
+                friend.update_transfer_data(key[1], TOX_FILE_TRANSFER_STATE['PAUSED_BY_FRIEND'])
+            else:  # avatars and inline images are sent again from start
+                transfer.cancelled()
+                friend.update_transfer_data(key[1], TOX_FILE_TRANSFER_STATE['CANCELLED'])
+        settings.save()
+
+    def resume_transfers(self, friend_number):
+        """
+        Offers again files which were sent to friend before disconnect. Friend's client continues from received part
+        """
+        friend = self.get_friend_by_number(friend_number)
+        settings = Settings.get_instance()
+        paused = settings['paused_file_transfers']
+        outgoing = [(file_id, data[0], data[2]) for file_id, data in paused.items()
+                    if not data[4] and data[1] == friend.tox_id]
+        if not outgoing:
+            return
+        for file_id, path, size in outgoing:
+            del paused[file_id]
+            if os.path.isfile(path) and os.path.getsize(path) == size:  # file wasn't changed
+                self.send_file(path, friend_number, True, file_id)
+        settings.save()
+
+    def forget_paused_transfer(self, file_id):
+        settings = Settings.get_instance()
+        if settings['paused_file_transfers'].pop(file_id, None) is not None:
+            settings.save()
+
+    def prune_paused_transfers(self):
+        """
+        Forgets transfers suspended more than PAUSED_TRANSFER_LIFETIME seconds ago, partially received files are deleted
+        """
+        settings = Settings.get_instance()
+        paused = settings['paused_file_transfers']
+        now = time.time()
+        changed = False
+        for file_id, data in list(paused.items()):
+            if len(data) < 6:  # saved without time
+                data.append(now)
+                changed = True
+            elif data[5] < now - PAUSED_TRANSFER_LIFETIME:
+                del paused[file_id]
+                changed = True
+                if data[4] and os.path.isfile(data[0]):
+                    try:
+                        os.remove(data[0])
+                    except OSError as ex:
+                        log('Removing of partially received file failed: ' + str(ex))
+        if changed:
+            settings.save()
+
+    def remove_paused_transfer_message(self, friend_number, file_id):
+        """
+        Suspended transfer is offered again with new file number, message about old transfer is removed
+        """
+        for key, value in list(self._paused_transfers.items()):
+            if key[0] == friend_number and value == file_id:
+                del self._paused_transfers[key]
+                i = self.get_friend_by_number(friend_number).delete_transfer_message(key[1])
+                if i is not None and friend_number == self.get_active_number():
+                    count = self._messages.count()
+                    if count + i >= 0:
+                        self._messages.takeItem(count + i)
+
     # -----------------------------------------------------------------------------------------------------------------
     # Avatars support
     # -----------------------------------------------------------------------------------------------------------------
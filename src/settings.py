@@ -123,7 +123,11 @@ class Settings(dict, Singleton):
             'y': 400,
             'message_font_size': 14,
             'unread_color': 'red',
-            'save_unsent_only': False
+            'save_unsent_only': False,
+            'messages_in_memory': 20000,
+            'paused_file_transfers': {},
+            'upload_limit': 0,
+            'friends_upload_limits': {}
         }
 
     @staticmethod
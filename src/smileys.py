@@ -1,11 +1,69 @@
 import util
 import json
 import os
+import re
+import html as h
 from collections import OrderedDict
-try:
-    from PySide import QtCore
-except ImportError:
-    from PyQt4 import QtCore
+
+
+class SmileyMatcher:
+    """
+    Finds all smileys of pack in text in one pass. Smileys are put into trie which is compiled to one regular
+    expression, so text is scanned once by re engine and the longest smiley is taken at every position.
+    Smiley which starts or ends with letter or digit is found only if it's not a part of word: 'xD' is found in
+    'lol xD!' but not in 'xDD', ':)' is found in 'yes:)'
+    """
+
+    def __init__(self, fragments):
+        """
+        :param fragments: dict smiley -> html fragment which replaces it
+        """
+        self._fragments = fragments
+        trie = {}
+        for smiley in fragments:
+            node = trie
+            for c in smiley:
+                node = node.setdefault(c, {})
+            node[''] = smiley  # end of smiley
+        self._pattern = re.compile(self._compile(trie)) if trie else None
+
+    @staticmethod
+    def _is_word_char(c):
+        return c is not None and re.match(r'\w', c) is not None
+
+    @classmethod
+    def _compile(cls, node, char=None):
+        """
+        :param node: node of trie
+        :param char: char on edge to node, None for root
+        :return: regular expression for smileys in subtree of node. Longer smileys are tried first
+        """
+        branches = []
+        for c in sorted(key for key in node if key):
+            branch = re.escape(c)
+            if char is None and cls._is_word_char(c):  # first char of smiley mustn't continue word
+                branch += r'(?<!\w.)'
+            branches.append(branch + cls._compile(node[c], c))
+        if '' in node:  # smiley ends here
+            branches.append(r'(?!\w)' if cls._is_word_char(char) else '')
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    def replace(self, text):
+        """
+        :param text: plain text
+        :return: tuple (escaped text with html fragments instead of smileys, list of found smileys)
+        """
+        if self._pattern is None:
+            return h.escape(text), []
+        parts, found, position = [], [], 0
+        for match in self._pattern.finditer(text):
+            smiley = match.group()
+            parts.append(h.escape(text[position:match.start()]))
+            parts.append(self._fragments[smiley])
+            found.append(smiley)
+            position = match.end()
+        parts.append(h.escape(text[position:]))
+        return ''.join(parts), found
 
 
 class SmileyLoader(util.Singleton):
@@ -19,6 +77,7 @@ class SmileyLoader(util.Singleton):
         self._curr_pack = None  # current pack name
         self._smileys = {}  # smileys dict. key - smiley (str), value - path to image (str)
         self._list = []  # smileys list without duplicates
+        self._matcher = SmileyMatcher({})
         self.load_pack()
 
     def load_pack(self):
@@ -31,20 +90,22 @@ class SmileyLoader(util.Singleton):
             path = self.get_smileys_path() + 'config.json'
             try:
                 with open(path, encoding='utf8') as fl:
-                    self._smileys = json.loads(fl.read())
-                    fl.seek(0)
                     tmp = json.loads(fl.read(), object_pairs_hook=OrderedDict)
+                self._smileys = dict(tmp)
                 print('Smiley pack {} loaded'.format(pack_name))
-                keys, values, self._list = [], [], []
+                values, self._list = set(), []
                 for key, value in tmp.items():
                     value = self.get_smileys_path() + value
                     if value not in values:
-                        keys.append(key)
-                        values.append(value)
-                self._list = list(zip(keys, values))
+                        self._list.append((key, value))
+                        values.add(value)
+                fragments = dict((key, '<img title="{}" src="{}" />'.format(h.escape(key), h.escape(value)))
+                                 for key, value in tmp.items())  # html of every smiley is created once
+                self._matcher = SmileyMatcher(fragments)
             except Exception as ex:
                 self._smileys = {}
                 self._list = []
+                self._matcher = SmileyMatcher({})
                 print('Smiley pack {} was not loaded. Error: {}'.format(pack_name, ex))
 
     def get_smileys_path(self):
@@ -57,23 +118,23 @@ class SmileyLoader(util.Singleton):
     def get_smileys(self):
         return list(self._list)
 
-    def add_smileys_to_text(self, text, edit):
+    def get_pack_id(self):
+        """
+        :return: name of current pack or None if smileys are disabled
+        """
+        return self._curr_pack if self._settings['smileys'] and len(self._smileys) else None
+
+    def add_smileys_to_text(self, text):
         """
-        Adds smileys to text
-        :param text: message
-        :param edit: MessageEdit instance
-        :return text with smileys
+        Escapes text and adds smileys to it
+        :param text: plain text of message
+        :return tuple (html with smileys, tuple of file names of animated smileys in text)
         """
         if not self._settings['smileys'] or not len(self._smileys):
-            return text
-        arr = text.split(' ')
-        for i in range(len(arr)):
-            if arr[i] in self._smileys:
-                file_name = self._smileys[arr[i]]  # image name
-                arr[i] = '<img title=\"{}\" src=\"{}\" />'.format(arr[i], file_name)
-                if file_name.endswith('.gif'):  # animated smiley
-                    edit.addAnimation(QtCore.QUrl(file_name), self.get_smileys_path() + file_name)
-        return ' '.join(arr)
+            return h.escape(text), ()
+        text, found = self._matcher.replace(text)
+        animated = (self._smileys[smiley] for smiley in found)
+        return text, tuple(file_name for file_name in animated if file_name.endswith('.gif'))
 
 
 def sticker_loader():
@@ -1106,7 +1106,7 @@ class Tox:
         :return: True on success.
         """
         tox_err_file_seek = c_int()
-        result = Tox.libtoxcore.tox_file_control(self._tox_pointer, c_uint32(friend_number), c_uint32(file_number),
+        result = Tox.libtoxcore.tox_file_seek(self._tox_pointer, c_uint32(friend_number), c_uint32(file_number),
                                                  c_uint64(position), byref(tox_err_file_seek))
         tox_err_file_seek = tox_err_file_seek.value
         if tox_err_file_seek == TOX_ERR_FILE_SEEK['OK']:
@@ -1,6 +1,6 @@
 import libtox
 import util
-from ctypes import c_size_t, create_string_buffer, byref, c_int, ArgumentError, c_char_p, c_bool
+from ctypes import c_size_t, create_string_buffer, byref, c_int, ArgumentError, c_char_p, c_bool, c_uint8
 
 
 TOX_ERR_ENCRYPTION = {
@@ -31,8 +31,21 @@ TOX_ERR_DECRYPTION = {
     'FAILED': 5,
 }
 
+TOX_ERR_KEY_DERIVATION = {
+    # The function returned successfully.
+    'OK': 0,
+    # Some input data, or maybe the output pointer, was null.
+    'NULL': 1,
+    # The crypto lib was unable to derive a key from the given passphrase, which is usually a lack of memory issue
+    'FAILED': 2
+}
+
 TOX_PASS_ENCRYPTION_EXTRA_LENGTH = 80
 
+TOX_PASS_SALT_LENGTH = 32
+
+TOX_PASS_KEY_LENGTH = 32
+
 
 class LibToxEncryptSave(util.Singleton):
 
@@ -109,3 +122,97 @@ class LibToxEncryptSave(util.Singleton):
         elif tox_err_decryption == TOX_ERR_DECRYPTION['FAILED']:
             raise RuntimeError('The encrypted byte array could not be decrypted. Either the data was corrupt or the '
                                'password/key was incorrect.')
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Encryption with derived key. Key derivation is slow, so one key is used for many encryptions
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get_salt(self, data):
+        """
+        Retrieves the salt used to encrypt the given data
+        :return: salt (bytes) or None if data is not encrypted
+        """
+        salt = create_string_buffer(TOX_PASS_SALT_LENGTH)
+        func = self.libtoxencryptsave.tox_get_salt
+        func.restype = c_bool
+        if func(c_char_p(bytes(data)), salt):
+            return salt[:]
+        return None
+
+    def pass_key_derive(self, salt=None):
+        """
+        Derives key from the passphrase.
+
+        :param salt: salt of existing data or None to generate random salt
+        :return: TOX_PASS_KEY (salt + key) as bytes
+        """
+        key = (c_uint8 * (TOX_PASS_SALT_LENGTH + TOX_PASS_KEY_LENGTH))()
+        tox_err_key_derivation = c_int()
+        passphrase = bytes(self._passphrase, 'utf-8')
+        if salt is None:
+            self.libtoxencryptsave.tox_derive_key_from_pass(c_char_p(passphrase),
+                                                            c_size_t(len(passphrase)),
+                                                            key,
+                                                            byref(tox_err_key_derivation))
+        else:
+            self.libtoxencryptsave.tox_derive_key_with_salt(c_char_p(passphrase),
+                                                            c_size_t(len(passphrase)),
+                                                            c_char_p(bytes(salt)),
+                                                            key,
+                                                            byref(tox_err_key_derivation))
+        tox_err_key_derivation = tox_err_key_derivation.value
+        if tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['OK']:
+            return bytes(key)
+        elif tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['FAILED']:
+            raise RuntimeError('The crypto lib was unable to derive a key from the given passphrase, which is usually a'
+                               ' lack of memory issue.')
+
+    def pass_key_encrypt(self, data, key):
+        """
+        Encrypts the given data with key from pass_key_derive.
+
+        :return: output array
+        """
+        out = create_string_buffer(len(data) + TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        tox_err_encryption = c_int()
+        self.libtoxencryptsave.tox_pass_key_encrypt(c_char_p(bytes(data)),
+                                                    c_size_t(len(data)),
+                                                    c_char_p(key),
+                                                    out,
+                                                    byref(tox_err_encryption))
+        tox_err_encryption = tox_err_encryption.value
+        if tox_err_encryption == TOX_ERR_ENCRYPTION['OK']:
+            return out[:]
+        elif tox_err_encryption == TOX_ERR_ENCRYPTION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_encryption == TOX_ERR_ENCRYPTION['FAILED']:
+            raise RuntimeError('The encryption itself failed.')
+
+    def pass_key_decrypt(self, data, key):
+        """
+        Decrypts the given data with key from pass_key_derive.
+
+        :return: output array
+        """
+        out = create_string_buffer(len(data) - TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        tox_err_decryption = c_int()
+        self.libtoxencryptsave.tox_pass_key_decrypt(c_char_p(bytes(data)),
+                                                    c_size_t(len(data)),
+                                                    c_char_p(key),
+                                                    out,
+                                                    byref(tox_err_decryption))
+        tox_err_decryption = tox_err_decryption.value
+        if tox_err_decryption == TOX_ERR_DECRYPTION['OK']:
+            return out[:]
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['INVALID_LENGTH']:
+            raise ArgumentError('The input data was shorter than TOX_PASS_ENCRYPTION_EXTRA_LENGTH bytes')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['BAD_FORMAT']:
+            raise ArgumentError('The input data is missing the magic number (i.e. wasn\'t created by this module, or is'
+                                ' corrupted)')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['FAILED']:
+            raise RuntimeError('The encrypted byte array could not be decrypted. Either the data was corrupt or the '
+                               'password/key was incorrect.')
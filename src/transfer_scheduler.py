@@ -0,0 +1,219 @@
+from collections import deque
+import threading
+import time
+from file_transfers import SendAvatar, SendFromBuffer, TOX_FILE_TRANSFER_STATE
+from util import Singleton, log
+
+
+MAX_CHUNK_SIZE = 1371  # size of chunks requested by toxcore
+
+SMALL_FILE_SIZE = 1024 * 1024  # files up to this size are sent before big files
+
+BURST_TIME = 0.25  # seconds of traffic which can be sent at once after idle time
+
+INTERACTIVE, BULK = 0, 1  # priorities of transfers
+
+
+class TokenBucket:
+    """
+    Rate limiter. Bucket is refilled with rate bytes per second up to capacity, every sent chunk takes its size
+    """
+
+    def __init__(self, rate=0, clock=time.monotonic):
+        """
+        :param rate: bytes per second, 0 - no limit
+        :param clock: function which returns time in seconds
+        """
+        self._clock = clock
+        self.rate = rate
+        self.capacity = self._tokens = max(rate * BURST_TIME, 4 * MAX_CHUNK_SIZE)
+        self._time = clock()
+
+    def set_rate(self, rate):
+        """
+        Changes limit. Bucket isn't refilled, tokens collected before are kept up to new capacity
+        """
+        now = self._clock()
+        if self.rate:
+            self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+        self.rate = rate
+        self.capacity = max(rate * BURST_TIME, 4 * MAX_CHUNK_SIZE)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def allows(self, size):
+        """
+        :return: True if chunk of size bytes can be sent now
+        """
+        if not self.rate:
+            return True
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+        return self._tokens >= size
+
+    def consume(self, size):
+        if self.rate:
+            self._tokens -= size
+
+
+class TransferScheduler(Singleton):
+    """
+    Sends chunks of outgoing transfers. Toxcore requests chunks of all transfers at once, scheduler sends them
+    in order of priority (avatars, inline images and small files first), round robin between transfers
+    of same priority. Global and per friend rate limits are token buckets, chunks over limit wait in queue
+    """
+
+    def __init__(self, rate=0, clock=time.monotonic, error_handler=None):
+        """
+        :param rate: global limit in bytes per second, 0 - no limit
+        :param clock: function which returns time in seconds
+        :param error_handler: function called in tox thread with transfer which was cancelled because its chunk
+        couldn't be sent
+        """
+        super().__init__()
+        self._clock = clock
+        self._error_handler = error_handler
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(rate, clock)
+        self._friends_buckets = {}  # friend number -> TokenBucket
+        self._transfers = {}  # (friend_number, file_number) -> tuple (transfer, priority)
+        self._requests = {}  # (friend_number, file_number) -> deque of lists [position, end, chunk size]
+        self._queues = (deque(), deque())  # keys of transfers with requested chunks for every priority
+        self._sent = {}  # (friend_number, file_number) -> bytes sent by scheduler
+        self._failed = []  # transfers which will be cancelled
+
+    @staticmethod
+    def get_priority(transfer):
+        if isinstance(transfer, (SendAvatar, SendFromBuffer)) or transfer.get_size() <= SMALL_FILE_SIZE:
+            return INTERACTIVE
+        return BULK
+
+    def set_limits(self, rate, friends_rates):
+        """
+        :param rate: global limit in bytes per second, 0 - no limit
+        :param friends_rates: dict friend number -> limit in bytes per second
+        """
+        with self._lock:
+            self._bucket.set_rate(rate)
+            buckets = {}  # buckets of friends which had limits are kept, so new limits don't give new burst
+            for number, value in friends_rates.items():
+                if value:
+                    bucket = buckets[number] = self._friends_buckets.get(number) or TokenBucket(value, self._clock)
+                    bucket.set_rate(value)
+            self._friends_buckets = buckets
+
+    def request(self, transfer, position, size):
+        """
+        Called in tox thread when toxcore requests chunk
+        """
+        key = (transfer.get_friend_number(), transfer.get_file_number())
+        with self._lock:
+            if key not in self._transfers:
+                self._transfers[key] = (transfer, self.get_priority(transfer))
+                self._sent[key] = 0
+            requests = self._requests.get(key)
+            if requests is None:
+                requests = self._requests[key] = deque()
+                self._queues[self._transfers[key][1]].append(key)
+            last = requests[-1] if requests else None
+            if last is not None and last[1] == position and last[2] == size:
+                last[1] += size  # next chunk, toxcore requests chunks of file one by one
+            else:
+                requests.append([position, position + size, size])
+        self.send_chunks()
+
+    def send_chunks(self):
+        """
+        Sends requested chunks which are allowed by limits. Called in tox thread after every request and iteration
+        """
+        with self._lock:
+            blocked = set()  # friends with full packet queue
+            for queue in self._queues:
+                sent = True
+                while queue and sent:  # every round sends one chunk of every transfer
+                    sent = False
+                    for _ in range(len(queue)):
+                        key = queue[0]
+                        sent = self._send_next(key, blocked) or sent
+                        if key in self._requests:
+                            queue.rotate(-1)
+                        else:
+                            queue.popleft()
+            failed, self._failed = self._failed, []
+        for transfer in failed:  # cancelled outside of lock, handler can call scheduler
+            try:
+                transfer.cancel()
+            except Exception as ex:
+                log('Cancelling of transfer failed: ' + str(ex))
+            self.remove(transfer)
+            if self._error_handler is not None:
+                self._error_handler(transfer)
+
+    def _send_next(self, key, blocked):
+        """
+        :return: True if chunk was sent
+        """
+        transfer = self._transfers[key][0]
+        if transfer.state in (TOX_FILE_TRANSFER_STATE['CANCELLED'], TOX_FILE_TRANSFER_STATE['FINISHED']):
+            del self._requests[key]
+            return False
+        if key[0] in blocked:
+            return False
+        requests = self._requests[key]
+        chunk = requests[0]
+        size = min(chunk[2], chunk[1] - chunk[0])
+        bucket = self._friends_buckets.get(key[0])
+        if not self._bucket.allows(size) or bucket is not None and not bucket.allows(size):
+            return False
+        try:
+            transfer.send_chunk(chunk[0], size)
+        except RuntimeError:  # packet queue is full, chunk will be sent after next iteration
+            blocked.add(key[0])
+            return False
+        except Exception as ex:  # file can't be read, transfer can't continue
+            log('Sending of chunk failed: ' + str(ex))
+            del self._requests[key]
+            self._failed.append(transfer)
+            return False
+        self._bucket.consume(size)
+        if bucket is not None:
+            bucket.consume(size)
+        self._sent[key] += size
+        chunk[0] += size
+        if chunk[0] >= chunk[1]:
+            requests.popleft()
+            if not requests:
+                del self._requests[key]
+        return True
+
+    def remove(self, transfer):
+        """
+        Transfer was finished, cancelled or suspended. Its requested chunks are dropped
+        """
+        key = (transfer.get_friend_number(), transfer.get_file_number())
+        with self._lock:
+            if self._transfers.get(key, (None,))[0] is not transfer:
+                return
+            del self._transfers[key]
+            del self._sent[key]
+            if self._requests.pop(key, None) is not None:
+                for queue in self._queues:
+                    if key in queue:
+                        queue.remove(key)
+
+    def get_stats(self):
+        """
+        :return: list of dicts with live stats of outgoing transfers: friend_number, file_number, priority,
+        sent (bytes), waiting (bytes requested by toxcore and delayed by limits), speed (bytes per second or None),
+        eta (seconds or -1)
+        """
+        with self._lock:
+            return [{'friend_number': key[0],
+                     'file_number': key[1],
+                     'priority': priority,
+                     'sent': self._sent[key],
+                     'waiting': sum(end - position for position, end, size in self._requests.get(key, ())),
+                     'speed': transfer.get_speed(),
+                     'eta': transfer.get_eta()}
+                    for key, (transfer, priority) in self._transfers.items()]
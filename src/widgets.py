@@ -4,15 +4,21 @@ except ImportError:
     from PyQt4 import QtCore, QtGui
 
 
+def elided_text(text, font, width):
+    """
+    :return: text with unsupported symbols replaced, elided to given width in pixels
+    """
+    text = ''.join(c if c <= '\u10FFFF' else '\u25AF' for c in text)
+    metrics = QtGui.QFontMetrics(font)
+    return metrics.elidedText(text, QtCore.Qt.ElideRight, width)
+
+
 class DataLabel(QtGui.QLabel):
     """
     Label with elided text
     """
     def setText(self, text):
-        text = ''.join(c if c <= '\u10FFFF' else '\u25AF' for c in text)
-        metrics = QtGui.QFontMetrics(self.font())
-        text = metrics.elidedText(text, QtCore.Qt.ElideRight, self.width())
-        super().setText(text)
+        super().setText(elided_text(text, self.font(), self.width()))
 
 
 class CenteredWidget(QtGui.QWidget):
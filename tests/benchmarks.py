@@ -0,0 +1,778 @@
+"""
+Performance benchmarks. Run with: python3 tests/benchmarks.py [benchmark name]
+"""
+from collections import deque
+import html
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'src'))
+from settings import ProfileHelper
+from toxencryptsave import LibToxEncryptSave
+from history import History, MESSAGE_OWNER
+from encrypted_storage import PagedEncryptedFile
+from messages import TextMessage, TransferMessage, UnsentFile
+import file_transfers
+from file_transfers import TOX_FILE_TRANSFER_STATE, FileTransfer, ReceiveToBuffer, ReceiveTransfer, SendTransfer, \
+    SendFromBuffer
+import file_io
+from file_io import FileIOPool, ReadAhead
+import message_render
+import pixmaps
+from transfer_scheduler import TransferScheduler
+from smileys import SmileyLoader, SmileyMatcher
+try:
+    from PySide import QtGui
+except ImportError:
+    from PyQt4 import QtGui
+
+
+def measure(func, *args):
+    """
+    :return: time of func execution in seconds
+    """
+    t = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t
+
+
+def temp_profile():
+    """
+    Creates profile helper with empty temporary directory
+    """
+    directory = tempfile.mkdtemp() + '/'
+    ProfileHelper(directory, 'benchmark')
+    LibToxEncryptSave()
+    return directory
+
+
+def fake_tox_id(i):
+    return '{:064X}'.format(i)
+
+
+class BenchmarkHistory:
+
+    MESSAGES_PER_FRIEND = 10
+
+    def save_history(self, history, friends_count):
+        """
+        Same calls as Profile.save_history does
+        """
+        messages = [('message', MESSAGE_OWNER['ME'], time.time() + i, 0) for i in range(self.MESSAGES_PER_FRIEND)]
+        with history.transaction():
+            for i in range(friends_count):
+                tox_id = fake_tox_id(i)
+                if not history.friend_exists_in_db(tox_id):
+                    history.add_friend_to_db(tox_id)
+                history.save_messages_to_db(tox_id, messages)
+                history.update_messages(tox_id, time.time() + 1)
+
+    def bench_save_history(self):
+        print('Save history: friends count -> seconds')
+        for friends_count in (10, 100, 500, 1000, 2000, 5000):
+            temp_profile()
+            history = History('benchmark')
+            t = measure(self.save_history, history, friends_count)
+            history.close()
+            print('{:>6} -> {:.3f}'.format(friends_count, t))
+
+
+class BenchmarkWriteBehind:
+
+    MESSAGES_COUNT = 20000
+    FRIENDS_COUNT = 100
+    MESSAGES_PER_SECOND = 2000  # heavy chat load
+
+    def bench_write_behind(self):
+        temp_profile()
+        history = History('benchmark')
+        for i in range(self.FRIENDS_COUNT):
+            history.add_friend_to_db(fake_tox_id(i))
+        latencies = []
+        for i in range(self.MESSAGES_COUNT):
+            tox_id = fake_tox_id(i % self.FRIENDS_COUNT)
+            message = ('message', MESSAGE_OWNER['FRIEND'], float(i), 0)
+            latencies.append(measure(history.append_messages, tox_id, [message]))
+            time.sleep(1. / self.MESSAGES_PER_SECOND)
+        metrics = history.get_writer_metrics()
+        print('Append of {} messages: mean {:.6f}, max {:.6f} seconds'.format(
+            self.MESSAGES_COUNT, sum(latencies) / len(latencies), max(latencies)))
+        print('Tail written on exit: {:.3f} seconds, {} statements'.format(
+            measure(history.flush), history.get_writer_metrics()['flushed_statements'] - metrics['flushed_statements']))
+        metrics = history.get_writer_metrics()
+        print('Flushes: {}, max queue depth: {}, mean flush latency: {:.4f}, max flush latency: {:.4f}'.format(
+            metrics['flushes'], metrics['max_queue_depth'], metrics['total_flush_latency'] / metrics['flushes'],
+            metrics['max_flush_latency']))
+        history.close()
+
+
+class BenchmarkSearch:
+
+    MESSAGES_COUNT = 1000000
+    FRIENDS_COUNT = 100
+    WORDS = ('hello', 'world', 'tox', 'message', 'file', 'call', 'video', 'audio', 'friend', 'profile')
+
+    def bench_search(self):
+        temp_profile()
+        history = History('benchmark')
+        per_friend = self.MESSAGES_COUNT // self.FRIENDS_COUNT
+        with history.transaction():
+            for i in range(self.FRIENDS_COUNT):
+                tox_id = fake_tox_id(i)
+                history.add_friend_to_db(tox_id)
+                history.save_messages_to_db(tox_id, [(' '.join(self.WORDS[(j * k) % len(self.WORDS)]
+                                                               for k in range(1, 6)) + ' ' + str(j),
+                                                      MESSAGE_OWNER['FRIEND'], float(j), 0) for j in range(per_friend)])
+        print('Search in {} messages: query -> seconds'.format(self.MESSAGES_COUNT))
+        for text, tox_id in (('hello', None), ('tox message', None), ('vid', None), ('12345', None),
+                             ('friend', fake_tox_id(1)), ('nothing', None)):
+            print('{:>20} -> {:.4f}'.format(text + (' (one friend)' if tox_id else ''),
+                                            measure(history.search, text, tox_id)))
+        history.close()
+
+
+class BenchmarkFriend:
+
+    SIZES = (1000, 10000, 100000)
+    CALLS = 500
+
+    class MessageGetter:
+        """
+        Getter of friend whose history is written in background
+        """
+
+        def append(self, messages):
+            list(messages)
+            return True
+
+        def mark_as_sent(self, unix_time):
+            pass
+
+    @staticmethod
+    def create_friend(count):
+        """
+        :return: friend with count messages, last CALLS messages are not sent. Every 100th older message is file
+        transfer. Window starts with CALLS files which are not sent
+        """
+        from friend import Friend
+        temp_profile()
+        friend = Friend(BenchmarkFriend.MessageGetter(), 0, 'friend', '', None, fake_tox_id(0))
+        for i in range(-BenchmarkFriend.CALLS, 0):
+            friend.append_message(UnsentFile('file', None, float(i)))
+        for i in range(count):
+            if i >= count - BenchmarkFriend.CALLS:
+                friend.append_message(TextMessage('message', MESSAGE_OWNER['NOT_SENT'], float(i), 0))
+            elif i % 100 == 99:
+                friend.append_message(TransferMessage(MESSAGE_OWNER['FRIEND'], float(i), 0, 100, 'file', 0, i))
+            else:
+                friend.append_message(TextMessage('message', i % 2, float(i), 0))
+        return friend
+
+    def bench_friend_lookups(self):
+        print('Microseconds per call for conversation size')
+        print('{:>30} {}'.format('', ' '.join('{:>9}'.format(size) for size in self.SIZES)))
+        results = {}
+        for size in self.SIZES:
+            friend = self.create_friend(size)
+            transfers = [i for i in range(size - self.CALLS) if i % 100 == 99][:5]  # oldest
+            old = [float(i) for i in range(size - self.CALLS) if i % 100 != 99][:self.CALLS]
+            calls = (
+                ('get_last_message_text', lambda i: friend.get_last_message_text()),
+                ('get_unsent_messages', lambda i: friend.get_unsent_messages()),
+                ('get_corr_for_saving', lambda i: friend.get_corr_for_saving()),
+                ('update_transfer_data', lambda i: friend.update_transfer_data(
+                    transfers[i % len(transfers)], TOX_FILE_TRANSFER_STATE['PAUSED_BY_USER'])),
+                ('mark_as_sent', lambda i: friend.mark_as_sent()),
+                ('delete_message (newest)', lambda i: friend.delete_message(float(size - 1 - i))),
+                ('delete_message (oldest)', lambda i: i < len(old) and friend.delete_message(old[i])),
+                ('get_unsent_files', lambda i: friend.get_unsent_files()),
+                ('delete_one_unsent_file', lambda i: friend.delete_one_unsent_file(float(-1 - i)))
+            )
+            for name, call in calls:
+                t = measure(lambda: [call(i) for i in range(self.CALLS)])
+                results.setdefault(name, []).append(t / self.CALLS * 1000000)
+        for name in results:
+            print('{:>30} {}'.format(name, ' '.join('{:>9.2f}'.format(t) for t in results[name])))
+
+
+class BenchmarkCallbacks:
+
+    FRIENDS_COUNTS = (10, 100, 1000, 5000)
+    EVENTS = 10000
+    LOOKUPS_PER_EVENT = 3  # e.g. message callback: friend for message, for notification and for receipt
+
+    class Friend:
+
+        def __init__(self, number):
+            self.number = number
+
+    def bench_callback_dispatch(self):
+        from profile import Profile
+        print('Microseconds per event for friends count: linear search (old) / dict')
+        for count in self.FRIENDS_COUNTS:
+            profile = Profile.__new__(Profile)  # only friends list is needed
+            profile._friends = [self.Friend(i) for i in range(count)]
+            profile._friends_by_number = dict((friend.number, friend) for friend in profile._friends)
+            numbers = [(i * 7919) % count for i in range(self.EVENTS)]
+
+            def linear():
+                for num in numbers:
+                    for _ in range(self.LOOKUPS_PER_EVENT):
+                        list(filter(lambda x: x.number == num, profile._friends))[0]
+
+            def indexed():
+                for num in numbers:
+                    for _ in range(self.LOOKUPS_PER_EVENT):
+                        profile.get_friend_by_number(num)
+
+            print('{:>6}: {:.2f} / {:.2f}'.format(count, measure(linear) / self.EVENTS * 1000000,
+                                                  measure(indexed) / self.EVENTS * 1000000))
+
+
+class BenchmarkStartup:
+
+    FRIENDS_COUNTS = (100, 1000, 5000)
+
+    class Tox:
+        """
+        Friends data of tox instance
+        """
+
+        def __init__(self, count):
+            self._count = count
+
+        def self_get_friend_list(self):
+            return list(range(self._count))
+
+        def friend_get_public_key(self, number):
+            return fake_tox_id(number)
+
+        def friend_get_name(self, number):
+            return 'friend {}'.format(number)
+
+        def friend_get_status_message(self, number):
+            return 'status message'
+
+    class Screen:
+
+        def __init__(self):
+            self.friends_list = QtGui.QListView()
+            self.friends_list.setUniformItemSizes(True)
+            self.friends_list.setGeometry(0, 0, 270, 600)
+
+    def bench_startup(self):
+        from profile import Profile
+        from settings import Settings
+        if QtGui.QApplication.instance() is None:
+            BenchmarkStartup.app = QtGui.QApplication([])
+        print('Friends list: friends count -> seconds to load friends, to filter list, to paint visible rows, '
+              'pixmaps in memory')
+        for count in self.FRIENDS_COUNTS:
+            temp_profile()
+            Settings('benchmark')
+            profile = Profile.__new__(Profile)  # only friends list is created
+            profile._screen = self.Screen()
+            profile._history = History('benchmark')
+            load = measure(profile.load_friends, self.Tox(count))
+            show = measure(profile.filtration, False)
+            friends_list = profile._screen.friends_list
+            paint = measure(QtGui.QPixmap.grabWidget, friends_list)
+            friends_list.scrollToBottom()
+            paint += measure(QtGui.QPixmap.grabWidget, friends_list)
+            avatars = pixmaps.get_stats()[0]
+            print('{:>6} -> {:.3f}, {:.3f}, {:.3f}, {}'.format(count, load, show, paint, avatars))
+            profile._history.close()
+
+
+class BenchmarkMessages:
+
+    MESSAGES_COUNT = 1000000
+
+    class DictMessage:
+        """
+        Text message with per-instance dict, like messages before __slots__
+        """
+
+        def __init__(self, message, owner, time, message_type):
+            self._time = time
+            self._type = message_type
+            self._owner = owner
+            self._message = message
+
+    @staticmethod
+    def allocated(func):
+        """
+        :return: number of bytes allocated by func which are still used by its result
+        """
+        tracemalloc.start()
+        result = func()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+        return size
+
+    def bench_messages_memory(self):
+        rows = [('message {}'.format(i), i % 2, float(i), 0) for i in range(self.MESSAGES_COUNT)]
+        print('{} loaded messages (rows from db are not counted): seconds, MB, bytes per message'.format(
+            self.MESSAGES_COUNT))
+        for name, func in (('dict-based objects', lambda: [self.DictMessage(*row) for row in rows]),
+                           ('TextMessage(*row)', lambda: list(map(lambda row: TextMessage(*row), rows))),
+                           ('TextMessage.from_db', lambda: TextMessage.from_db(rows))):
+            size = self.allocated(func)
+            print('{:>20}: {:.3f}, {:.1f}, {:.0f}'.format(name, measure(func), size / 1024 / 1024,
+                                                          size / self.MESSAGES_COUNT))
+
+
+class BenchmarkEncryptedHistory:
+
+    HISTORY_SIZE = 500 * 1024 * 1024
+
+    def bench_incremental_save(self):
+        directory = temp_profile()
+        encryption = LibToxEncryptSave.get_instance()
+        encryption.set_password('benchmark')
+        plain_path = directory + 'plain'
+        with open(plain_path, 'wb') as fl:
+            for _ in range(self.HISTORY_SIZE // (1024 * 1024)):
+                fl.write(os.urandom(1024 * 1024))
+        storage = PagedEncryptedFile(directory + 'benchmark.hstr', encryption)
+        print('Encrypted history of {} MB'.format(self.HISTORY_SIZE // (1024 * 1024)))
+        print('First save (all pages): {:.3f}'.format(measure(storage.encrypt_from, plain_path)))
+        with open(plain_path, 'rb') as fl:
+            data = fl.read()
+        print('Whole file encryption (old format): {:.3f}'.format(measure(encryption.pass_encrypt, data)))
+        del data
+        for changes in (1, 10, 100):
+            with open(plain_path, 'r+b') as fl:  # like sqlite page updates
+                for i in range(changes):
+                    fl.seek((i * 7919 * 4096) % self.HISTORY_SIZE)
+                    fl.write(os.urandom(4096))
+            pages = []
+            t = measure(lambda: pages.append(storage.encrypt_from(plain_path)))
+            print('Save after {} changed db pages: {:.3f} ({} pages rewritten)'.format(changes, t, pages[0]))
+
+
+class BenchmarkRender:
+
+    WORDS = ('hello', 'how', 'are', 'you', 'ok', 'see', 'this', 'tox', 'file', 'thanks', 'lol', 'yes', 'no', 'maybe',
+             'tomorrow', 'build', 'works', 'for', 'me', 'the', 'a', 'is', 'it', ':)', ':D', ';)', ':(')
+    URLS = ('https://github.com/toxygen-project/toxygen', 'www.example.com/page?id=1', 'ftp://example.org/file.zip',
+            'mailto:user@example.com', 'http://example.com/a/b/c.html')
+
+    @staticmethod
+    def old_smileys(text):
+        """
+        Smileys substitution before matcher: only space separated smileys are found
+        """
+        smileys = SmileyLoader.get_instance()._smileys
+        arr = text.split(' ')
+        for i in range(len(arr)):
+            if arr[i] in smileys:
+                arr[i] = '<img title=\"{}\" src=\"{}\" />'.format(arr[i], smileys[arr[i]])
+        return ' '.join(arr)
+
+    @staticmethod
+    def old_render(text):
+        """
+        Rendering without caching: text is rebuilt after every found link
+        """
+        text = html.escape(text)
+        match = message_render.LINKS.search(text)
+        while match is not None:
+            if match.group(1) == 'www.':
+                link = '<a href="http://{0}">{0}</a>'.format(match.group(0))
+            else:
+                link = '<a href="{0}">{0}</a>'.format(match.group(0))
+            text = text[:match.start()] + link + text[match.end():]
+            match = message_render.LINKS.search(text, match.start() + len(link))
+        arr = text.split('\n')
+        for i in range(len(arr)):
+            if arr[i].startswith('&gt;'):
+                arr[i] = '<font color="green"><b>' + arr[i][4:] + '</b></font>'
+        return BenchmarkRender.old_smileys('<br>'.join(arr))
+
+    def corpora(self):
+        """
+        :return: dict name -> list of messages
+        """
+        rnd = random.Random(0)
+
+        def sentence(count, links=0.0):
+            return ' '.join(rnd.choice(self.URLS) if rnd.random() < links else rnd.choice(self.WORDS)
+                            for _ in range(count))
+
+        return {
+            'chat (2000 short lines)': [sentence(rnd.randint(1, 15), 0.02) for _ in range(2000)],
+            'quotes (1000 replies)': ['\n'.join('>' + sentence(8) for _ in range(3)) + '\n' + sentence(10)
+                                      for _ in range(1000)],
+            'links (50 x 1000 links)': [sentence(2000, 0.5) for _ in range(50)],
+            'pastes (20 x 30 KB)': ['\n'.join(sentence(12, 0.05) for _ in range(500)) for _ in range(20)]
+        }
+
+    def bench_render(self):
+        SmileyLoader({'smileys': True, 'smiley_pack': 'default'})
+        print('Rendering of messages: corpus -> seconds for old rendering, new rendering, cached rendering')
+        for name, messages in sorted(self.corpora().items()):
+            old = measure(lambda: [self.old_render(text) for text in messages])
+            message_render.clear_cache()
+            new = measure(lambda: [message_render.render_message(text) for text in messages])
+            cached = measure(lambda: [message_render.render_message(text) for text in messages])
+            print('{:>24} -> {:.3f}, {:.3f}, {:.4f}'.format(name, old, new, cached))
+
+    def bench_smileys(self):
+        loader = SmileyLoader({'smileys': True, 'smiley_pack': 'default'})
+        rnd = random.Random(0)
+        punctuation = ('', '', '', ',', '.', '!', '(', ')')
+        words = [rnd.choice(self.WORDS) + rnd.choice(punctuation) for _ in range(200000)]
+        text = ' '.join(words)  # about 1 MB pasted text, some smileys are followed by punctuation
+        size = len(text.encode('utf-8')) / 1024 / 1024
+        print('Smileys in {:.1f} MB of text: MB per second, smileys found'.format(size))
+        for name, func in (('space separated only', lambda: self.old_smileys(text).count('<img')),
+                           ('matcher', lambda: len(loader.add_smileys_to_text(text)[0].split('<img')) - 1)):
+            found = []
+            t = measure(lambda: found.append(func()))
+            print('{:>22}: {:.1f}, {}'.format(name, size / t, found[0]))
+        print('Matcher creation for pack: {:.3f}'.format(measure(SmileyMatcher, dict.fromkeys(loader._smileys, ''))))
+
+
+class BenchmarkTransfers:
+
+    CHUNK_SIZE = 1371  # max size of file chunk in toxcore
+    IMAGE_SIZES = (64 * 1024, 256 * 1024, 1024 * 1024)
+
+    @staticmethod
+    def old_receive(chunks):
+        """
+        Inline image reception before preallocated buffer: buffer is rebuilt for every chunk
+        """
+        buffer, size = bytes(), 0
+        for position, data in chunks:
+            data = bytes(data)
+            l = len(data)
+            if size < position:
+                buffer += (b'\0' * (position - size))
+            buffer = buffer[:position] + data + buffer[position + l:]
+            if position + l > size:
+                size = position + l
+        return buffer
+
+    def chunks(self, size):
+        data = os.urandom(size)
+        return data, [(i, data[i:i + self.CHUNK_SIZE]) for i in range(0, size, self.CHUNK_SIZE)]
+
+    def bench_receive_to_buffer(self):
+        print('Inline image reception in {} B chunks: size -> MB per second for old buffer, '
+              'preallocated buffer'.format(self.CHUNK_SIZE))
+        for size in self.IMAGE_SIZES:
+            data, chunks = self.chunks(size)
+            result = []
+            old = measure(lambda: result.append(self.old_receive(chunks)))
+            transfer = ReceiveToBuffer(None, 0, size, 0)
+
+            def receive():
+                for position, chunk in chunks:
+                    transfer.write_chunk(position, chunk)
+                transfer.write_chunk(size, None)
+
+            new = measure(receive)
+            assert result[0] == data and transfer.get_data() == data
+            mb = size / 1024 / 1024
+            print('{:>8} -> {:.1f}, {:.1f}'.format(size, mb / old, mb / new))
+
+    def bench_progress(self):
+        size, speed = 1024 * 1024 * 1024, 10 * 1024 * 1024
+        print('Progress of 1 GB transfer at 10 MB/s in {} B chunks: chunks, progress signals, '
+              'seconds spent in signal(), ETA in the middle'.format(self.CHUNK_SIZE))
+        clock = [0.0]
+        real_time, file_transfers.time = file_transfers.time, lambda: clock[0]  # simulated time of transfer
+        try:
+            transfer = FileTransfer(None, None, 0, size)
+            signals, eta = [0], [None]
+
+            def handler(state, progress, time):
+                signals[0] += 1
+                if eta[0] is None and progress >= 0.5:
+                    eta[0] = time
+
+            transfer.set_state_changed_handler(handler)
+            transfer._creation_time = 0.0
+            chunks, step = 0, self.CHUNK_SIZE / speed
+            t = time.perf_counter()
+            for position in range(0, size, self.CHUNK_SIZE):
+                clock[0] += step
+                transfer._done += min(self.CHUNK_SIZE, size - position)
+                transfer.signal()
+                chunks += 1
+            transfer.state = TOX_FILE_TRANSFER_STATE['FINISHED']
+            transfer.signal()
+            t = time.perf_counter() - t
+        finally:
+            file_transfers.time = real_time
+        print('{} -> {}, {:.3f}, {}'.format(chunks, signals[0], t, eta[0]))
+
+    TRANSFERS_COUNT = 4
+    TRANSFER_SIZE = 64 * 1024 * 1024
+    STALL_BYTES, STALL_TIME = 4 * 1024 * 1024, 0.05  # simulated slow disk: writeback stall every 4 MB
+
+    class SlowDisk:
+        """
+        Slow or busy disk: writes to every file stall after every STALL_BYTES
+        """
+
+        def __init__(self):
+            self._written = {}  # file -> bytes written after last stall
+
+        def write(self, fl, size):
+            stalls, self._written[fl] = divmod(self._written.get(fl, 0) + size, BenchmarkTransfers.STALL_BYTES)
+            if stalls:
+                time.sleep(BenchmarkTransfers.STALL_TIME * stalls)
+
+    class Tox:
+        """
+        Accepts outgoing files and chunks
+        """
+
+        def file_send(self, friend_number, kind, size, file_id, file_name):
+            return 0
+
+        def file_send_chunk(self, friend_number, file_number, position, data):
+            return True
+
+    @staticmethod
+    def tox_thread(calls):
+        """
+        :param calls: functions called by tox thread one by one
+        :return: tuple (total seconds, max seconds of one call)
+        """
+        total = longest = 0.
+        for call in calls:
+            t = time.perf_counter()
+            call()
+            t = time.perf_counter() - t
+            total += t
+            longest = max(longest, t)
+        return total, longest
+
+    def interleaved(self, count):
+        """
+        :return: list of (transfer index, position) - chunks of concurrent transfers
+        """
+        return [(i, position) for position in range(0, self.TRANSFER_SIZE, self.CHUNK_SIZE) for i in range(count)]
+
+    def bench_io_threads(self):
+        if FileIOPool.get_instance() is None:
+            FileIOPool()
+        directory = tempfile.mkdtemp()
+        chunk = os.urandom(self.CHUNK_SIZE)
+        order = self.interleaved(self.TRANSFERS_COUNT)
+        print('{} concurrent transfers of {} MB in {} B chunks, disk stalls for {} ms every {} MB written: '
+              'tox thread seconds, longest call in ms, seconds until files are closed'.format(
+                  self.TRANSFERS_COUNT, self.TRANSFER_SIZE // 1024 // 1024, self.CHUNK_SIZE,
+                  int(self.STALL_TIME * 1000), self.STALL_BYTES // 1024 // 1024))
+        paths = [os.path.join(directory, 'file{}'.format(i)) for i in range(self.TRANSFERS_COUNT)]
+
+        disk = self.SlowDisk()
+        files = [open(path, 'wb') for path in paths]
+
+        def old_write(i, position):
+            disk.write(i, len(chunk))
+            files[i].seek(position)
+            files[i].write(bytearray(chunk))
+
+        t = time.perf_counter()
+        total, longest = self.tox_thread(lambda i=i, p=p: old_write(i, p) for i, p in order)
+        for fl in files:
+            fl.close()
+        print('{:>18}: {:.3f}, {:.2f}, {:.3f}'.format('receive in tox', total, longest * 1000, time.perf_counter() - t))
+
+        real_write = file_io.FileIOQueue._write
+
+        def slow_write(queue, position, data):
+            disk.write(queue, len(data))
+            real_write(queue, position, data)
+
+        file_io.FileIOQueue._write = slow_write
+        try:
+            transfers = [ReceiveTransfer(path, None, 0, self.TRANSFER_SIZE, 0) for path in paths]
+            t = time.perf_counter()
+            total, longest = self.tox_thread(lambda i=i, p=p: transfers[i].write_chunk(p, chunk) for i, p in order)
+            for transfer in transfers:
+                transfer.write_chunk(self.TRANSFER_SIZE, None)
+        finally:
+            file_io.FileIOQueue._write = real_write
+        print('{:>18}: {:.3f}, {:.2f}, {:.3f}'.format('receive in workers', total, longest * 1000,
+                                                      time.perf_counter() - t))
+
+        files = [open(path, 'rb') for path in paths]
+
+        def old_read(i, position):
+            files[i].seek(position)
+            return files[i].read(self.CHUNK_SIZE)
+
+        t = time.perf_counter()
+        total, longest = self.tox_thread(lambda i=i, p=p: old_read(i, p) for i, p in order)
+        for fl in files:
+            fl.close()
+        print('{:>18}: {:.3f}, {:.2f}, {:.3f}'.format('send in tox', total, longest * 1000, time.perf_counter() - t))
+
+        transfers = [SendTransfer(path, self.Tox(), 0) for path in paths]
+        t = time.perf_counter()
+        total, longest = self.tox_thread(lambda i=i, p=p: transfers[i].send_chunk(p, self.CHUNK_SIZE)
+                                         for i, p in order)
+        for transfer in transfers:
+            transfer.send_chunk(self.TRANSFER_SIZE, 0)
+        print('{:>18}: {:.3f}, {:.2f}, {:.3f}'.format('send in workers', total, longest * 1000,
+                                                      time.perf_counter() - t))
+        print('I/O metrics: {}'.format(FileIOPool.get_instance().get_metrics()))
+        for path in paths:
+            os.remove(path)
+        os.rmdir(directory)
+
+    def requests(self, size, loss=0.01, rewind=64):
+        """
+        Simulated chunk requests of toxcore: sequential, after lost packet earlier chunks are requested again
+        :return: list of positions
+        """
+        rnd = random.Random(0)
+        positions, position = [], 0
+        while position < size:
+            positions.append(position)
+            if rnd.random() < loss:
+                position = max(position - rewind * self.CHUNK_SIZE, 0)
+            position += self.CHUNK_SIZE
+        return positions
+
+    def bench_read_ahead(self):
+        if FileIOPool.get_instance() is None:
+            FileIOPool()
+        size = 256 * 1024 * 1024
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fl:
+            for _ in range(size // (1024 * 1024)):
+                fl.write(os.urandom(1024 * 1024))
+        positions = self.requests(size)
+        print('Sending of {} MB file, {} chunk requests with 1% re-requests: MB per second in tox thread, '
+              'read-ahead misses'.format(size // 1024 // 1024, len(positions)))
+        cold = hasattr(os, 'posix_fadvise')
+        for cache in ('warm', 'cold') if cold else ('warm', ):
+            for name in ('seek and read', 'read-ahead blocks', 'read-ahead mmap'):
+                with open(path, 'rb') as fl:
+                    if cache == 'cold':  # drop file from page cache
+                        os.posix_fadvise(fl.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                    if name == 'seek and read':
+                        def read(position):
+                            fl.seek(position)
+                            return fl.read(self.CHUNK_SIZE)
+                        queue = None
+                    else:
+                        queue = FileIOPool.get_instance().create_queue(fl)
+                        read_ahead = ReadAhead(queue, name.endswith('mmap'))
+                        read = lambda position: read_ahead.read(position, self.CHUNK_SIZE)
+                    misses = FileIOPool.get_instance().get_metrics()['read_ahead_misses']
+                    t = measure(lambda: [read(position) for position in positions])
+                    misses = FileIOPool.get_instance().get_metrics()['read_ahead_misses'] - misses
+                    if queue is not None:
+                        read_ahead.close()
+                        queue.close()
+                print('{:>5} {:>18}: {:.0f}, {}'.format(cache, name, size / 1024 / 1024 / t, misses))
+        os.remove(path)
+
+    class Link:
+        """
+        Tox with packet queue of connection to friend. Packets leave queue in order at link rate
+        """
+
+        RATE = 1024 * 1024  # bytes per second
+        QUEUE_SIZE = 8192  # packets
+
+        def __init__(self):
+            self.queue = deque()  # tuples (file number, size)
+            self._files, self._budget = 0, 0.
+
+        def file_send(self, friend_number, kind, size, file_id, file_name):
+            self._files += 1
+            return self._files
+
+        def file_send_chunk(self, friend_number, file_number, position, data):
+            if len(self.queue) >= self.QUEUE_SIZE:
+                raise RuntimeError('Packet queue is full.')
+            self.queue.append((file_number, len(data)))
+            return True
+
+        def transmit(self, dt):
+            """
+            :return: list of (file number, size) of packets sent in dt seconds
+            """
+            self._budget += self.RATE * dt
+            sent = []
+            while self.queue and self._budget >= self.queue[0][1]:
+                self._budget -= self.queue[0][1]
+                sent.append(self.queue.popleft())
+            if not self.queue:
+                self._budget = 0.
+            return sent
+
+    def shaping(self, scheduled, path, start=2., step=0.01):
+        """
+        Simulates upload of big file and two inline images sent after start seconds. Toxcore requests chunks
+        while packet queue has free slots
+        :return: dict file number -> seconds from start to delivery of file
+        """
+        link, now = self.Link(), [0.]
+        scheduler = TransferScheduler(0.95 * link.RATE, lambda: now[0]) if scheduled else None
+        big = SendTransfer(path, link, 0)
+        transfers, requested, delivered, result = [big], {}, {}, {}
+        while len(result) < 2:
+            if now[0] >= start and len(transfers) == 1:
+                transfers += [SendFromBuffer(link, 0, os.urandom(size), 'toxygen_inline.png')
+                              for size in self.IMAGE_SIZES[:2]]
+            free = link.QUEUE_SIZE - len(link.queue)
+            for transfer in transfers:
+                size, number = transfer.get_size(), transfer.get_file_number()
+                while free and requested.get(number, 0) < size:
+                    position = requested.get(number, 0)
+                    chunk = min(self.CHUNK_SIZE, size - position)
+                    requested[number] = position + chunk
+                    free -= 1
+                    if scheduled:
+                        scheduler.request(transfer, position, chunk)
+                    else:
+                        transfer.send_chunk(position, chunk)
+            if scheduled:
+                scheduler.send_chunks()
+            now[0] += step
+            for number, size in link.transmit(step):
+                delivered[number] = delivered.get(number, 0) + size
+                if number != big.get_file_number() and delivered[number] == transfers[number - 1].get_size():
+                    result[number] = now[0] - start
+        big._close_file()
+        return result
+
+    def bench_scheduler(self):
+        fl, path = tempfile.mkstemp()
+        os.truncate(fl, 100 * 1024 * 1024)
+        os.close(fl)
+        if FileIOPool.get_instance() is None:
+            FileIOPool()
+        print('Delivery of 64 KB and 256 KB inline images during upload of big file, seconds')
+        for scheduled in (False, True):
+            result = self.shaping(scheduled, path)
+            print('{:>10}: {:.2f}, {:.2f}'.format('scheduler' if scheduled else 'old', result[2], result[3]))
+        os.remove(path)
+
+
+def run(name=None):
+    for cls in (BenchmarkHistory, BenchmarkWriteBehind, BenchmarkSearch, BenchmarkFriend, BenchmarkCallbacks,
+                BenchmarkStartup, BenchmarkMessages, BenchmarkEncryptedHistory, BenchmarkRender,
+                BenchmarkTransfers):
+        obj = cls()
+        for attr in sorted(dir(obj)):
+            if attr.startswith('bench_') and (name is None or name in attr):
+                getattr(obj, attr)()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1] if len(sys.argv) > 1 else None)
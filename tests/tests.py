@@ -1,8 +1,26 @@
+import os
+import sqlite3
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'src'))
 from src.bootstrap import node_generator
+import messages
+from src.messages import TextMessage
+from src.pixmaps import LRUCache
 from src.profile import *
-from src.settings import ProfileHelper
 from src.tox_dns import tox_dns
-from src.toxencryptsave import LibToxEncryptSave
+# modules with singletons are imported by same names as in src, otherwise tests and src get different instances
+from encrypted_storage import PagedEncryptedFile
+from file_io import FileIOPool, ReadAhead, IntervalSet
+from friend import Friend
+from file_transfers import ReceiveTransfer, STREAMING_SIZE, TOX_FILE_TRANSFER_STATE
+import history as history_module
+from history import History
+from message_render import render_message
+from settings import ProfileHelper
+from smileys import SmileyLoader, SmileyMatcher
+from toxencryptsave import LibToxEncryptSave
+from src.transfer_scheduler import TokenBucket, TransferScheduler
 
 
 class TestProfile():
@@ -85,3 +103,376 @@ class TestEncryption():
         data = lib.pass_encrypt(data)
         data = lib.pass_decrypt(data)
         assert copy_data == data
+
+    def test_paged_file(self):
+        lib = LibToxEncryptSave.get_instance() or LibToxEncryptSave()
+        lib.set_password('easypassword')
+        directory = tempfile.TemporaryDirectory()
+        plain, path = os.path.join(directory.name, 'plain'), os.path.join(directory.name, 'history')
+        data = os.urandom(3 * PagedEncryptedFile.PAGE_SIZE)
+        with open(plain, 'wb') as fl:
+            fl.write(data)
+        storage = PagedEncryptedFile(path, lib)
+        assert storage.encrypt_from(plain) == 3 and storage.encrypt_from(plain) == 0
+        PagedEncryptedFile(path, lib).decrypt_to(plain)
+        with open(plain, 'rb') as fl:
+            assert fl.read() == data
+        with open(path, 'rb') as fl:
+            encrypted = fl.read()
+        first, second = storage._slot_offset(0), storage._slot_offset(1)
+        swapped = encrypted[:first] + encrypted[second:2 * second - first] + encrypted[first:second] + \
+            encrypted[2 * second - first:]
+        for broken in (encrypted[:second], swapped):  # truncated file, swapped pages
+            with open(path, 'wb') as fl:
+                fl.write(broken)
+            try:
+                PagedEncryptedFile(path, lib).decrypt_to(plain)
+                assert False
+            except RuntimeError:
+                pass
+        directory.cleanup()
+
+
+class TestHistory():
+
+    @staticmethod
+    def create_profile():
+        directory = tempfile.mkdtemp() + '/'
+        ProfileHelper(directory, 'history')
+        LibToxEncryptSave()
+        return directory
+
+    def test_migration(self):
+        directory = self.create_profile()
+        db = sqlite3.connect(directory + 'history.hstr')
+        db.execute('CREATE TABLE friends(tox_id TEXT PRIMARY KEY)')
+        for tox_id in ('A' * 64, 'B' * 64, 'C' * 64):
+            db.execute('INSERT INTO friends VALUES (?)', (tox_id, ))
+            db.execute('CREATE TABLE id' + tox_id + '(id INTEGER PRIMARY KEY, message TEXT, owner INTEGER, '
+                       'unix_time REAL, message_type INTEGER)')
+            db.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) VALUES (?, ?, ?, ?)',
+                           [(tox_id[0] + str(i), 0, float(i), 0) for i in range(3)])
+        db.commit()
+        db.close()
+        history = History('history')
+        assert history.get_messages('B' * 64, 1) == [('B2', 0, 2.0, 0)]  # migrated on demand
+        while not history.migrate(1):
+            pass
+        assert history.friend_exists_in_db('C' * 64)
+        assert [m[0] for m in history.messages_getter('A' * 64).get_all()] == ['A2', 'A1', 'A0']
+        history.close()
+
+    def test_messages(self):
+        self.create_profile()
+        history = History('history')
+        tox_id = 'D' * 64
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, [('a', 2, 1.0, 0), ('b', 2, 2.0, 0), ('c', 2, 3.0, 0)])
+        history.update_messages(tox_id, 3.0)
+        history.delete_message(tox_id, 2.0)
+        assert history.get_messages(tox_id, -1) == [('c', 2, 3.0, 0), ('a', 0, 1.0, 0)]
+        history.delete_friend_from_db(tox_id)
+        assert not history.friend_exists_in_db(tox_id)
+        history.close()
+
+    def test_pages(self):
+        self.create_profile()
+        history = History('history')
+        tox_id = 'E' * 64
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, [(str(i), 0, float(i), 0) for i in range(10)])
+        getter = history.messages_getter(tox_id)
+        page = getter.get(4)
+        assert [m[2] for m in page] == [9.0, 8.0, 7.0, 6.0]
+        page = getter.get(4, page[-1][2])
+        assert [m[2] for m in page] == [5.0, 4.0, 3.0, 2.0]
+        assert len(getter.get_all(page[-1][2])) == 2
+        history.close()
+
+    def test_search(self):
+        self.create_profile()
+        history = History('history')
+        for tox_id in ('F' * 64, '1' * 64):
+            history.add_friend_to_db(tox_id)
+            history.save_messages_to_db(tox_id, [('hello world', 0, 1.0, 0), ('good bye', 0, 2.0, 0)])
+        assert len(history.search('hello')) == 2
+        assert [r[:2] for r in history.search('wor', 'F' * 64)] == [('F' * 64, 1.0)]
+        assert history.search('unknown') == []
+        history.close()
+
+    def test_write_behind(self):
+        self.create_profile()
+        history = History('history')
+        tox_id = '2' * 64
+        history.append_messages(tox_id, [('a', 2, 1.0, 0), ('b', 1, 2.0, 0)])
+        history.mark_as_sent(tox_id, 1.0)
+        history.flush()
+        assert history.get_messages(tox_id, -1) == [('b', 1, 2.0, 0), ('a', 0, 1.0, 0)]
+        metrics = history.get_writer_metrics()
+        assert metrics['queue_depth'] == 0 and metrics['flushed_statements'] == 3
+        history.add_friend_to_db('4' * 64)
+        history.append_messages(tox_id, [('c', 1, 3.0, 0)])
+        assert history.get_messages('4' * 64, -1) == []
+        assert history.get_writer_metrics()['queue_depth'] == 1  # other friend's page doesn't flush queue
+        assert len(history.get_messages(tox_id, -1)) == 3
+        history.append_messages(tox_id, [('d', 1, 4.0, 0)])
+        history.close()
+        history = History('history')
+        assert len(history.get_messages(tox_id, -1)) == 4
+        history.close()
+
+    def test_locked_db(self):
+        directory = self.create_profile()
+        module, logged = history_module, []
+        saved = module.BUSY_TIMEOUT, module.FLUSH_INTERVAL, module.log
+        module.BUSY_TIMEOUT, module.FLUSH_INTERVAL, module.log = 0.1, 0.2, logged.append
+        try:
+            db = History('history')
+            tox_id = '3' * 64
+            db.add_friend_to_db(tox_id)
+            lock = sqlite3.connect(directory + 'history.hstr', isolation_level=None)
+            lock.execute('BEGIN EXCLUSIVE;')
+            db.append_messages(tox_id, [('a', 1, 1.0, 0)])
+            db.flush()  # returns after failed attempt
+            metrics = db.get_writer_metrics()
+            assert metrics['failed_flushes'] == 1 and metrics['queue_depth'] == 1 and len(logged) == 1
+            db.append_messages(tox_id, [('b', 1, 2.0, 0)])
+            lock.execute('ROLLBACK;')
+            lock.close()
+            db.flush()  # failed batch is written again
+            assert [m[0] for m in db.get_messages(tox_id, -1)] == ['b', 'a']
+            db.close()
+        finally:
+            module.BUSY_TIMEOUT, module.FLUSH_INTERVAL, module.log = saved
+
+
+class TestMessages():
+
+    def test_from_db(self):
+        rows = [('a', 0, 1.0, 0), ('b', 2, 2.0, 1)]
+        messages = TextMessage.from_db(rows)
+        assert [m.get_data() for m in messages] == rows
+        assert not hasattr(messages[0], '__dict__')
+        messages[1].mark_as_sent()
+        assert messages[1].get_owner() == 0
+
+
+class TestFriend():
+
+    class MessageGetter:
+
+        def append(self, messages):
+            list(messages)
+            return True
+
+        def mark_as_sent(self, unix_time):
+            pass
+
+    def test_window(self):
+        friend = Friend(self.MessageGetter(), 0, 'friend', '', None, 'A' * 64)
+        expected, transfers = [], {}
+        for i in range(300):
+            if i % 10:
+                message = messages.TextMessage(str(i), 1, float(i), 0)
+            else:
+                message = transfers[i] = messages.TransferMessage(1, float(i), 0, 10, 'file', 0, i)
+            friend.append_message(message)
+            expected.append(message)
+        inline = messages.InlineImage(b'png')
+        position = expected.index(transfers[250])
+        expected.insert(position, inline)
+        assert friend.update_transfer_data(250, 3, inline) == position - len(expected)  # inline before transfer
+        for i in range(240):  # tombstones, then compaction
+            if i % 10:
+                friend.delete_message(float(i))
+                expected.remove(next(m for m in expected if m.get_time() == float(i)))
+                if i % 50 == 1:
+                    assert friend.get_corr()[friend.update_transfer_data(260, 0)] is transfers[260]
+        assert friend.get_corr() == expected and friend.get_last_corr(5, 3) == expected[-8:-3]
+        for i in (1000, 1001):
+            friend.append_message(messages.UnsentFile('path', None, float(i)))
+        friend.delete_one_unsent_file(1000.)
+        assert [m.get_time() for m in friend.get_unsent_files()] == [1001.]
+        friend.clear_unsent_files()
+        assert friend.get_corr() == expected and not friend.get_unsent_files()
+        friend.set_corr_limit(20)  # old finished transfer with inline is evicted, active transfers are kept
+        corr = friend.get_corr()
+        assert inline not in corr and corr == [m for m in expected if m in corr]
+        assert corr[friend.update_transfer_data(290, 0)] is transfers[290]
+        assert corr[friend.delete_transfer_message(290)] is transfers[290]
+        assert transfers[290] not in friend.get_corr() and friend.delete_transfer_message(290) is None
+
+
+class TestRender():
+
+    def test_render(self):
+        SmileyLoader({'smileys': True, 'smiley_pack': 'default'})
+        text = '<b> www.example.com\n>quote\nhi :)'
+        html, animated = render_message(text)
+        assert html.startswith('&lt;b&gt; <a href="http://www.example.com">www.example.com</a><br>')
+        assert '<font color="green"><b>quote</b></font><br>' in html
+        assert html.endswith('src="D83DDE0A.png" />')
+        assert animated == ()
+        assert render_message(text) is render_message(text)  # cached
+        assert render_message('info', 1)[0].startswith('<p align="center"')
+
+    def test_smileys(self):
+        matcher = SmileyMatcher({':)': '[smile]', ':o': '[o]', ':office:': '[office]', 'xD': '[xd]', '8)': '[8]'})
+        assert matcher.replace('yes:) <b>') == ('yes[smile] &lt;b&gt;', [':)'])
+        assert matcher.replace('xD, not xDD or ratio:one') == ('[xd], not xDD or ratio:one', ['xD'])
+        assert matcher.replace(':office:(8)') == ('[office]([8]', [':office:', '8)'])
+
+
+class TestPixmaps():
+
+    def test_lru(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        assert cache.get('a') == 1  # 'b' is least recently used now
+        cache.put('c', 3, 4)
+        assert 'b' not in cache and cache.get('c') == 3
+        assert len(cache) == 2 and cache.cost == 8
+        cache.put('big', 4, 20)  # value bigger than limit is kept alone
+        assert len(cache) == 1 and cache.get('big') == 4
+        cache.pop('big')
+        assert len(cache) == 0 and cache.cost == 0
+
+
+class TestFileIO():
+
+    def test_queue(self):
+        pool = FileIOPool.get_instance() or FileIOPool()
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'file')
+        queue = pool.create_queue(open(path, 'wb'))
+        for position in (0, 3, 6, 20):  # first three chunks are written at once
+            queue.write(position, b'abc')
+        queue.write(3, b'XYZ')  # order of writes is kept
+        queue.close()
+        with open(path, 'rb') as fl:
+            assert fl.read() == b'abcXYZabc' + b'\0' * 11 + b'abc'
+        for use_mmap in (True, False):
+            queue = pool.create_queue(open(path, 'rb'))
+            read_ahead = ReadAhead(queue, use_mmap)
+            assert read_ahead.read(3, 6) == b'XYZabc'  # miss
+            queue.flush()
+            assert read_ahead.read(20, 10) == b'abc'  # hit
+            assert read_ahead.read(0, 4) == b'abcX'  # re-request
+            read_ahead.close()
+            queue.close()
+        directory.cleanup()
+
+    def test_intervals(self):
+        intervals = IntervalSet()
+        assert intervals.add(0, 10) == 10
+        assert intervals.add(10, 20) == 10  # appended to last range
+        assert intervals.add(30, 40) == 10
+        assert intervals.add(5, 35) == 10  # only gap is new
+        assert list(intervals) == [(0, 40)] and intervals.size == 40
+        assert intervals.add(50, 60) == 10
+        assert intervals.contains(0, 40) and not intervals.contains(30, 55)
+        assert intervals.gaps(70) == [(40, 50), (60, 70)]
+        assert not intervals.is_complete(60) and IntervalSet(intervals).is_complete(40)
+
+    def test_receive(self):
+        pool = FileIOPool.get_instance() or FileIOPool()
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, 'file')
+        transfer = ReceiveTransfer(path, None, 0, 10, 0)
+        transfer.write_chunk(6, b'6789')  # chunk after gap
+        transfer.write_chunk(0, b'012')
+        transfer.write_chunk(6, b'6789')  # repeated chunk
+        transfer.suspend()
+        with open(path, 'rb') as fl:
+            assert fl.read() == b'012\0\0\0' + b'6789'
+        assert not transfer.is_complete() and transfer.get_received().gaps(10) == [(3, 6)]
+        transfer = ReceiveTransfer(path, None, 0, 10, 0, IntervalSet(list(transfer.get_received())))  # resumed
+        assert transfer.get_resume_position() == 3
+        transfer.write_chunk(3, b'345')
+        transfer.write_chunk(6, b'6789')
+        transfer.write_chunk(10, None)
+        with open(path, 'rb') as fl:
+            assert fl.read() == b'0123456789'
+        assert transfer.state == TOX_FILE_TRANSFER_STATE['FINISHED'] and transfer.get_resume_position() == 9
+        transfer = ReceiveTransfer(path, None, 0, 10, 0)
+        transfer.write_chunk(0, b'012')
+        transfer.write_chunk(3, None)  # friend finished transfer before end of file
+        assert transfer.state == TOX_FILE_TRANSFER_STATE['CANCELLED'] and not os.path.exists(path)
+        transfer = ReceiveTransfer(path, None, 0, STREAMING_SIZE, 0)  # size is unknown, file isn't preallocated
+        transfer.write_chunk(0, b'012')
+        transfer.write_chunk(3, None)
+        assert transfer.state == TOX_FILE_TRANSFER_STATE['FINISHED'] and os.path.getsize(path) == 3
+        directory.cleanup()
+
+
+class TestScheduler():
+
+    class Transfer:
+
+        def __init__(self, friend_number, file_number, size, sent):
+            self.state, self._key, self._size, self._sent = 0, (friend_number, file_number), size, sent
+
+        def get_friend_number(self):
+            return self._key[0]
+
+        def get_file_number(self):
+            return self._key[1]
+
+        def get_size(self):
+            return self._size
+
+        def send_chunk(self, position, size):
+            if self._sent is None:
+                raise OSError('file was removed')
+            self._sent.append((self._key[1], position, size))
+
+        def cancel(self):
+            self.state = 2
+
+        def get_speed(self):
+            return None
+
+        def get_eta(self):
+            return -1
+
+    def test_bucket(self):
+        now = [0.]
+        bucket = TokenBucket(40000, lambda: now[0])
+        assert bucket.allows(10000) and not bucket.allows(10001)  # burst of 0.25 s
+        bucket.consume(10000)
+        assert not bucket.allows(1)
+        now[0] = 0.125
+        assert bucket.allows(5000) and not bucket.allows(5001)
+        assert TokenBucket(0).allows(10 ** 9)
+        bucket.set_rate(80000)  # tokens aren't refilled by new limit
+        assert bucket.allows(5000) and not bucket.allows(5001)
+
+    def test_priority(self):
+        now, sent = [0.], []
+        scheduler = TransferScheduler(1000, lambda: now[0])
+        big = self.Transfer(0, 1, 10 ** 9, sent)
+        small = self.Transfer(1, 2, 1000, sent)
+        for position in range(0, 5000, 1000):
+            scheduler.request(big, position, 1000)
+        assert len(sent) == 5  # burst
+        scheduler.request(small, 0, 1000)  # waits for tokens
+        now[0] = 1.
+        scheduler.send_chunks()
+        assert sent[5:] == [(2, 0, 1000)]  # small file is sent before rest of big file
+        scheduler.set_limits(0, {0: 1000})
+        for position in range(5000, 20000, 1000):
+            scheduler.request(big, position, 1000)
+        assert len(sent) == 11 and scheduler.get_stats()[0]['waiting'] == 10000  # friend's limit
+        scheduler.set_limits(0, {0: 1000, 1: 1000})
+        scheduler.send_chunks()
+        assert len(sent) == 11  # bucket of friend is kept
+        scheduler.remove(big)
+        assert [stats['file_number'] for stats in scheduler.get_stats()] == [2]
+
+    def test_error(self):
+        failed = []
+        scheduler = TransferScheduler(error_handler=failed.append)
+        broken = self.Transfer(0, 1, 1000, None)
+        scheduler.request(broken, 0, 1000)
+        assert failed == [broken] and broken.state == 2 and scheduler.get_stats() == []